@@ -1 +1 @@
-__author__ == 'Craig Derington'
\ No newline at end of file
+__author__ = 'Craig Derington'
@@ -0,0 +1,334 @@
+"""
+asyncio receiver for the Mailgun lead webhooks.  Serves the same
+/api/v1.0/webhooks/mailgun/lead/* contract as api.py on aiohttp, with a
+bounded async connection pool: aiomysql, or aiosqlite for a sqlite url.
+
+    python aioserver.py [--host 0.0.0.0] [--port 5881]
+
+Events are verified, deduplicated and applied in the request, like the
+'sync' ingest mode.  Recipient and dedupe caches are per process and local
+only, redis would block the event loop.  Python 3 only.
+"""
+from aiohttp import web
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.engine.url import make_url
+from cache import NegativeCache, RecipientCache, Watermark
+from dedupe import WebhookDeduplicator
+from fastjson import dumps
+from ingest import LEAD_FORM_FIELDS, WEBHOOK_FORM_FIELDS, lead_form_data
+from leads import (RecipientLead, event_time, lead_event_committed, lead_event_row, lead_update,
+                   recipient_select, record_events, visitor_watermark_select)
+from models import LeadEvent
+from signatures import SignatureVerifier
+from webhookform import WebhookFormParser, FormTooLarge
+import argparse
+import asyncio
+import config
+import logging
+import signatures
+
+
+log = logging.getLogger(__name__)
+
+ROUTE = '/api/v1.0/webhooks/mailgun/lead/{}'
+
+
+def compile_statement(statement, dialect):
+    """
+    :param statement: sqlalchemy core statement
+    :param dialect: the driver's dialect
+    :return: (sql, params) for a DB-API cursor
+    """
+    compiled = statement.compile(dialect=dialect)
+    params = compiled.construct_params()
+    if compiled.positional:
+        return str(compiled), [params[name] for name in compiled.positiontup]
+    return str(compiled), params
+
+
+class MySQLPool(object):
+    """
+    aiomysql connection pool, at most maxsize connections
+    """
+
+    def __init__(self, url, minsize=1, maxsize=20):
+        self.url = make_url(url)
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.dialect = mysql.pymysql.dialect()
+        self.pool = None
+
+        import pymysql
+        self.errors = (pymysql.err.MySQLError,)
+
+    async def open(self):
+        import aiomysql
+        self.pool = await aiomysql.create_pool(
+            host=self.url.host or 'localhost',
+            port=self.url.port or 3306,
+            user=self.url.username,
+            password=self.url.password or '',
+            db=self.url.database,
+            charset='utf8',
+            autocommit=False,
+            minsize=self.minsize,
+            maxsize=self.maxsize
+        )
+
+    async def fetch_one(self, statement):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(*compile_statement(statement, self.dialect))
+                row = await cursor.fetchone()
+            # end the read transaction before the connection goes back to the pool
+            await conn.rollback()
+            return row
+
+    async def transaction(self, statements):
+        async with self.pool.acquire() as conn:
+            try:
+                async with conn.cursor() as cursor:
+                    for statement in statements:
+                        await cursor.execute(*compile_statement(statement, self.dialect))
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+
+    async def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+
+
+class SQLitePool(object):
+    """
+    One aiosqlite connection, writes serialized by a lock, for development
+    and benchmarks against a sqlite file
+    """
+
+    def __init__(self, url):
+        self.path = make_url(url).database
+        self.dialect = sqlite.dialect()
+        self.conn = None
+        self._write = asyncio.Lock()
+
+        import sqlite3
+        self.errors = (sqlite3.Error,)
+
+    async def open(self):
+        import aiosqlite
+        self.conn = await aiosqlite.connect(self.path)
+
+    async def fetch_one(self, statement):
+        async with self.conn.execute(*compile_statement(statement, self.dialect)) as cursor:
+            return await cursor.fetchone()
+
+    async def transaction(self, statements):
+        async with self._write:
+            try:
+                for statement in statements:
+                    await self.conn.execute(*compile_statement(statement, self.dialect))
+                await self.conn.commit()
+            except Exception:
+                await self.conn.rollback()
+                raise
+
+    async def close(self):
+        if self.conn is not None:
+            await self.conn.close()
+
+
+def json_response(obj, status=200):
+    return web.Response(body=dumps(obj), status=status, content_type='application/json')
+
+
+def make_pool(url, minsize=1, maxsize=20):
+    if url.startswith('sqlite'):
+        return SQLitePool(url)
+    return MySQLPool(url, minsize, maxsize)
+
+
+class WebhookReceiver(object):
+    """
+    The lead webhook handlers, mirroring mailgun_webhook and
+    apply_lead_event in api.py
+    """
+
+    def __init__(self, db, verifier, deduplicator, recipients, unknown, form_parser, watermark=None):
+        self.db = db
+        self.form_parser = form_parser
+        self.verifier = verifier
+        self.deduplicator = deduplicator
+        self.recipients = recipients
+        self.unknown = unknown
+        self.watermark = watermark or Watermark()
+
+    @classmethod
+    def from_config(cls, config):
+        db = make_pool(
+            getattr(config, 'AIO_DATABASE_URI', config.SQLALCHEMY_DATABASE_URI),
+            minsize=getattr(config, 'AIO_DB_POOL_MIN', 1),
+            maxsize=getattr(config, 'AIO_DB_POOL_MAX', 20)
+        )
+        verifier = SignatureVerifier(config.MAILGUN_API_KEY, max_age=getattr(config, 'MAILGUN_TIMESTAMP_TOLERANCE', 900))
+        deduplicator = WebhookDeduplicator(window=getattr(config, 'WEBHOOK_DEDUPE_WINDOW', 3600),
+                                           maxsize=getattr(config, 'WEBHOOK_DEDUPE_SIZE', 100000))
+        recipients = RecipientCache(maxsize=getattr(config, 'RECIPIENT_CACHE_SIZE', 10000),
+                                    ttl=getattr(config, 'RECIPIENT_CACHE_TTL', 300))
+        unknown = NegativeCache(maxsize=getattr(config, 'UNKNOWN_RECIPIENT_CACHE_SIZE', 50000),
+                                ttl=getattr(config, 'UNKNOWN_RECIPIENT_CACHE_TTL', 600))
+        watermark = Watermark(getattr(config, 'UNKNOWN_RECIPIENT_WATERMARK_INTERVAL', 1.0))
+        form_parser = WebhookFormParser.from_config(config, WEBHOOK_FORM_FIELDS)
+        return cls(db, verifier, deduplicator, recipients, unknown, form_parser, watermark)
+
+    async def generation(self):
+        """
+        leads.visitor_generation on the async pool
+        :return: int
+        """
+        if self.watermark.stale():
+            row = await self.db.fetch_one(visitor_watermark_select())
+            self.watermark.set(row[0] or 0 if row else 0)
+        return self.watermark.value
+
+    async def lookup(self, recipient):
+        """
+        leads.lookup_recipient on the async pool
+        :param recipient: the recipient email address
+        :return: RecipientLead or None
+        """
+        if not recipient:
+            return None
+
+        cached = self.recipients.get(recipient)
+        if cached is not None:
+            return RecipientLead(cached[1], cached[0], recipient)
+
+        generation = await self.generation()
+        if self.unknown.contains(recipient, generation):
+            return None
+
+        row = await self.db.fetch_one(recipient_select(recipient))
+        if row is None:
+            self.unknown.add(recipient, generation)
+            return None
+
+        row = RecipientLead(*row)
+        if row.lead_id is not None:
+            self.recipients.set(recipient, row.appended_visitor_id, row.lead_id)
+        return row
+
+    async def apply(self, kind, form_data):
+        """
+        :param kind: one of leads.LEAD_EVENTS
+        :param form_data: the webhook form data
+        :return: (body, status)
+        """
+        # answer before the caches and the dedupe window see it
+        if not form_data.get('recipient') or not form_data['recipient'].strip():
+            return {"Error": "Unable to resolve the recipient email address..."}, 406
+
+        if not self.deduplicator.claim(form_data):
+            return {"email": form_data['recipient'], "event": form_data['event'], "status": 'duplicate'}, 200
+
+        try:
+            row = await self.lookup(form_data['recipient'])
+
+            # no appended visitor for recipient email address, unapplied events release their claim
+            if not row:
+                self.deduplicator.release(form_data)
+                return {"Error": "Unable to resolve the recipient email address..."}, 406
+
+            if not row.lead_id:
+                self.deduplicator.release(form_data)
+                return {"Error": "Lead not found..."}, 404
+
+            statements = []
+            if record_events:
+                statements.append(LeadEvent.__table__.insert().values(**lead_event_row(row.lead_id, kind, form_data)))
+            statements.append(lead_update(row.lead_id, kind, form_data))
+            await self.db.transaction(statements)
+
+        except self.db.errors as err:
+            self.deduplicator.release(form_data)
+            return {"Database Error": str(err)}, 500
+
+        lead_event_committed(row.lead_id, kind, event_time(form_data))
+
+        return {"v_id": row.appended_visitor_id, "email": row.email, "event": form_data['event'],
+                "status": 'success'}, 202
+
+    async def read_form(self, request):
+        """
+        Stream the body through the form parser instead of request.post(),
+        which buffers all of it
+        :param request: aiohttp request
+        :return: dict of the whitelisted fields
+        """
+        form = self.form_parser.start(request.headers.get('Content-Type'), request.content_length)
+        async for chunk in request.content.iter_chunked(self.form_parser.chunk_size):
+            form.feed(chunk)
+        return form.close()
+
+    def handler(self, kind):
+        async def handle(request):
+            try:
+                form_data = lead_form_data(kind, await self.read_form(request))
+            except FormTooLarge as err:
+                log.warning('rejected webhook body: %s', err)
+                return json_response({"Error": "Webhook payload is too large..."}, 413)
+
+            token = form_data['token']
+            signature = form_data['signature']
+            result = self.verifier.verify(token, form_data['timestamp'], signature)
+
+            # stale or replayed payload, 406 tells Mailgun not to retry
+            if result == signatures.STALE:
+                return json_response({"Error": "Webhook timestamp is outside the allowed window..."}, 406)
+
+            # signature and token verification failed
+            if result != signatures.VALID:
+                return json_response({"Signature": signature, "Token": token}, 409)
+
+            body, status = await self.apply(kind, form_data)
+            return json_response(body, status)
+
+        return handle
+
+
+def create_app(receiver=None):
+    """
+    :param receiver: WebhookReceiver, built from config by default
+    :return: aiohttp application
+    """
+    receiver = receiver or WebhookReceiver.from_config(config)
+    app = web.Application()
+
+    for kind in LEAD_FORM_FIELDS:
+        app.router.add_post(ROUTE.format(kind), receiver.handler(kind))
+
+    async def open_pool(app):
+        await receiver.db.open()
+
+    async def close_pool(app):
+        await receiver.db.close()
+
+    app.on_startup.append(open_pool)
+    app.on_cleanup.append(close_pool)
+    app['receiver'] = receiver
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='asyncio receiver for the Mailgun lead webhooks.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5881)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
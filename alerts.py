@@ -0,0 +1,288 @@
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+import logging
+import os
+import smtplib
+import time
+
+
+log = logging.getLogger(__name__)
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+
+class SmtpPool(object):
+    """
+    A small pool of logged-in SMTP connections, checked with NOOP before
+    reuse and reopened when the server has dropped them.
+    """
+
+    def __init__(self, host, port=587, username=None, password=None, use_tls=True, size=2, timeout=10):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self._idle = Queue(maxsize=size)
+        self.opened = 0
+
+    def _connect(self):
+        conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            conn.starttls()
+        if self.username:
+            conn.login(self.username, self.password)
+        self.opened += 1
+        return conn
+
+    def _checkout(self):
+        try:
+            conn = self._idle.get_nowait()
+        except Empty:
+            return self._connect()
+
+        try:
+            if conn.noop()[0] == 250:
+                return conn
+        except smtplib.SMTPException:
+            pass
+        except (IOError, OSError):
+            pass
+
+        self._close(conn)
+        return self._connect()
+
+    def _checkin(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except Exception:
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.quit()
+        except Exception:
+            pass
+
+    def send(self, sender, recipients, message):
+        conn = self._checkout()
+        reusable = False
+        try:
+            try:
+                conn.sendmail(sender, recipients, message)
+            except (smtplib.SMTPServerDisconnected, IOError, OSError) as err:
+                # SMTPException is an OSError on python 3, only a stale
+                # connection is retried, once, on a new one
+                if isinstance(err, smtplib.SMTPException) and not isinstance(err, smtplib.SMTPServerDisconnected):
+                    raise
+                self._close(conn)
+                conn = self._connect()
+                conn.sendmail(sender, recipients, message)
+            reusable = True
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+            # the server answered and sendmail reset the transaction
+            reusable = True
+            raise
+        finally:
+            if reusable:
+                self._checkin(conn)
+            else:
+                self._close(conn)
+
+
+class TwilioSms(object):
+    """
+    Sends SMS through the Twilio REST API on one pooled HTTP session.
+    base_url can point at a local stand-in for testing.
+    """
+
+    def __init__(self, account_sid, auth_token, sender, base_url='https://api.twilio.com', pool_size=4, timeout=10):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.url = '{}/2010-04-01/Accounts/{}/Messages.json'.format(base_url.rstrip('/'), account_sid)
+        self.sender = sender
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (account_sid, auth_token)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def send(self, to, body):
+        """
+        :return: the message sid
+        """
+        resp = self.session.post(self.url, data={"To": to, "From": self.sender, "Body": body},
+                                 timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json().get('sid')
+
+
+class OutboxSmtp(object):
+    """
+    Stand-in for SmtpPool that keeps the messages in memory, for development
+    and tests.  ALERT_TRANSPORT = 'outbox' selects it.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self._lock = Lock()
+
+    def send(self, sender, recipients, message):
+        with self._lock:
+            self.messages.append((sender, list(recipients), message))
+
+
+class OutboxSms(object):
+    """
+    Stand-in for TwilioSms that keeps the messages in memory
+    """
+
+    def __init__(self):
+        self.messages = []
+        self._lock = Lock()
+
+    def send(self, to, body):
+        """
+        :return: a fake message sid
+        """
+        with self._lock:
+            self.messages.append((to, body))
+            return 'SM{:032d}'.format(len(self.messages))
+
+
+class AlertDispatcher(object):
+    """
+    Delivers alert emails and SMS to many recipients concurrently on a
+    bounded thread pool, reusing connections per process.  With a factory
+    the transports are only built on first use.
+    """
+
+    def __init__(self, smtp=None, sms=None, sender=None, pool_size=4, factory=None):
+        self._smtp = smtp
+        self._sms = sms
+        self._factory = factory
+        self.sender = sender
+        self.pool_size = pool_size
+        self._pool = None
+        self._pid = None
+        self._lock = Lock()
+        self.metrics = {}
+
+    @classmethod
+    def from_config(cls, config):
+        def factory():
+            if getattr(config, 'ALERT_TRANSPORT', 'smtp') == 'outbox':
+                return OutboxSmtp(), OutboxSms()
+
+            smtp = SmtpPool(
+                getattr(config, 'MAIL_SERVER', 'smtp.mailgun.org'),
+                getattr(config, 'MAIL_PORT', 587),
+                config.MAIL_USERNAME,
+                config.MAIL_PASSWORD,
+                use_tls=getattr(config, 'MAIL_USE_TLS', True)
+            )
+            sms = TwilioSms(
+                config.TWILIO_ACCOUNT_SID,
+                config.TWILIO_AUTH_TOKEN,
+                getattr(config, 'TWILIO_FROM_NUMBER', '+14152342025'),
+                base_url=getattr(config, 'TWILIO_API_BASE_URL', 'https://api.twilio.com')
+            )
+            return smtp, sms
+
+        return cls(sender=config.MAIL_DEFAULT_SENDER, pool_size=getattr(config, 'ALERT_POOL_SIZE', 4),
+                   factory=factory)
+
+    def load(self):
+        """
+        Build the transports now
+        :return: self
+        """
+        if self._factory is not None:
+            with self._lock:
+                if self._factory is not None:
+                    self._smtp, self._sms = self._factory()
+                    self._factory = None
+        return self
+
+    @property
+    def smtp(self):
+        return self.load()._smtp
+
+    @property
+    def sms(self):
+        return self.load()._sms
+
+    def _workers(self):
+        # pools don't survive a fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = ThreadPool(self.pool_size)
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _record(self, channel, started, ok):
+        elapsed = (time.time() - started) * 1000.0
+        with self._lock:
+            m = self.metrics.setdefault(channel, {"sent": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            m['sent' if ok else 'errors'] += 1
+            m['total_ms'] += elapsed
+            m['max_ms'] = max(m['max_ms'], elapsed)
+
+    def _timed(self, channel, fn, *args):
+        started = time.time()
+        try:
+            result = fn(*args)
+        except Exception as err:
+            self._record(channel, started, False)
+            log.error('%s alert to %s failed: %s', channel, args[0], err)
+            return None
+        self._record(channel, started, True)
+        return result
+
+    def _fan_out(self, channel, fn, items):
+        return self._workers().map(lambda args: self._timed(channel, fn, *args), items)
+
+    def send_email(self, recipients, subject, html, text='EARL API v1.0'):
+        """
+        One message per recipient, sent concurrently
+        :return: list of recipients that were sent to
+        """
+        def send(to):
+            msg = MIMEMultipart('alternative')
+            msg['Subject'] = subject
+            msg['From'] = self.sender
+            msg['To'] = to
+            msg.attach(MIMEText(text, 'plain'))
+            msg.attach(MIMEText(html, 'html'))
+            self.smtp.send(self.sender, [to], msg.as_string())
+            return to
+
+        return [r for r in self._fan_out('email', send, [(to,) for to in recipients]) if r]
+
+    def send_sms(self, numbers, body):
+        """
+        :return: list of twilio message sids
+        """
+        return [sid for sid in self._fan_out('sms', self.sms.send, [(n, body) for n in numbers]) if sid]
+
+    def stats(self):
+        stats = {}
+        for channel, m in self.metrics.items():
+            total = m['sent'] + m['errors']
+            stats[channel] = {
+                "sent": m['sent'],
+                "errors": m['errors'],
+                "avg_ms": round(m['total_ms'] / total, 3) if total else 0.0,
+                "max_ms": round(m['max_ms'], 3)
+            }
+        return stats
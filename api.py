@@ -1,57 +1,99 @@
-from flask import Flask, Response, abort, request, jsonify, g, url_for, render_template, flash
-from flask_mail import Mail, Message
-from flask_sslify import SSLify
-from flask_sqlalchemy import SQLAlchemy
+from flask import Blueprint, Flask, Response, abort, request, g, url_for, render_template, flash
 from flask_httpauth import HTTPBasicAuth
 from sqlalchemy import exc, and_, desc
-from database import db_session
+from database import db_session, read_session, remove_sessions, engine, replica_engine
 from celery import Celery
-from datetime import datetime
-from models import User, Lead, AppendedVisitor, GlobalDashboard
-from twilio.rest import Client
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+from models import User
+from leads import (lookup_recipient, update_lead, lead_event_committed, event_time, recipient_cache,
+                   unknown_recipients, visitor_generation, COUNTERS)
+from ingest import (compact_event, event_from_json, lead_form_data, write_dead_letter, QueueDepthProbe,
+                    WEBHOOK_FORM_FIELDS)
+from batching import LeadEventBatcher, CounterAccumulator, PendingLead, flush_pending
+from dedupe import WebhookDeduplicator
+from signatures import SignatureVerifier
+from eventlog import EventLog
+from health import HealthMonitor, Cooldown
+from alerts import AlertDispatcher
+from metrics import Registry, cache_collector, signature_collector
+from querylog import QueryProfiler
+from fastjson import json_response, constant_response
+from webhookform import WebhookFormParser, FormTooLarge
+from six import string_types
+from threading import Thread
+import health
+import rollups
+import signatures
+import ingest
 import config
 import json
+import logging
 import random
-import hashlib
-import hmac
 import time
 
 
 # debug
 debug = config.DEBUG
 
-# app config
-app = Flask(__name__)
-sslify = SSLify(app)
-app.config['SECRET_KEY'] = config.SECRET_KEY
+log = logging.getLogger(__name__)
 
-# Flask-Mail configuration
-app.config['MAIL_SERVER'] = 'smtp.mailgun.org'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
-app.config['MAIL_USERNAME'] = config.MAIL_USERNAME
-app.config['MAIL_PASSWORD'] = config.MAIL_PASSWORD
-app.config['MAIL_DEFAULT_SENDER'] = config.MAIL_DEFAULT_SENDER
+# constant error responses, encoded once, Mailgun retries hit these hardest
+LEAD_NOT_FOUND = constant_response({"Error": "Lead not found..."}, 404)
+UNRESOLVED_RECIPIENT = constant_response({"Error": "Unable to resolve the recipient email address..."}, 406)
+STALE_WEBHOOK = constant_response({"Error": "Webhook timestamp is outside the allowed window..."}, 406)
+METHOD_NOT_ALLOWED = constant_response({"Message": "Method Not Allowed"}, 405)
+PAYLOAD_TOO_LARGE = constant_response({"Error": "Webhook payload is too large..."}, 413)
 
-# SQLAlchemy
-app.config['SQLALCHEMY_DATABASE_URI'] = config.SQLALCHEMY_DATABASE_URI
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = config.SQLALCHEMY_TRACK_MODIFICATIONS
-db = SQLAlchemy(app)
-
-# disable strict slashes
-app.url_map.strict_slashes = False
-
-# Celery config
-app.config['CELERY_BROKER_URL'] = config.CELERY_BROKER_URL
-app.config['CELERY_RESULT_BACKEND'] = config.CELERY_RESULT_BACKEND
-app.config['CELERY_ACCEPT_CONTENT'] = config.CELERY_ACCEPT_CONTENT
+# the routes, registered on the Flask app built by create_app()
+bp = Blueprint('api', __name__)
 
 # Initialize Celery
-celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
-celery.conf.update(app.config)
-
-# Config mail
-mail = Mail(app)
+celery = Celery(__name__, broker=config.CELERY_BROKER_URL)
+celery.conf.update(
+    CELERY_BROKER_URL=config.CELERY_BROKER_URL,
+    CELERY_RESULT_BACKEND=config.CELERY_RESULT_BACKEND,
+    CELERY_ACCEPT_CONTENT=config.CELERY_ACCEPT_CONTENT
+)
+
+# webhook ingest mode, 'sync' applies events in the request, 'async' hands
+# them to celery and falls back to sync when the queue is too deep
+ingest_mode = getattr(config, 'WEBHOOK_INGEST_MODE', ingest.SYNC)
+async_max_queue = getattr(config, 'WEBHOOK_ASYNC_MAX_QUEUE', 10000)
+async_queue = QueueDepthProbe(celery, queue=getattr(config, 'WEBHOOK_ASYNC_QUEUE', 'celery'))
+
+# failed async events are retried with backoff (seconds), then dead lettered
+task_max_retries = getattr(config, 'WEBHOOK_TASK_MAX_RETRIES', 5)
+task_retry_backoff = getattr(config, 'WEBHOOK_TASK_RETRY_BACKOFF', 2)
+task_retry_backoff_max = getattr(config, 'WEBHOOK_TASK_RETRY_BACKOFF_MAX', 300)
+dead_letter_dir = getattr(config, 'WEBHOOK_DEAD_LETTER_DIR', 'var/webhook-dead-letter')
+
+# 'batch' buffers events per worker and flushes them every few milliseconds
+batcher = LeadEventBatcher(
+    db_session,
+    flush_interval=getattr(config, 'WEBHOOK_BATCH_INTERVAL_MS', 50) / 1000.0,
+    max_batch=getattr(config, 'WEBHOOK_BATCH_SIZE', 500)
+).register_atexit()
+
+# 'log' appends verified webhooks to a local durable log, drain.py applies it
+event_log = EventLog(
+    getattr(config, 'WEBHOOK_LOG_DIR', 'var/webhook-log'),
+    segment_bytes=getattr(config, 'WEBHOOK_LOG_SEGMENT_BYTES', 64 * 1024 * 1024),
+    group_commit_ms=getattr(config, 'WEBHOOK_LOG_GROUP_COMMIT_MS', 2.0)
+)
+
+# upper bound on events in one JSON webhook request
+json_max_batch = getattr(config, 'WEBHOOK_JSON_MAX_BATCH', 1000)
+
+# remembers recent webhook tokens so Mailgun redeliveries are only applied once
+deduplicator = WebhookDeduplicator.from_config(config)
+
+# optionally aggregate open/click counters per lead for a few seconds in sync mode
+counter_flush_interval = getattr(config, 'LEAD_COUNTER_FLUSH_INTERVAL', 0)
+counter_accumulator = None
+if counter_flush_interval:
+    counter_accumulator = CounterAccumulator(db_session, flush_interval=counter_flush_interval).register_atexit()
 
 # auth
 auth = HTTPBasicAuth()
@@ -59,23 +101,197 @@ auth = HTTPBasicAuth()
 # mailgun_api_key
 mailgun_api_key = config.MAILGUN_API_KEY
 
-
-# clear all db sessions at the end of each request
-@app.teardown_appcontext
+# webhook signature check, rejects timestamps older than the tolerance
+verifier = SignatureVerifier(mailgun_api_key, max_age=getattr(config, 'MAILGUN_TIMESTAMP_TOLERANCE', 900))
+
+# streams the webhook bodies, keeping only the fields the lead routes read,
+# bounded by WEBHOOK_MAX_CONTENT_LENGTH and WEBHOOK_MAX_FIELD_SIZE
+webhook_form_parser = WebhookFormParser.from_config(config, WEBHOOK_FORM_FIELDS)
+
+# alert email and SMS, sent concurrently over pooled SMTP and HTTP connections
+alert_dispatcher = AlertDispatcher.from_config(config)
+
+# request, webhook and database metrics, summed across workers through METRICS_DIR
+metrics = Registry.from_config(config)
+metrics.counter('earl_http_requests_total', 'HTTP requests by route, method and status.')
+metrics.histogram('earl_http_request_duration_seconds', 'HTTP request latency by route.')
+metrics.counter('earl_webhook_events_total', 'Mailgun webhook events by event type and response status.')
+metrics.histogram('earl_webhook_event_duration_seconds', 'Mailgun webhook latency by event type.')
+metrics.counter('earl_db_statements_total', 'SQL statements executed by route.')
+metrics.counter('earl_db_commits_total', 'Database commits by route.')
+metrics.histogram('earl_db_statements_per_request', 'SQL statements per request.',
+                  buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55))
+metrics.histogram('earl_db_duration_seconds', 'Database time per request by route.')
+metrics.counter('earl_cache_hits_total', 'Cache hits by cache.')
+metrics.counter('earl_cache_misses_total', 'Cache misses by cache.')
+metrics.counter('earl_signature_checks_total', 'Webhook signature checks by result.')
+metrics.counter('earl_signature_check_seconds_total', 'Time spent checking webhook signatures.')
+
+# per request statement count, database time and slowest statement, plus the
+# slow query log (statements over SLOW_QUERY_MS)
+query_profiler = QueryProfiler.from_config(config).install(engine)
+if replica_engine is not engine:
+    query_profiler.install(replica_engine)
+request_log = logging.getLogger(__name__ + '.requests')
+
+for cache_name, cache in (('recipient', recipient_cache.local), ('unknown_recipient', unknown_recipients.local),
+                          ('webhook_dedupe', deduplicator.local)):
+    metrics.register_collector(cache_collector(cache_name, cache))
+if recipient_cache.shared is not None:
+    metrics.register_collector(cache_collector('recipient_redis', recipient_cache.shared))
+metrics.register_collector(signature_collector(verifier))
+
+
+@bp.before_app_request
+def start_request_metrics():
+    g.request_started = time.time()
+    query_profiler.start()
+
+
+@bp.after_app_request
+def record_request_metrics(response):
+    elapsed = time.time() - g.get('request_started', time.time())
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    status = response.status_code
+
+    metrics.inc('earl_http_requests_total', route=route, method=request.method, status=status)
+    metrics.observe('earl_http_request_duration_seconds', elapsed, route=route)
+
+    # set by apply_lead_event for the single event webhooks
+    kind = g.get('webhook_event')
+    if kind:
+        metrics.inc('earl_webhook_events_total', event=kind, status=status)
+        metrics.observe('earl_webhook_event_duration_seconds', elapsed, event=kind)
+
+    db = query_profiler.stop()
+    if db:
+        metrics.inc('earl_db_statements_total', db['db_statements'], route=route)
+        metrics.inc('earl_db_commits_total', db['db_commits'], route=route)
+        metrics.observe('earl_db_statements_per_request', db['db_statements'])
+        metrics.observe('earl_db_duration_seconds', db['db_ms'] / 1000.0, route=route)
+
+        # one structured line per request
+        line = {"route": route, "method": request.method, "status": status, "ms": round(elapsed * 1000.0, 3)}
+        if kind:
+            line['event'] = kind
+        line.update(db)
+        request_log.info(json.dumps(line))
+
+    return response
+
+
+# clear the db sessions used by the request, routes that never query don't create one
 def shutdown_session(exception=None):
-    db_session.remove()
+    remove_sessions()
 
 
 # tasks sections, for async functions, etc...
-@celery.task(serializer='pickle')
-def send_async_email(msg):
-    """Background task to send an email with Flask-Mail."""
-    with app.app_context():
-        mail.send(msg)
+@celery.task(ignore_result=True)
+def send_health_alert(kind):
+    """Background task to send an EARL health alert by email or SMS."""
+    if kind == health.EMAIL:
+        send_email(config.ALERT_EMAIL, "EARL Automation ALERT!", "EARL Automation - Health Check Failed!")
+
+    elif kind == health.SMS:
+        send_alerts()
+
+
+def dispatch_health_alert(kind):
+    """
+    Hand a health alert to celery, or to a thread when the broker is down
+    :param kind: health.EMAIL or health.SMS
+    :return: None
+    """
+    try:
+        send_health_alert.delay(kind)
+    except Exception as err:
+        log.warning('unable to queue the %s health alert, sending it in a thread: %s', kind, err)
+        thread = Thread(target=send_health_alert, args=(kind,))
+        thread.daemon = True
+        thread.start()
+
+
+# health checks run in the background, the status route serves the last result
+health_monitor = HealthMonitor(
+    read_session,
+    dispatch_health_alert,
+    interval=getattr(config, 'HEALTH_CHECK_INTERVAL', 60),
+    cooldown=Cooldown.from_config(config),
+    fallback=db_session
+)
+
+
+@celery.task(bind=True, ignore_result=True, max_retries=task_max_retries)
+def apply_lead_event_task(self, kind, event, dedupe_keys=()):
+    """
+    Background task to apply a verified Mailgun webhook event to its lead.
+    Database errors are retried with exponential backoff.  The webhook was
+    already acknowledged, so on the last failure the event goes to the dead
+    letter directory and its dedupe keys are released.
+    """
+    try:
+        row = lookup_recipient(db_session, event['recipient'])
+
+        if row and row.lead_id:
+            update_lead(db_session, row.lead_id, kind, event)
+            db_session.commit()
+            lead_event_committed(row.lead_id, kind, event_time(event))
+        else:
+            deduplicator.release_keys(list(dedupe_keys))
+
+    except exc.SQLAlchemyError as err:
+        db_session.rollback()
+
+        if self.request.retries < self.max_retries:
+            countdown = min(task_retry_backoff * 2 ** self.request.retries, task_retry_backoff_max)
+            raise self.retry(exc=err, countdown=countdown * random.uniform(0.5, 1.0))
+
+        path = write_dead_letter(dead_letter_dir, kind, event, err)
+        deduplicator.release_keys(list(dedupe_keys))
+        log.error('gave up on a %s event for %s after %s retries, kept in %s: %s',
+                  kind, event.get('recipient'), self.request.retries, path, err)
+
+    finally:
+        db_session.remove()
+
+
+def mailgun_webhook(f):
+    """
+    Entry guard for the Mailgun webhooks, streams the whitelisted form fields
+    and verifies the timestamp, token and signature before the route does any
+    database work.
+    :param f: the webhook view
+    :return: decorated view
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        # parse the body once, the route reads its fields from g.webhook_form
+        try:
+            form = g.webhook_form = webhook_form_parser.parse(request.stream, request.content_type,
+                                                              request.content_length)
+        except FormTooLarge as err:
+            log.warning('rejected webhook body: %s', err)
+            return PAYLOAD_TOO_LARGE()
+
+        token = form.get('token')
+        signature = form.get('signature')
+        result = verifier.verify(token, form.get('timestamp'), signature)
+
+        if result == signatures.VALID:
+            return f(*args, **kwargs)
+
+        # stale or replayed payload, 406 tells Mailgun not to retry
+        if result == signatures.STALE:
+            return STALE_WEBHOOK()
+
+        # signature and token verification failed
+        return json_response({"Signature": signature, "Token": token}, 409)
+
+    return decorated
 
 
 # default routes
-@app.route('/', methods=['GET'])
+@bp.route('/', methods=['GET'])
 def site_root():
     """
     Server a nicely formatted EARL API webpage
@@ -93,9 +309,9 @@ def site_root():
     )
 
 
-@app.route('/api', methods=['GET'])
-@app.route('/api/v1.0', methods=['GET'])
-@app.route('/api/v1.0/index', methods=['GET'])
+@bp.route('/api', methods=['GET'])
+@bp.route('/api/v1.0', methods=['GET'])
+@bp.route('/api/v1.0/index', methods=['GET'])
 def index():
     """
     The default API view.  List routes:
@@ -109,71 +325,177 @@ def index():
     api_routes['unsubscribe'] = '/api/v1.0/webhooks/mailgun/lead/unsubscribe'
     api_routes['clicks'] = '/api/v1.0/webhooks/mailgun/lead/click'
     api_routes['opens'] = '/api/v1.0/webhooks/mailgun/lead/open'
+    api_routes['events'] = '/api/v1.0/webhooks/mailgun/events'
 
     # return the response
-    return jsonify(api_routes), 200
+    return json_response(api_routes, 200)
 
 
-@app.route('/api/v1.0/automation/dashboard/health/status')
+@bp.route('/api/v1.0/automation/dashboard/health/status')
 def check_earl_health():
     """
     Administrative function to compare the health of the EARL system.
-    :return: None or send_alerts()
+    Serves the last result of the background health monitor.
+    :return: json
     """
+    return json_response(health_monitor.result(), 200)
 
-    # function variables
-    g1, g2, a1, a2 = range(4)
-    resp = {"EARL Health": "OK!"}
-    data = None
-    dashboards = db_session.query(GlobalDashboard.total_unique_visitors,
-                                  GlobalDashboard.total_appends).order_by(GlobalDashboard.id.desc()).limit(2).all()
 
-    for idx, dashboard in enumerate(dashboards):
-        if idx == 0:
-            g1 = int(dashboard[0])
-            a1 = int(dashboard[1])
-        else:
-            g2 = int(dashboard[0])
-            a2 = int(dashboard[1])
+@bp.route('/api/v1.0/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Prometheus scrape endpoint, the metrics of every worker process.
+    :return: text
+    """
+    return Response(metrics.render(), status=200, mimetype='text/plain; version=0.0.4')
+
+
+@bp.route('/api/v1.0/automation/webhooks/batch/status')
+def webhook_batch_status():
+    """
+    Flush statistics for the webhook event batcher in this worker.
+    :return: json
+    """
+    resp = batcher.stats()
+    resp['ingest_mode'] = ingest_mode
+    return json_response(resp, 200)
+
+
+@bp.route('/api/v1.0/automation/alerts/status')
+def alert_status():
+    """
+    Health check runs and alert delivery statistics for this worker.
+    :return: json
+    """
+    return json_response({"health": health_monitor.stats(), "alerts": alert_dispatcher.stats()}, 200)
 
-    # compare the values from the query and trip alerts
-    # if duplicate values are found
-    if g1 and g2 > 4:
-        if compare_(g1, g2) is True:
 
-            # set up email
-            alert_email = config.ALERT_EMAIL
-            msg_subject = "EARL Automation ALERT!"
-            msg_body = "EARL Automation - Health Check Failed!"
+@bp.route('/api/v1.0/campaigns/<int:campaign_id>/timeseries', methods=['GET'])
+def campaign_timeseries(campaign_id):
+    """
+    Engagement time series for a campaign, served from the rollups.
+    Query args: start, end (ISO dates), granularity (hour or day), metrics.
+    :return: json
+    """
+    try:
+        end = parse_date(request.args.get('end')) or datetime.now()
+        start = parse_date(request.args.get('start')) or end - timedelta(days=7)
+    except ValueError:
+        return json_response({"Error": "start and end must be ISO dates..."}, 400)
+
+    granularity = request.args.get('granularity', rollups.HOUR)
+    requested = [m for m in request.args.get('metrics', ','.join(rollups.METRICS)).split(',') if m]
 
-            # send email async with celery
-            send_email(alert_email, msg_subject, msg_body)
+    if granularity not in (rollups.HOUR, rollups.DAY) or not set(requested) <= set(rollups.METRICS):
+        return json_response({"Error": "Unknown granularity or metric...", "metrics": list(rollups.METRICS)}, 400)
 
-            # continue comparison and trip SMS
-            if a1 and a2 > 4:
-                if compare_(a1, a2) is True:
-                    resp = send_alerts()
+    try:
+        series = rollups.timeseries(read_session, campaign_id, start, end, granularity, requested)
 
-    # return api response
-    if resp:
-        data = resp
+    # database exception
+    except exc.SQLAlchemyError as err:
+        return json_response({"Database Error": str(err)}, 500)
 
-    return jsonify(resp), 200
+    return json_response({"campaign_id": campaign_id, "granularity": granularity, "start": start.isoformat(),
+                          "end": end.isoformat(), "series": series}, 200)
 
 
-@app.route('/api/v1.0/webhooks/mailgun/delivered', methods=['POST'])
+@bp.route('/api/v1.0/webhooks/mailgun/delivered', methods=['POST'])
+@bp.route('/api/v1.0/webhooks/mailgun/events', methods=['POST'])
 def lead_delivered_json():
     """
-    MG route for delivered
+    MG route for JSON event-data payloads, a single event or a list of events.
+    The batch is applied in one transaction with a status for each item.
     :return: json
     """
-
     if request.method == 'POST':
-        data = request.get_json()
-        return jsonify(data), 200
+        data = request.get_json(silent=True)
+        single = isinstance(data, dict)
+        items = [data] if single else data
+
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            return json_response({"Error": "Expected an event object or a list of events..."}, 400)
+
+        if len(items) > json_max_batch:
+            return json_response({"Error": "At most {} events per request...".format(json_max_batch)}, 413)
+
+        results = []
+        kinds = []
+        claimed = []
+        pending = OrderedDict()
+
+        for idx, item in enumerate(items):
+            if not valid_event_shape(item):
+                results.append({"index": idx, "event": None, "email": None, "status": 'malformed', "code": 406})
+                kinds.append(None)
+                continue
+
+            kind, form_data = event_from_json(item)
+            result = {"index": idx, "event": form_data['event'], "email": form_data['recipient']}
+            results.append(result)
+            kinds.append(kind)
+
+            check = verifier.verify(form_data['token'], form_data['timestamp'], form_data['signature'])
+            if check != signatures.VALID:
+                result['status'], result['code'] = check, 406 if check == signatures.STALE else 409
+                continue
+
+            if kind is None:
+                result['status'], result['code'] = 'ignored', 200
+                continue
+
+            if not valid_recipient(form_data['recipient']):
+                result['status'], result['code'] = 'unresolved', 406
+                continue
+
+            if not deduplicator.claim(form_data):
+                result['status'], result['code'] = 'duplicate', 200
+                continue
+            claimed.append(form_data)
+
+            try:
+                row = lookup_recipient(db_session, form_data['recipient'])
+            except exc.SQLAlchemyError as err:
+                db_session.rollback()
+                for claim in claimed:
+                    deduplicator.release(claim)
+                return json_response({"Database Error": str(err)}, 500)
+
+            if not row or not row.lead_id:
+                # not applied, keep the dedupe window open for a redelivery
+                deduplicator.release(claimed.pop())
+                result['status'], result['code'] = ('lead not found', 404) if row else ('unresolved', 406)
+            else:
+                pending.setdefault(row.lead_id, PendingLead(row.lead_id)).apply(kind, form_data)
+                result['v_id'] = row.appended_visitor_id
+                result['status'], result['code'] = 'success', 202
+
+        # apply every resolved event in a single transaction
+        if pending:
+            try:
+                flush_pending(db_session, pending)
+            except exc.SQLAlchemyError as err:
+                db_session.rollback()
+                for claim in claimed:
+                    deduplicator.release(claim)
+                return json_response({"Database Error": str(err)}, 500)
+
+        for kind, result in zip(kinds, results):
+            metrics.inc('earl_webhook_events_total', event=kind or 'ignored', status=result['code'])
+
+        if single:
+            return json_response(results[0], results[0]['code'])
 
+        applied = len([r for r in results if r['status'] == 'success'])
+        return json_response({"events": len(results), "applied": applied, "results": results}, 200)
 
-@app.route('/api/v1.0/webhooks/mailgun/lead/delivered', methods=['POST'])
+    else:
+        # method not allowed
+        return METHOD_NOT_ALLOWED()
+
+
+@bp.route('/api/v1.0/webhooks/mailgun/lead/delivered', methods=['POST'])
+@mailgun_webhook
 def lead_delivered():
     """
     The lead email delivered webhook.
@@ -181,89 +503,17 @@ def lead_delivered():
     """
     if request.method == 'POST':
 
-        form_data = {
-            "message_id": request.form.get('Message-Id'),
-            "domain": request.form.get('domain'),
-            "event": request.form.get('event'),
-            "timestamp": request.form.get('timestamp'),
-            "recipient": request.form.get('recipient'),
-            "signature": request.form.get('signature'),
-            "token": request.form.get('token')
-        }
-
-        # verify the mailgun token and signature with the api_key
-        token = form_data['token'].encode('utf-8')
-        timestamp = form_data['timestamp'].encode('utf-8')
-        signature = form_data['signature'].encode('utf-8')
-        mg_recipient = form_data['recipient']
-        webhook_event = form_data['event']
-
-        if verify(mailgun_api_key, token, timestamp, signature):
-
-            try:
-                av = db_session.query(AppendedVisitor).filter(
-                    AppendedVisitor.email == mg_recipient
-                ).first()
-
-                if av:
-
-                    try:
-                        lead = db_session.query(Lead).filter(
-                            Lead.appended_visitor_id == av.id
-                        ).one()
-
-                        if lead:
-                            email = av.email
-                            av_id = lead.appended_visitor_id
-
-                            # set the delivered flags in the database
-                            lead.followup_email_delivered = 1
-                            lead.followup_email_status = webhook_event
-                            lead.webhook_last_update = datetime.now()
-                            db_session.commit()
-
-                            # return a successful response
-                            return jsonify({"v_id": av_id, "email": email, "event": webhook_event,
-                                            "status": 'success'}), 202
-
-                        # return 404 for lead not found
-                        else:
-                            resp = {"Error": "Lead not found..."}
-                            data = json.dumps(resp)
-                            return Response(data, status=404, mimetype='application/json')
-
-                    # database exception
-                    except exc.SQLAlchemyError as err:
-                        resp = {"Database Error": str(err)}
-                        data = json.dumps(resp)
-                        return Response(data, status=500, mimetype='application/json')
-
-                else:
-                    # return 404: no email for recipient email address
-                    resp = {"Error": "Unable to resolve the recipient email address..."}
-                    data = json.dumps(resp)
-                    return Response(data, status=406, mimetype='application/json')
-
-            # database exception
-            except exc.SQLAlchemyError as err:
-                resp = {"Database Error": str(err)}
-                data = json.dumps(resp)
-                return Response(data, status=500, mimetype='application/json')
+        form_data = lead_form_data('delivered', g.webhook_form)
 
-        # signature and token verification failed
-        else:
-            resp = {"Signature": form_data['signature'], "Token": form_data['token']}
-            data = json.dumps(resp)
-            return Response(data, status=409, mimetype='application/json')
+        return apply_lead_event('delivered', form_data)
 
     else:
         # method not allowed
-        resp = {"Message": "Method Not Allowed"}
-        data = json.dumps(resp)
-        return Response(data, status=405, mimetype='application/json')
+        return METHOD_NOT_ALLOWED()
 
 
-@app.route('/api/v1.0/webhooks/mailgun/lead/dropped', methods=['POST'])
+@bp.route('/api/v1.0/webhooks/mailgun/lead/dropped', methods=['POST'])
+@mailgun_webhook
 def lead_dropped():
     """
     The lead email dropped webhook
@@ -271,99 +521,17 @@ def lead_dropped():
     """
     if request.method == 'POST':
 
-        form_data = {
-            "message_id": request.form.get('Message-Id'),
-            "domain": request.form.get('domain'),
-            "event": request.form.get('event'),
-            "timestamp": request.form.get('timestamp'),
-            "recipient": request.form.get('recipient'),
-            "signature": request.form.get('signature'),
-            "token": request.form.get('token'),
-            "reason": request.form.get('reason'),
-            "code": request.form.get('code'),
-            "description": request.form.get('description')
-        }
-
-        # verify the mailgun token and signature with the api_key
-        token = form_data['token'].encode('utf-8')
-        timestamp = form_data['timestamp'].encode('utf-8')
-        signature = form_data['signature'].encode('utf-8')
-        mg_recipient = form_data['recipient']
-        webhook_event = form_data['event']
-        reason = form_data['reason']
-        code = form_data['code']
-        description = form_data['description']
-
-        if verify(mailgun_api_key, token, timestamp, signature):
-
-            try:
-                av = db_session.query(AppendedVisitor).filter(
-                    AppendedVisitor.email == mg_recipient
-                ).first()
-
-                if av:
-
-                    try:
-                        lead = db_session.query(Lead).filter(
-                            Lead.appended_visitor_id == av.id
-                        ).one()
-
-                        if lead:
-                            email = av.email
-                            av_id = lead.appended_visitor_id
-
-                            # set the dropped flags in the database
-                            lead.followup_email_delivered = 0
-                            lead.followup_email_status = webhook_event
-                            lead.followup_email_dropped = 1
-                            lead.dropped_code = code
-                            lead.dropped_reason = reason
-                            lead.dropped_description = description
-                            lead.webhook_last_update = datetime.now()
-                            db_session.commit()
-
-                            # return a successful response
-                            return jsonify({"v_id": av_id, "email": email, "event": webhook_event,
-                                            "status": 'success'}), 202
-
-                        # return 404 for lead not found
-                        else:
-                            resp = {"Error": "Lead not found..."}
-                            data = json.dumps(resp)
-                            return Response(data, status=404, mimetype='application/json')
-
-                    # database exception
-                    except exc.SQLAlchemyError as err:
-                        resp = {"Database Error": str(err)}
-                        data = json.dumps(resp)
-                        return Response(data, status=500, mimetype='application/json')
-
-                else:
-                    # return 404: no email for recipient email address
-                    resp = {"Error": "Unable to resolve the recipient email address..."}
-                    data = json.dumps(resp)
-                    return Response(data, status=406, mimetype='application/json')
-
-            # database exception
-            except exc.SQLAlchemyError as err:
-                resp = {"Database Error": str(err)}
-                data = json.dumps(resp)
-                return Response(data, status=500, mimetype='application/json')
+        form_data = lead_form_data('dropped', g.webhook_form)
 
-        # signature and token verification failed
-        else:
-            resp = {"Signature": form_data['signature'], "Token": form_data['token']}
-            data = json.dumps(resp)
-            return Response(data, status=409, mimetype='application/json')
+        return apply_lead_event('dropped', form_data)
 
     else:
         # method not allowed
-        resp = {"Message": "Method Not Allowed"}
-        data = json.dumps(resp)
-        return Response(data, status=405, mimetype='application/json')
+        return METHOD_NOT_ALLOWED()
 
 
-@app.route('/api/v1.0/webhooks/mailgun/lead/hard-bounce', methods=['POST'])
+@bp.route('/api/v1.0/webhooks/mailgun/lead/hard-bounce', methods=['POST'])
+@mailgun_webhook
 def lead_hard_bounce():
     """
     The lead email hard bounce webhook
@@ -371,97 +539,17 @@ def lead_hard_bounce():
     """
     if request.method == 'POST':
 
-        form_data = {
-            "message_id": request.form.get('Message-Id'),
-            "x_mail_gun_sid": request.form.get('X-Mailgun-Sid'),
-            "domain": request.form.get('domain'),
-            "event": request.form.get('event'),
-            "timestamp": request.form.get('timestamp'),
-            "recipient": request.form.get('recipient'),
-            "signature": request.form.get('signature'),
-            "token": request.form.get('token'),
-            "code": request.form.get('code'),
-            "error": request.form.get('error')
-        }
-
-        # verify the mailgun token and signature with the api_key
-        token = form_data['token'].encode('utf-8')
-        timestamp = form_data['timestamp'].encode('utf-8')
-        signature = form_data['signature'].encode('utf-8')
-        mg_recipient = form_data['recipient']
-        webhook_event = form_data['event']
-        code = form_data['code']
-        bounce_error = form_data['error']
-
-        if verify(mailgun_api_key, token, timestamp, signature):
+        form_data = lead_form_data('hard-bounce', g.webhook_form)
 
-            try:
-                av = db_session.query(AppendedVisitor).filter(
-                    AppendedVisitor.email == mg_recipient
-                ).first()
-
-                if av:
-
-                    try:
-                        lead = db_session.query(Lead).filter(
-                            Lead.appended_visitor_id == av.id
-                        ).one()
-
-                        if lead:
-                            email = av.email
-                            av_id = lead.appended_visitor_id
-
-                            # set the dropped flags in the database
-                            lead.followup_email_delivered = 0
-                            lead.followup_email_status = webhook_event
-                            lead.followup_email_bounced = 1
-                            lead.dropped_code = code
-                            lead.bounce_error = bounce_error
-                            lead.webhook_last_update = datetime.now()
-                            db_session.commit()
-
-                            # return a successful response
-                            return jsonify({"v_id": av_id, "email": email, "event": webhook_event,
-                                            "status": 'success'}), 202
-
-                        # return 404 for lead not found
-                        else:
-                            resp = {"Error": "Lead not found..."}
-                            data = json.dumps(resp)
-                            return Response(data, status=404, mimetype='application/json')
-
-                    # database exception
-                    except exc.SQLAlchemyError as err:
-                        resp = {"Database Error": str(err)}
-                        data = json.dumps(resp)
-                        return Response(data, status=500, mimetype='application/json')
-
-                else:
-                    # return 404: no email for recipient email address
-                    resp = {"Error": "Unable to resolve the recipient email address..."}
-                    data = json.dumps(resp)
-                    return Response(data, status=406, mimetype='application/json')
-
-            # database exception
-            except exc.SQLAlchemyError as err:
-                resp = {"Database Error": str(err)}
-                data = json.dumps(resp)
-                return Response(data, status=500, mimetype='application/json')
-
-        # signature and token verification failed
-        else:
-            resp = {"Signature": form_data['signature'], "Token": form_data['token']}
-            data = json.dumps(resp)
-            return Response(data, status=409, mimetype='application/json')
+        return apply_lead_event('hard-bounce', form_data)
 
     else:
         # method not allowed
-        resp = {"Message": "Method Not Allowed"}
-        data = json.dumps(resp)
-        return Response(data, status=405, mimetype='application/json')
+        return METHOD_NOT_ALLOWED()
 
 
-@app.route('/api/v1.0/webhooks/mailgun/lead/spam-complaint', methods=['POST'])
+@bp.route('/api/v1.0/webhooks/mailgun/lead/spam-complaint', methods=['POST'])
+@mailgun_webhook
 def lead_spam_complaint():
     """
     The lead spam complaint webhook
@@ -469,90 +557,17 @@ def lead_spam_complaint():
     """
     if request.method == 'POST':
 
-        form_data = {
-            "message_id": request.form.get('Message-Id'),
-            "domain": request.form.get('domain'),
-            "event": request.form.get('event'),
-            "timestamp": request.form.get('timestamp'),
-            "recipient": request.form.get('recipient'),
-            "signature": request.form.get('signature'),
-            "token": request.form.get('token')
-        }
-
-        # verify the mailgun token and signature with the api_key
-        token = form_data['token'].encode('utf-8')
-        timestamp = form_data['timestamp'].encode('utf-8')
-        signature = form_data['signature'].encode('utf-8')
-        mg_recipient = form_data['recipient']
-        webhook_event = form_data['event']
-
-        if verify(mailgun_api_key, token, timestamp, signature):
-
-            try:
-                av = db_session.query(AppendedVisitor).filter(
-                    AppendedVisitor.email == mg_recipient
-                ).first()
-
-                if av:
-
-                    try:
-                        lead = db_session.query(Lead).filter(
-                            Lead.appended_visitor_id == av.id
-                        ).one()
-
-                        if lead:
-                            email = av.email
-                            av_id = lead.appended_visitor_id
-
-                            # set the dropped flags in the database
-                            lead.followup_email_delivered = 0
-                            lead.followup_email_status = webhook_event
-                            lead.followup_email_spam = 1
-                            lead.webhook_last_update = datetime.now()
-                            db_session.commit()
-
-                            # return a successful response
-                            return jsonify({"v_id": av_id, "email": email, "event": webhook_event,
-                                            "status": 'success'}), 202
-
-                        # return 404 for lead not found
-                        else:
-                            resp = {"Error": "Lead not found..."}
-                            data = json.dumps(resp)
-                            return Response(data, status=404, mimetype='application/json')
-
-                    # database exception
-                    except exc.SQLAlchemyError as err:
-                        resp = {"Database Error": str(err)}
-                        data = json.dumps(resp)
-                        return Response(data, status=500, mimetype='application/json')
-
-                else:
-                    # return 404: no email for recipient email address
-                    resp = {"Error": "Unable to resolve the recipient email address..."}
-                    data = json.dumps(resp)
-                    return Response(data, status=406, mimetype='application/json')
+        form_data = lead_form_data('spam-complaint', g.webhook_form)
 
-            # database exception
-            except exc.SQLAlchemyError as err:
-                resp = {"Database Error": str(err)}
-                data = json.dumps(resp)
-                return Response(data, status=500, mimetype='application/json')
-
-        # signature and token verification failed
-        else:
-            resp = {"Signature": form_data['signature'], "Token": form_data['token']}
-            data = json.dumps(resp)
-            return Response(data, status=409, mimetype='application/json')
+        return apply_lead_event('spam-complaint', form_data)
 
     else:
         # method not allowed
-        resp = {"Message": "Method Not Allowed"}
-        data = json.dumps(resp)
-        return Response(data, status=405, mimetype='application/json')
+        return METHOD_NOT_ALLOWED()
 
 
-@app.route('/api/v1.0/webhooks/mailgun/lead/unsubscribe', methods=['POST'])
+@bp.route('/api/v1.0/webhooks/mailgun/lead/unsubscribe', methods=['POST'])
+@mailgun_webhook
 def lead_unsubscribe():
     """
     The lead unsubscribe dropped webhook
@@ -560,89 +575,17 @@ def lead_unsubscribe():
     """
     if request.method == 'POST':
 
-        form_data = {
-            "domain": request.form.get('domain'),
-            "event": request.form.get('event'),
-            "timestamp": request.form.get('timestamp'),
-            "recipient": request.form.get('recipient'),
-            "signature": request.form.get('signature'),
-            "token": request.form.get('token')
-        }
-
-        # verify the mailgun token and signature with the api_key
-        token = form_data['token'].encode('utf-8')
-        timestamp = form_data['timestamp'].encode('utf-8')
-        signature = form_data['signature'].encode('utf-8')
-        mg_recipient = form_data['recipient']
-        webhook_event = form_data['event']
-
-        if verify(mailgun_api_key, token, timestamp, signature):
-
-            try:
-                av = db_session.query(AppendedVisitor).filter(
-                    AppendedVisitor.email == mg_recipient
-                ).first()
-
-                if av:
-
-                    try:
-                        lead = db_session.query(Lead).filter(
-                            Lead.appended_visitor_id == av.id
-                        ).one()
-
-                        if lead:
-                            email = av.email
-                            av_id = lead.appended_visitor_id
-
-                            # set the dropped flags in the database
-                            lead.followup_email_delivered = 0
-                            lead.followup_email_status = webhook_event
-                            lead.followup_email_unsub = 1
-                            lead.webhook_last_update = datetime.now()
-                            db_session.commit()
-
-                            # return a successful response
-                            return jsonify({"v_id": av_id, "email": email, "event": webhook_event,
-                                            "status": 'success'}), 202
-
-                        # return 404 for lead not found
-                        else:
-                            resp = {"Error": "Lead not found..."}
-                            data = json.dumps(resp)
-                            return Response(data, status=404, mimetype='application/json')
-
-                    # database exception
-                    except exc.SQLAlchemyError as err:
-                        resp = {"Database Error": str(err)}
-                        data = json.dumps(resp)
-                        return Response(data, status=500, mimetype='application/json')
-
-                else:
-                    # return 404: no email for recipient email address
-                    resp = {"Error": "Unable to resolve the recipient email address..."}
-                    data = json.dumps(resp)
-                    return Response(data, status=406, mimetype='application/json')
+        form_data = lead_form_data('unsubscribe', g.webhook_form)
 
-            # database exception
-            except exc.SQLAlchemyError as err:
-                resp = {"Database Error": str(err)}
-                data = json.dumps(resp)
-                return Response(data, status=500, mimetype='application/json')
-
-        # signature and token verification failed
-        else:
-            resp = {"Signature": form_data['signature'], "Token": form_data['token']}
-            data = json.dumps(resp)
-            return Response(data, status=409, mimetype='application/json')
+        return apply_lead_event('unsubscribe', form_data)
 
     else:
         # method not allowed
-        resp = {"Message": "Method Not Allowed"}
-        data = json.dumps(resp)
-        return Response(data, status=405, mimetype='application/json')
+        return METHOD_NOT_ALLOWED()
 
 
-@app.route('/api/v1.0/webhooks/mailgun/lead/click', methods=['POST'])
+@bp.route('/api/v1.0/webhooks/mailgun/lead/click', methods=['POST'])
+@mailgun_webhook
 def lead_clicks():
     """
     The lead email clicks webhook
@@ -650,99 +593,17 @@ def lead_clicks():
     """
     if request.method == 'POST':
 
-        form_data = {
-            "domain": request.form.get('domain'),
-            "event": request.form.get('event'),
-            "timestamp": request.form.get('timestamp'),
-            "recipient": request.form.get('recipient'),
-            "signature": request.form.get('signature'),
-            "token": request.form.get('token'),
-            "ip": request.form.get('ip'),
-            "device_type": request.form.get('device-type'),
-            "client_type": request.form.get('client-type')
-        }
-
-        # verify the mailgun token and signature with the api_key
-        token = form_data['token'].encode('utf-8')
-        timestamp = form_data['timestamp'].encode('utf-8')
-        signature = form_data['signature'].encode('utf-8')
-        mg_recipient = form_data['recipient']
-        webhook_event = form_data['event']
-        ip_addr = form_data['ip']
-        device_type = form_data['device_type']
-        client_type = form_data['client_type']
-
-        if verify(mailgun_api_key, token, timestamp, signature):
-
-            try:
-                av = db_session.query(AppendedVisitor).filter(
-                    AppendedVisitor.email == mg_recipient
-                ).first()
-
-                if av:
-
-                    try:
-                        lead = db_session.query(Lead).filter(
-                            Lead.appended_visitor_id == av.id
-                        ).one()
-
-                        if lead:
-                            email = av.email
-                            av_id = lead.appended_visitor_id
-                            total_clicks = lead.followup_email_clicks + 1
-
-                            # set the dropped flags in the database
-                            lead.followup_email_delivered = 0
-                            lead.followup_email_status = webhook_event
-                            lead.followup_email_clicks = total_clicks
-                            lead.followup_email_click_ip = ip_addr
-                            lead.followup_email_click_device = device_type
-                            lead.followup_email_click_campaign = client_type
-                            lead.webhook_last_update = datetime.now()
-                            db_session.commit()
-
-                            # return a successful response
-                            return jsonify({"v_id": av_id, "email": email, "event": webhook_event,
-                                            "status": 'success'}), 202
-
-                        # return 404 for lead not found
-                        else:
-                            resp = {"Error": "Lead not found..."}
-                            data = json.dumps(resp)
-                            return Response(data, status=404, mimetype='application/json')
-
-                    # database exception
-                    except exc.SQLAlchemyError as err:
-                        resp = {"Database Error": str(err)}
-                        data = json.dumps(resp)
-                        return Response(data, status=500, mimetype='application/json')
-
-                else:
-                    # return 404: no email for recipient email address
-                    resp = {"Error": "Unable to resolve the recipient email address..."}
-                    data = json.dumps(resp)
-                    return Response(data, status=406, mimetype='application/json')
-
-            # database exception
-            except exc.SQLAlchemyError as err:
-                resp = {"Database Error": str(err)}
-                data = json.dumps(resp)
-                return Response(data, status=500, mimetype='application/json')
+        form_data = lead_form_data('click', g.webhook_form)
 
-        # signature and token verification failed
-        else:
-            resp = {"Signature": form_data['signature'], "Token": form_data['token']}
-            data = json.dumps(resp)
-            return Response(data, status=409, mimetype='application/json')
+        return apply_lead_event('click', form_data)
 
     else:
         # method not allowed
-        resp = {"Message": "Method Not Allowed"}
-        data = json.dumps(resp)
-        return Response(data, status=405, mimetype='application/json')
+        return METHOD_NOT_ALLOWED()
 
 
-@app.route('/api/v1.0/webhooks/mailgun/lead/open', methods=['POST'])
+@bp.route('/api/v1.0/webhooks/mailgun/lead/open', methods=['POST'])
+@mailgun_webhook
 def lead_opens():
     """
     The lead email opens webhook
@@ -750,99 +611,16 @@ def lead_opens():
     """
     if request.method == 'POST':
 
-        form_data = {
-            "domain": request.form.get('domain'),
-            "event": request.form.get('event'),
-            "timestamp": request.form.get('timestamp'),
-            "recipient": request.form.get('recipient'),
-            "signature": request.form.get('signature'),
-            "token": request.form.get('token'),
-            "ip": request.form.get('ip'),
-            "device_type": request.form.get('device-type'),
-            "client_type": request.form.get('client-type')
-        }
-
-        # verify the mailgun token and signature with the api_key
-        token = form_data['token'].encode('utf-8')
-        timestamp = form_data['timestamp'].encode('utf-8')
-        signature = form_data['signature'].encode('utf-8')
-        mg_recipient = form_data['recipient']
-        webhook_event = form_data['event']
-        ip_addr = form_data['ip']
-        device_type = form_data['device_type']
-        client_type = form_data['client_type']
-
-        if verify(mailgun_api_key, token, timestamp, signature):
-
-            try:
-                av = db_session.query(AppendedVisitor).filter(
-                    AppendedVisitor.email == mg_recipient
-                ).first()
-
-                if av:
-
-                    try:
-                        lead = db_session.query(Lead).filter(
-                            Lead.appended_visitor_id == av.id
-                        ).one()
-
-                        if lead:
-                            email = av.email
-                            av_id = lead.appended_visitor_id
-                            total_opens = lead.followup_email_opens + 1
-
-                            # set the dropped flags in the database
-                            lead.followup_email_delivered = 0
-                            lead.followup_email_status = webhook_event
-                            lead.followup_email_opens = total_opens
-                            lead.followup_email_open_ip = ip_addr
-                            lead.followup_email_open_campaign = client_type
-                            lead.followup_email_open_device = device_type
-                            lead.webhook_last_update = datetime.now()
-                            db_session.commit()
-
-                            # return a successful response
-                            return jsonify({"v_id": av_id, "email": email, "event": webhook_event,
-                                            "status": 'success'}), 202
-
-                        # return 404 for lead not found
-                        else:
-                            resp = {"Error": "Lead not found..."}
-                            data = json.dumps(resp)
-                            return Response(data, status=404, mimetype='application/json')
-
-                    # database exception
-                    except exc.SQLAlchemyError as err:
-                        resp = {"Database Error": str(err)}
-                        data = json.dumps(resp)
-                        return Response(data, status=500, mimetype='application/json')
-
-                else:
-                    # return 404: no email for recipient email address
-                    resp = {"Error": "Unable to resolve the recipient email address..."}
-                    data = json.dumps(resp)
-                    return Response(data, status=406, mimetype='application/json')
-
-            # database exception
-            except exc.SQLAlchemyError as err:
-                resp = {"Database Error": str(err)}
-                data = json.dumps(resp)
-                return Response(data, status=500, mimetype='application/json')
+        form_data = lead_form_data('open', g.webhook_form)
 
-        # signature and token verification failed
-        else:
-            resp = {"Signature": form_data['signature'], "Token": form_data['token']}
-            data = json.dumps(resp)
-            return Response(data, status=409, mimetype='application/json')
+        return apply_lead_event('open', form_data)
 
     else:
         # method not allowed
-        resp = {"Message": "Method Not Allowed"}
-        data = json.dumps(resp)
-        return Response(data, status=405, mimetype='application/json')
+        return METHOD_NOT_ALLOWED()
 
 
-@app.route('/api/v1.0/auth/login', methods=['GET'])
+@bp.route('/api/v1.0/auth/login', methods=['GET'])
 def login():
     """
     Template for Login page
@@ -857,37 +635,22 @@ def login():
 def send_alerts():
     """
     Send alerts when the EARL Dashboard does not update correctly.
-    :return: twilio sid
+    :return: twilio sids
     """
-    admins = config.ADMINS
-    client = Client(config.TWILIO_ACCOUNT_SID, config.TWILIO_AUTH_TOKEN)
-    messages = []
-
-    for admin in admins:
-
-        # create and send the sms message to the admins
-        msg = client.messages.create(
-            to=admin,
-            from_="+14152342025",
-            body="Warning! EARL Dashboard shows duplicate entries across 2 cycles. "
-                 "Check EARL automation ASAP!")
-
-        messages.append(msg.sid)
-
-    # return the message sid
-    return messages
-
-
-def compare_(a, b):
-    return a == b
+    # the admins are texted concurrently on the shared twilio session
+    return alert_dispatcher.send_sms(
+        config.ADMINS,
+        "Warning! EARL Dashboard shows duplicate entries across 2 cycles. "
+        "Check EARL automation ASAP!"
+    )
 
 
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def page_not_found(err):
     return render_template('error-404.html'), 404
 
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_server_error(err):
     return render_template('error-500.html'), 500
 
@@ -904,20 +667,116 @@ def flash_errors(form):
 def send_email(to, subject, msg_body, **kwargs):
     """
     Send Mail function
-    :param to:
+    :param to: address or list of addresses
     :param subject:
-    :param template:
+    :param msg_body: html body
     :param kwargs:
-    :return: celery async task id
+    :return: list of addresses sent to
     """
-    msg = Message(
-        subject,
-        sender=app.config['MAIL_DEFAULT_SENDER'],
-        recipients=[to, ]
-    )
-    msg.body = "EARL API v1.0"
-    msg.html = msg_body
-    mail.send(msg)
+    recipients = list(to) if isinstance(to, (list, tuple)) else [to]
+    return alert_dispatcher.send_email(recipients, subject, msg_body)
+
+
+def valid_recipient(recipient):
+    # a signed payload can still omit the recipient or send a non-string
+    return isinstance(recipient, string_types) and bool(recipient.strip())
+
+
+def valid_event_shape(item):
+    # event_from_json needs signature and event-data objects
+    return isinstance(item.get('signature'), dict) and isinstance(item.get('event-data'), dict)
+
+
+def apply_lead_event(kind, form_data):
+    """
+    Resolve the webhook recipient to its lead and apply the event, or queue
+    it for the celery workers in the async ingest mode.
+    :param kind: one of leads.LEAD_EVENTS
+    :param form_data: the webhook form data
+    :return: json
+    """
+    g.webhook_event = kind
+
+    # nothing to resolve, answer before the caches and the dedupe window see it
+    if not valid_recipient(form_data.get('recipient')):
+        return UNRESOLVED_RECIPIENT()
+
+    # acknowledge Mailgun redeliveries without touching the database
+    if not deduplicator.claim(form_data):
+        return json_response({"email": form_data['recipient'], "event": form_data['event'],
+                              "status": 'duplicate'}, 200)
+
+    if ingest_mode == ingest.ASYNC and not unknown_recipients.contains(
+            form_data['recipient'], visitor_generation(db_session)):
+        if async_queue.has_room(async_max_queue):
+            try:
+                apply_lead_event_task.delay(kind, compact_event(form_data), deduplicator.keys(form_data))
+                async_queue.add()
+
+                # return an accepted response, the lead is updated by a worker
+                return json_response({"email": form_data['recipient'], "event": form_data['event'],
+                                      "status": 'queued'}, 202)
+
+            except Exception as err:
+                log.warning('unable to queue webhook event, applying it now: %s', err)
+
+    if ingest_mode == ingest.LOG:
+        try:
+            event_log.append({"kind": kind, "data": form_data})
+
+            # return an accepted response once the event is durable
+            return json_response({"email": form_data['recipient'], "event": form_data['event'],
+                                  "status": 'logged'}, 202)
+
+        except (IOError, OSError) as err:
+            log.error('unable to append to the webhook log, applying it now: %s', err)
+
+    try:
+        row = lookup_recipient(db_session, form_data['recipient'])
+
+        if row:
+
+            if row.lead_id:
+                if ingest_mode == ingest.BATCH:
+                    batcher.add(row.lead_id, kind, form_data)
+                elif counter_accumulator is not None and kind in COUNTERS:
+                    counter_accumulator.add(row.lead_id, kind, form_data)
+                else:
+                    update_lead(db_session, row.lead_id, kind, form_data)
+                    db_session.commit()
+                    lead_event_committed(row.lead_id, kind, event_time(form_data))
+
+                # return a successful response
+                return json_response({"v_id": row.appended_visitor_id, "email": row.email, "event": form_data['event'],
+                                      "status": 'success'}, 202)
+
+            # return 404 for lead not found, a redelivery after the lead is created must apply
+            else:
+                deduplicator.release(form_data)
+                return LEAD_NOT_FOUND()
+
+        else:
+            # return 406: no appended visitor for recipient email address
+            deduplicator.release(form_data)
+            return UNRESOLVED_RECIPIENT()
+
+    # database exception
+    except exc.SQLAlchemyError as err:
+        db_session.rollback()
+        deduplicator.release(form_data)
+        return json_response({"Database Error": str(err)}, 500)
+
+
+def parse_date(value):
+    # accepts YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS
+    if not value:
+        return None
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError(value)
 
 
 def get_date():
@@ -926,15 +785,45 @@ def get_date():
     return '{}'.format(today)
 
 
-def verify(api_key, token, timestamp, signature):
-    hmac_digest = hmac.new(key=mailgun_api_key,
-                           msg='{}{}'.format(timestamp, token).encode('utf-8'),
-                           digestmod=hashlib.sha256).hexdigest()
-    return hmac.compare_digest(signature, hmac_digest)
+def create_app():
+    """
+    Build the Flask app.  The alert transports are loaded on first use, call
+    preload() in a pre-fork master to load them up front instead.
+    :return: app
+    """
+    from flask_sslify import SSLify
+
+    app = Flask(__name__)
+    SSLify(app)
+    app.config['SECRET_KEY'] = config.SECRET_KEY
+
+    # disable strict slashes
+    app.url_map.strict_slashes = False
+
+    # compact json from any remaining jsonify calls, the api routes use fastjson
+    app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+
+    app.register_blueprint(bp)
+    app.teardown_appcontext(shutdown_session)
+
+    # the templates, shared with app.py, link to the unprefixed endpoint names
+    app.add_url_rule('/api/v1.0/index', 'index', index)
+    app.add_url_rule('/api/v1.0/auth/login', 'login', login)
+    return app
+
+
+def preload():
+    """
+    Import the lazily loaded dependencies before the workers fork, so their
+    memory is shared copy-on-write
+    :return: None
+    """
+    alert_dispatcher.load()
 
 
 if __name__ == '__main__':
     port = 5880
+    app = create_app()
 
     # start the application
     app.run(
@@ -0,0 +1,267 @@
+from collections import OrderedDict
+from sqlalchemy import bindparam
+from threading import Condition, Thread
+from leads import (COUNTERS, event_time, increment, insert_lead_events, lead_event_committed, lead_event_row,
+                   lead_event_values)
+import leads
+from models import Lead
+import atexit
+import logging
+import os
+import time
+
+
+log = logging.getLogger(__name__)
+
+leads_table = Lead.__table__
+
+
+class PendingLead(object):
+    """
+    The collapsed state of every buffered event for one lead.
+    """
+    __slots__ = ('lead_id', 'values', 'counts', 'events', 'rows', 'applied')
+
+    def __init__(self, lead_id):
+        self.lead_id = lead_id
+        self.values = {}
+        self.counts = dict((col, 0) for col in COUNTERS.values())
+        self.events = 0
+        self.rows = []
+        # (kind, event time) for the deltas counted after the commit
+        self.applied = []
+
+    def apply(self, kind, data):
+        self.values.update(lead_event_values(kind, data))
+        self.events += 1
+        self.applied.append((kind, event_time(data)))
+
+        if leads.record_events:
+            self.rows.append(lead_event_row(self.lead_id, kind, data))
+
+        if kind in COUNTERS:
+            self.counts[COUNTERS[kind]] += 1
+
+    def merge_older(self, older):
+        # a failed flush is put back underneath any newer events
+        values = dict(older.values)
+        values.update(self.values)
+        self.values = values
+        self.events += older.events
+        self.rows = older.rows + self.rows
+        self.applied = older.applied + self.applied
+        for col, n in older.counts.items():
+            self.counts[col] += n
+
+
+class PendingCounts(PendingLead):
+    """
+    Counter deltas for one lead, with the ip/device/client of its latest open
+    or click.  The status columns every event writes are left out, a late
+    flush would otherwise put an older open over a newer unsubscribe.
+    """
+    __slots__ = ()
+
+    STATUS_COLUMNS = ('followup_email_status', 'followup_email_delivered', 'webhook_last_update')
+
+    def apply(self, kind, data):
+        super(PendingCounts, self).apply(kind, data)
+        for col in self.STATUS_COLUMNS:
+            self.values.pop(col, None)
+
+
+def build_update(columns):
+    """
+    One parameterised UPDATE for a set of lead columns, used with executemany
+    :param columns: sorted tuple of column names
+    :return: update statement
+    """
+    values = dict((col, bindparam('b_' + col)) for col in columns)
+
+    for col in COUNTERS.values():
+        values[col] = increment(leads_table.c[col], bindparam('b_n_' + col))
+
+    return leads_table.update().where(
+        leads_table.c.id == bindparam('b_lead_id')
+    ).values(**values)
+
+
+def flush_pending(session, pending):
+    """
+    Write collapsed lead states in one transaction, one executemany per
+    distinct column set, i.e. per event type.
+    :param session: db session
+    :param pending: dict of lead_id -> PendingLead
+    :return: number of statements executed
+    """
+    groups = {}
+    rows = []
+
+    for lead_id, state in pending.items():
+        rows.extend(state.rows)
+        columns = tuple(sorted(state.values))
+        params = dict(('b_' + col, value) for col, value in state.values.items())
+        params['b_lead_id'] = lead_id
+        for col, n in state.counts.items():
+            params['b_n_' + col] = n
+        groups.setdefault(columns, []).append(params)
+
+    for columns, params in groups.items():
+        session.execute(build_update(columns), params)
+
+    insert_lead_events(session, rows)
+    session.commit()
+
+    for lead_id, state in pending.items():
+        for kind, ts in state.applied:
+            lead_event_committed(lead_id, kind, ts)
+
+    return len(groups)
+
+
+class LeadEventBatcher(object):
+    """
+    Buffers webhook events for flush_interval seconds or max_batch events and
+    collapses them per lead before writing them with flush_pending().
+    """
+
+    pending_class = PendingLead
+
+    def __init__(self, session, flush_interval=0.05, max_batch=500):
+        self.session = session
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = OrderedDict()
+        self._buffered = 0
+        self._cond = Condition()
+        self._thread = None
+        self._pid = None
+        self.flushes = 0
+        self.flushed_events = 0
+        self.flushed_leads = 0
+        self.statements = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def _ensure_thread(self):
+        # threads don't survive a fork, start one per worker process
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = Thread(target=self._run, name='lead-event-batcher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def add(self, lead_id, kind, data):
+        """
+        Buffer an event for a resolved lead
+        :param lead_id:
+        :param kind: one of leads.LEAD_EVENTS
+        :param data: the webhook form data
+        :return: None
+        """
+        with self._cond:
+            self._ensure_thread()
+
+            state = self._pending.get(lead_id)
+            if state is None:
+                state = self._pending[lead_id] = self.pending_class(lead_id)
+            state.apply(kind, data)
+
+            self._buffered += 1
+            if self._buffered >= self.max_batch:
+                self._cond.notify()
+
+    def _take(self):
+        with self._cond:
+            pending, self._pending = self._pending, OrderedDict()
+            self._buffered = 0
+            return pending
+
+    def _restore(self, pending):
+        with self._cond:
+            for lead_id, older in pending.items():
+                state = self._pending.get(lead_id)
+                if state is None:
+                    self._pending[lead_id] = older
+                else:
+                    state.merge_older(older)
+                self._buffered += older.events
+
+    def flush(self):
+        """
+        Write everything buffered so far
+        :return: number of events flushed
+        """
+        pending = self._take()
+        if not pending:
+            return 0
+
+        started = time.time()
+        try:
+            statements = flush_pending(self.session, pending)
+        except Exception as err:
+            self.session.rollback()
+            self.errors += 1
+            log.error('lead event batch flush failed, %s leads requeued: %s', len(pending), err)
+            self._restore(pending)
+            return 0
+        finally:
+            self.session.remove()
+
+        events = sum(state.events for state in pending.values())
+        elapsed = (time.time() - started) * 1000.0
+        self.flushes += 1
+        self.flushed_events += events
+        self.flushed_leads += len(pending)
+        self.statements += statements
+        self.last_flush_ms = elapsed
+        self.max_flush_ms = max(self.max_flush_ms, elapsed)
+        return events
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._buffered < self.max_batch:
+                    self._cond.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as err:
+                log.exception('lead event batcher: %s', err)
+
+    def stats(self):
+        return {
+            "pending_events": self._buffered,
+            "pending_leads": len(self._pending),
+            "flush_interval_ms": self.flush_interval * 1000.0,
+            "max_batch": self.max_batch,
+            "flushes": self.flushes,
+            "flushed_events": self.flushed_events,
+            "flushed_leads": self.flushed_leads,
+            "statements": self.statements,
+            "errors": self.errors,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+            "max_flush_ms": round(self.max_flush_ms, 3)
+        }
+
+    def register_atexit(self):
+        atexit.register(self.flush)
+        return self
+
+
+class CounterAccumulator(LeadEventBatcher):
+    """
+    Aggregates open and click events per lead, so a burst of opens on one
+    lead becomes a single UPDATE adding the total to the counter.  Only the
+    counters and the open/click client columns are written, see PendingCounts.
+    """
+
+    pending_class = PendingCounts
+
+    def __init__(self, session, flush_interval=1.0, max_batch=5000):
+        super(CounterAccumulator, self).__init__(session, flush_interval, max_batch)
+
+    def add(self, lead_id, kind, data):
+        if kind not in COUNTERS:
+            raise ValueError('{} is not a counter event'.format(kind))
+        super(CounterAccumulator, self).add(lead_id, kind, data)
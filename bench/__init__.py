@@ -0,0 +1,22 @@
+"""
+Webhook load tests for the Mailgun lead routes.
+
+    python -m bench seed --db-url sqlite:///bench.sqlite --visitors 10000
+    python -m bench run --requests 5000 --concurrency 8 --save-baseline
+    python -m bench run --url http://127.0.0.1:5880 --db-url mysql://... --compare
+    python -m bench run --url http://127.0.0.1:5881 --aio-client --concurrency 500
+
+run drives api.create_app() in-process unless --url is given, and reads the seeded
+recipients from --db-url or the app's own database.  Baselines are kept in
+bench/baselines/<name>.json; --compare fails when p95 or throughput regress
+past the tolerance, or straight away when there is no baseline by that name.
+The committed inprocess-sqlite baseline was recorded in-process on sqlite
+after a 10000 visitor seed, with
+
+    python -m bench run --requests 5000 --concurrency 1 \\
+        --name inprocess-sqlite --save-baseline
+
+latencies are machine specific, record your own before comparing.  To
+compare the WSGI app with aioserver.py, run the same --aio-client load
+against each server.
+"""
@@ -0,0 +1,150 @@
+from bench import drivers, payloads, seed
+import argparse
+import config
+import json
+import os
+import platform
+import sys
+import time
+
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+
+def baseline_path(name):
+    return os.path.join(BASELINE_DIR, '{}.json'.format(name))
+
+
+def baseline_names():
+    if not os.path.isdir(BASELINE_DIR):
+        return []
+    return sorted(name[:-len('.json')] for name in os.listdir(BASELINE_DIR) if name.endswith('.json'))
+
+
+def load_baseline(name):
+    """
+    :param name: baseline name
+    :return: the stored result, exits with the saved names when there is none
+    """
+    path = baseline_path(name)
+    if not os.path.exists(path):
+        sys.exit('--compare: no baseline named {!r} at {}, saved baselines: {}.  Record one on this '
+                 'machine with --save-baseline, or pick a saved one with --name.'.format(
+                     name, path, ', '.join(baseline_names()) or 'none'))
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(name, result):
+    if not os.path.isdir(BASELINE_DIR):
+        os.makedirs(BASELINE_DIR)
+    with open(baseline_path(name), 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+
+
+def compare(baseline, result, tolerance):
+    """
+    :param baseline: stored result
+    :param result: this run
+    :param tolerance: allowed fractional regression, e.g. 0.2
+    :return: list of regression messages
+    """
+    regressions = []
+    for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+        if baseline.get(key) and result[key] > baseline[key] * (1 + tolerance):
+            regressions.append('{} {} -> {}'.format(key, baseline[key], result[key]))
+
+    if baseline.get('throughput') and result['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append('throughput {} -> {}'.format(baseline['throughput'], result['throughput']))
+
+    for kind, route in result['routes'].items():
+        before = baseline.get('routes', {}).get(kind, {}).get('p95_ms')
+        if before and route['p95_ms'] > before * (1 + tolerance):
+            regressions.append('{} p95_ms {} -> {}'.format(kind, before, route['p95_ms']))
+
+    return regressions
+
+
+def cmd_seed(args):
+    engine = seed.engine_for(args.db_url)
+    started = time.time()
+    counts = seed.seed(engine, visitors=args.visitors, lead_ratio=args.lead_ratio, campaigns=args.campaigns)
+    counts['seconds'] = round(time.time() - started, 3)
+    print(json.dumps(counts))
+
+
+def cmd_run(args):
+    # fail before the run, not after it
+    baseline = load_baseline(args.name) if args.compare else None
+
+    recipients = seed.recipients(seed.engine_for(args.db_url), limit=args.recipients)
+    if not recipients:
+        sys.exit('no seeded recipients, run python -m bench seed first')
+
+    items = payloads.generate(args.requests + args.warmup, recipients,
+                              mix=payloads.parse_mix(args.mix), unknown=args.unknown, seed=args.seed)
+    if args.aio_client:
+        if not args.url:
+            sys.exit('--aio-client needs --url')
+        from bench import aioclient
+        result = aioclient.run(args.url, items, config.MAILGUN_API_KEY, concurrency=args.concurrency,
+                               warmup=args.warmup)
+        result['driver'] = 'aiohttp'
+    else:
+        driver = drivers.HttpDriver(args.url) if args.url else drivers.InProcessDriver()
+        result = drivers.run(driver, items, config.MAILGUN_API_KEY, concurrency=args.concurrency,
+                             warmup=args.warmup)
+        result['driver'] = 'http' if args.url else 'inprocess'
+    result['python'] = platform.python_version()
+    result['recorded'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+    if args.save_baseline:
+        save_baseline(args.name, result)
+        print('baseline saved to {}'.format(baseline_path(args.name)))
+
+    if baseline is not None:
+        regressions = compare(baseline, result, args.tolerance)
+        if regressions:
+            sys.exit('regressed past {:.0%}: {}'.format(args.tolerance, '; '.join(regressions)))
+        print('within {:.0%} of the baseline'.format(args.tolerance))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Load test the Mailgun lead webhooks.')
+    sub = parser.add_subparsers(dest='command')
+
+    s = sub.add_parser('seed', help='insert visitors, appended visitors and leads')
+    s.add_argument('--db-url', help="database url, defaults to the app's database")
+    s.add_argument('--visitors', type=int, default=10000)
+    s.add_argument('--lead-ratio', type=float, default=0.9, help='appended visitors with a lead')
+    s.add_argument('--campaigns', type=int, default=10)
+
+    r = sub.add_parser('run', help='send signed webhooks and report latency')
+    r.add_argument('--url', help='base url of a running server, in-process when omitted')
+    r.add_argument('--db-url', help="where the recipients were seeded, defaults to the app's database")
+    r.add_argument('--requests', type=int, default=2000)
+    r.add_argument('--concurrency', type=int, default=8)
+    r.add_argument('--aio-client', action='store_true',
+                   help='send from one asyncio client, for hundreds of requests in flight (python 3)')
+    r.add_argument('--warmup', type=int, default=100)
+    r.add_argument('--mix', help='route weights, e.g. open=4,click=2,delivered=1 (default all evenly)')
+    r.add_argument('--unknown', type=float, default=0.05, help='fraction of unresolvable recipients')
+    r.add_argument('--recipients', type=int, help='use at most this many seeded recipients')
+    r.add_argument('--seed', type=int, default=1, help='random seed for the payload mix')
+    r.add_argument('--name', default='default', help='baseline name')
+    r.add_argument('--save-baseline', action='store_true')
+    r.add_argument('--compare', action='store_true', help='exit non-zero on a regression')
+    r.add_argument('--tolerance', type=float, default=0.2)
+
+    args = parser.parse_args()
+    if args.command == 'seed':
+        cmd_seed(args)
+    elif args.command == 'run':
+        cmd_run(args)
+    else:
+        parser.error('choose seed or run')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+aiohttp load generator, keeps up to `concurrency` webhooks in flight from a
+single thread.  Python 3 only.
+"""
+from bench.drivers import report
+from bench.payloads import signed
+import aiohttp
+import asyncio
+import time
+
+
+async def _run(base_url, payloads, api_key, concurrency, warmup, samples):
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+
+        async def send(kind, route, form):
+            form = signed(form, api_key)
+            started = time.time()
+            try:
+                async with session.post(base_url + route, data=form) as resp:
+                    await resp.read()
+                    status = resp.status
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                status = 'error'
+            return kind, status, (time.time() - started) * 1000.0
+
+        for item in payloads[:warmup]:
+            await send(*item)
+
+        slots = asyncio.Semaphore(concurrency)
+
+        async def bounded(item):
+            async with slots:
+                samples.append(await send(*item))
+
+        started = time.time()
+        await asyncio.gather(*[bounded(item) for item in payloads[warmup:]])
+        return time.time() - started
+
+
+def run(base_url, payloads, api_key, concurrency=100, warmup=0):
+    """
+    :param base_url: server base url
+    :param payloads: list of (kind, route, unsigned form)
+    :param api_key: Mailgun API key
+    :param concurrency: requests in flight
+    :param warmup: leading payloads sent before timing starts
+    :return: dict report, as drivers.run
+    """
+    samples = []
+    loop = asyncio.new_event_loop()
+    try:
+        elapsed = loop.run_until_complete(
+            _run(base_url.rstrip('/'), payloads, api_key, concurrency, warmup, samples)
+        )
+    finally:
+        loop.close()
+    return report(samples, elapsed, concurrency)
@@ -0,0 +1,140 @@
+from threading import Thread
+from bench.payloads import signed
+import time
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+
+class InProcessDriver(object):
+    """
+    Posts through the Flask test client, no network or server in the way.
+    """
+
+    def __init__(self):
+        import api
+        self.app = api.create_app()
+
+    def client(self):
+        test_client = self.app.test_client()
+
+        def post(route, form):
+            return test_client.post(route, data=form).status_code
+        return post
+
+
+class HttpDriver(object):
+    """
+    Posts to a running server, one keep-alive session per thread.
+    """
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def client(self):
+        import requests
+        session = requests.Session()
+
+        def post(route, form):
+            return session.post(self.base_url + route, data=form, timeout=self.timeout).status_code
+        return post
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of sorted values
+    :param values: sorted list
+    :param pct: 0-100
+    :return: value
+    """
+    if not values:
+        return 0.0
+    rank = int(round(pct / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def run(driver, payloads, api_key, concurrency=8, warmup=0):
+    """
+    Send the payloads from `concurrency` threads and time each request.
+    Each payload is signed just before it is sent, outside the timing.
+    :param driver: InProcessDriver or HttpDriver
+    :param payloads: list of (kind, route, unsigned form)
+    :param api_key: Mailgun API key
+    :param concurrency: client threads
+    :param warmup: leading payloads sent before timing starts
+    :return: dict report
+    """
+    post = driver.client()
+    for kind, route, form in payloads[:warmup]:
+        post(route, signed(form, api_key))
+
+    work = Queue()
+    for item in payloads[warmup:]:
+        work.put(item)
+
+    samples = []
+
+    def client():
+        send = driver.client()
+        local = []
+        while True:
+            try:
+                kind, route, form = work.get_nowait()
+            except Empty:
+                break
+            form = signed(form, api_key)
+            started = time.time()
+            try:
+                status = send(route, form)
+            except Exception:
+                status = 'error'
+            local.append((kind, status, (time.time() - started) * 1000.0))
+        samples.extend(local)
+
+    threads = [Thread(target=client) for _ in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    return report(samples, elapsed, concurrency)
+
+
+def _summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "max_ms": round(latencies[-1], 3) if latencies else 0.0
+    }
+
+
+def report(samples, elapsed, concurrency):
+    """
+    :param samples: list of (kind, status, ms)
+    :param elapsed: wall clock seconds
+    :param concurrency: client threads
+    :return: dict with overall and per route latencies and status counts
+    """
+    statuses = {}
+    by_kind = {}
+    for kind, status, ms in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        by_kind.setdefault(kind, []).append(ms)
+
+    result = _summary([s[2] for s in samples])
+    result.update({
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        "statuses": statuses,
+        "routes": dict((kind, _summary(ms)) for kind, ms in by_kind.items())
+    })
+    return result
@@ -0,0 +1,128 @@
+import hashlib
+import hmac
+import os
+import random
+import time
+
+
+# webhook kind -> (route, Mailgun legacy event name)
+ROUTES = {
+    'delivered': ('/api/v1.0/webhooks/mailgun/lead/delivered', 'delivered'),
+    'dropped': ('/api/v1.0/webhooks/mailgun/lead/dropped', 'dropped'),
+    'hard-bounce': ('/api/v1.0/webhooks/mailgun/lead/hard-bounce', 'bounced'),
+    'spam-complaint': ('/api/v1.0/webhooks/mailgun/lead/spam-complaint', 'complained'),
+    'unsubscribe': ('/api/v1.0/webhooks/mailgun/lead/unsubscribe', 'unsubscribed'),
+    'click': ('/api/v1.0/webhooks/mailgun/lead/click', 'clicked'),
+    'open': ('/api/v1.0/webhooks/mailgun/lead/open', 'opened')
+}
+
+# extra form fields each route reads
+EXTRA = {
+    'dropped': {"reason": 'hardfail', "code": '605', "description": 'Not delivering to previously bounced address'},
+    'hard-bounce': {"code": '550', "error": '5.1.1 The email account does not exist', "X-Mailgun-Sid": 'bench'},
+    'click': {"ip": '50.56.129.169', "device-type": 'desktop', "client-type": 'browser'},
+    'open': {"ip": '50.56.129.169', "device-type": 'mobile', "client-type": 'mobile browser'}
+}
+
+
+def _bytes(value):
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def sign(api_key, timestamp, token):
+    """
+    Mailgun webhook signature, hex HMAC-SHA256 of timestamp + token
+    :return: str
+    """
+    return hmac.new(_bytes(api_key), _bytes(timestamp) + _bytes(token), hashlib.sha256).hexdigest()
+
+
+def payload(kind, recipient):
+    """
+    The unsigned form payload for one webhook, see signed()
+    :param kind: a key of ROUTES
+    :param recipient: email address
+    :return: (route, form dict)
+    """
+    route, event = ROUTES[kind]
+    form = {
+        "domain": 'bench.example.com',
+        "event": event,
+        "recipient": recipient
+    }
+    form.update(EXTRA.get(kind, {}))
+    return route, form
+
+
+def signed(form, api_key, timestamp=None):
+    """
+    A copy of the form signed with a fresh timestamp, token and Message-Id.
+    The drivers sign each payload just before sending it, payloads signed up
+    front go stale past the app's signature max age on long runs.
+    :param form: form dict from payload()
+    :param api_key: the Mailgun API key the app verifies with
+    :param timestamp: unix time, defaults to now
+    :return: form dict
+    """
+    timestamp = str(int(timestamp or time.time()))
+    token = hashlib.sha1(os.urandom(16)).hexdigest()
+
+    form = dict(form)
+    form.update({
+        "Message-Id": '<{}@bench.example.com>'.format(token[:20]),
+        "timestamp": timestamp,
+        "token": token,
+        "signature": sign(api_key, timestamp, token)
+    })
+    return form
+
+
+def parse_mix(value):
+    """
+    :param value: e.g. 'open=4,click=2,delivered=1', empty for all routes evenly
+    :return: dict of kind -> weight
+    """
+    if not value:
+        return dict((kind, 1) for kind in ROUTES)
+
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        if kind.strip() not in ROUTES:
+            raise ValueError('unknown webhook kind {}'.format(kind))
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+
+def generate(n, recipients, mix=None, unknown=0.0, seed=None):
+    """
+    Unsigned payloads for a load test, the drivers sign them as they send
+    :param n: number of payloads
+    :param recipients: seeded recipient addresses
+    :param mix: dict of kind -> weight
+    :param unknown: fraction sent to addresses that don't resolve
+    :param seed: random seed for a repeatable run
+    :return: list of (kind, route, form)
+    """
+    rng = random.Random(seed)
+    mix = mix or parse_mix(None)
+    kinds = sorted(mix)
+    weights = [mix[k] for k in kinds]
+    total = float(sum(weights))
+
+    payloads = []
+    for idx in range(n):
+        pick = rng.random() * total
+        for kind, weight in zip(kinds, weights):
+            pick -= weight
+            if pick < 0:
+                break
+
+        if rng.random() < unknown or not recipients:
+            recipient = 'unknown-{}@bench.example.com'.format(idx)
+        else:
+            recipient = rng.choice(recipients)
+
+        route, form = payload(kind, recipient)
+        payloads.append((kind, route, form))
+    return payloads
@@ -0,0 +1,65 @@
+"""
+Micro-benchmark of the JSON response paths, microseconds per response.
+
+    python -m bench.responses [--number 20000]
+
+Times the old json.dumps + Response and pretty printed jsonify bodies
+against fastjson.json_response for each installed encoder, and the
+pre-encoded constant error responses.
+"""
+from flask import Flask, Response, jsonify
+import argparse
+import fastjson
+import json
+import timeit
+
+
+BODY = {"v_id": 123456, "email": "visitor@example.com", "event": "opened", "status": 'success'}
+ERROR = {"Error": "Unable to resolve the recipient email address..."}
+
+
+def encoders():
+    """
+    :return: list of (name, dumps) for the installed encoders
+    """
+    found = []
+    for name in fastjson.ENCODERS:
+        loaded, dumps = fastjson.load_encoder(name)
+        if loaded == name:
+            found.append((name, dumps))
+    return found
+
+
+def cases():
+    cases = [
+        ('json.dumps + Response', lambda: Response(json.dumps(BODY), status=202, mimetype='application/json')),
+        ('jsonify, pretty printed', lambda: jsonify(BODY))
+    ]
+    for name, dumps in encoders():
+        cases.append(('{} + Response'.format(name),
+                      lambda dumps=dumps: Response(dumps(BODY), status=202, mimetype=fastjson.MIMETYPE)))
+
+    cases.append(('error, json.dumps + Response',
+                  lambda: Response(json.dumps(ERROR), status=406, mimetype='application/json')))
+    cases.append(('error, constant_response', fastjson.constant_response(ERROR, 406)))
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench.responses', description='Time the JSON response paths.')
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
+
+    print('fastjson backend: {}'.format(fastjson.backend))
+    with app.test_request_context():
+        for name, case in cases():
+            best = min(timeit.repeat(case, number=args.number, repeat=args.repeat))
+            print('{:<32} {:8.2f} us'.format(name, best / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, func, select
+from models import AppendedVisitor, Campaign, CampaignType, Lead, Store, Visitor
+from database import Base
+
+
+EMAIL = 'bench-{}@bench.example.com'
+
+
+def _next_id(conn, model):
+    return (conn.execute(select([func.max(model.__table__.c.id)])).scalar() or 0) + 1
+
+
+def seed(engine, visitors=10000, lead_ratio=0.9, campaigns=10, chunk=5000):
+    """
+    Create the tables if needed and bulk insert a store, campaigns, visitors,
+    appended visitors and leads for a load test.  Ids continue after the
+    existing rows so a seed can be repeated.
+    :param engine: sqlalchemy engine, e.g. a sqlite file or a local MySQL
+    :param visitors: appended visitors to create, one per visitor
+    :param lead_ratio: fraction of appended visitors that get a lead
+    :param campaigns: campaigns the visitors are spread over
+    :param chunk: rows per executemany
+    :return: dict of counts
+    """
+    Base.metadata.create_all(engine)
+    now = datetime.now()
+
+    with engine.begin() as conn:
+        store_id = _next_id(conn, Store)
+        type_id = _next_id(conn, CampaignType)
+        first_campaign = _next_id(conn, Campaign)
+        first_visitor = _next_id(conn, Visitor)
+        first_appended = _next_id(conn, AppendedVisitor)
+        first_lead = _next_id(conn, Lead)
+
+        conn.execute(Store.__table__.insert(), [{
+            "id": store_id, "client_id": 'bench-{}'.format(store_id), "name": 'Bench Store {}'.format(store_id),
+            "address1": '1 Main St', "city": 'Charlotte', "state": 'NC', "zip_code": '28202',
+            "notification_email": 'notify@bench.example.com', "reporting_email": 'reports@bench.example.com',
+            "phone_number": '7045550100'
+        }])
+        conn.execute(CampaignType.__table__.insert(), [{"id": type_id, "name": 'Bench'}])
+        conn.execute(Campaign.__table__.insert(), [{
+            "id": first_campaign + i, "store_id": store_id, "name": 'Bench Campaign {}'.format(first_campaign + i),
+            "job_number": 900000000 + first_campaign + i, "type": type_id, "status": 'ACTIVE',
+            "start_date": now - timedelta(days=30), "end_date": now + timedelta(days=30),
+            "client_id": 'bench-{}'.format(store_id), "rvm_campaign_id": None
+        } for i in range(campaigns)])
+
+        for start in range(0, visitors, chunk):
+            ids = range(start, min(start + chunk, visitors))
+            conn.execute(Visitor.__table__.insert(), [{
+                "id": first_visitor + i, "campaign_id": first_campaign + i % campaigns, "store_id": store_id,
+                "created_date": now, "ip": '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255),
+                "country_code": 'US'
+            } for i in ids])
+            conn.execute(AppendedVisitor.__table__.insert(), [{
+                "id": first_appended + i, "visitor": first_visitor + i, "created_date": now,
+                "email": EMAIL.format(first_appended + i)
+            } for i in ids])
+
+            with_lead = [i for i in ids if (i % 1000) < lead_ratio * 1000]
+            if with_lead:
+                conn.execute(Lead.__table__.insert(), [{
+                    "id": first_lead + i, "appended_visitor_id": first_appended + i, "created_date": now
+                } for i in with_lead])
+
+    return {"store_id": store_id, "campaigns": campaigns, "visitors": visitors,
+            "leads": len([i for i in range(visitors) if (i % 1000) < lead_ratio * 1000])}
+
+
+def recipients(engine, limit=None):
+    """
+    :param engine: sqlalchemy engine
+    :param limit: at most this many addresses
+    :return: list of seeded recipient addresses
+    """
+    t = AppendedVisitor.__table__
+    query = select([t.c.email]).where(t.c.email.like(EMAIL.format('%'))).order_by(t.c.id)
+    if limit:
+        query = query.limit(limit)
+    with engine.connect() as conn:
+        return [row[0] for row in conn.execute(query)]
+
+
+def engine_for(url=None):
+    """
+    :param url: database url, defaults to the app's own engine
+    :return: sqlalchemy engine
+    """
+    if url:
+        return create_engine(url)
+
+    from database import db_session
+    return db_session.get_bind()
@@ -0,0 +1,116 @@
+"""
+Worker startup cost: import time, RSS and private (unshared) memory of a
+worker after its first request.
+
+    python -m bench.startup [--runs 5]
+
+cold     a fresh process imports api and builds the app, extensions lazy
+eager    a fresh process that also preloads the alert transports
+forked   the master imports, builds and preloads, then forks the worker,
+         as gunicorn does with preload_app
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+MODES = ('cold', 'eager', 'forked')
+
+
+def memory_kb():
+    """
+    :return: (rss, private) in kB from /proc, private is unshared memory
+    """
+    rss = private = 0
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                    private += int(line.split()[1])
+    except (IOError, OSError):
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss, private
+
+
+def first_request(app):
+    app.test_client().get('/api/v1.0/index')
+
+
+def probe(mode):
+    """
+    Runs in a child process and prints one JSON result
+    :param mode: one of MODES
+    :return: None
+    """
+    started = time.time()
+    import api
+    app = api.create_app()
+    if mode in ('eager', 'forked'):
+        api.preload()
+    import_ms = (time.time() - started) * 1000.0
+
+    if mode != 'forked':
+        first_request(app)
+        rss, private = memory_kb()
+        print(json.dumps({"import_ms": import_ms, "rss_kb": rss, "private_kb": private}))
+        return
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        first_request(app)
+        rss, private = memory_kb()
+        os.write(write_fd, json.dumps({"rss_kb": rss, "private_kb": private}).encode('utf-8'))
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = json.loads(f.read())
+    os.waitpid(pid, 0)
+
+    # the forked worker pays no import time of its own
+    result['import_ms'] = 0.0
+    result['master_import_ms'] = import_ms
+    print(json.dumps(result))
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0
+
+
+def measure(mode, runs):
+    samples = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-m', 'bench.startup', '--probe', mode])
+        samples.append(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+
+    return dict((key, round(median([s[key] for s in samples]), 1)) for key in samples[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench.startup', description='Measure worker startup cost.')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--probe', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe:
+        probe(args.probe)
+        return
+
+    print(json.dumps(dict((mode, measure(mode, args.runs)) for mode in args.modes.split(',')), indent=2,
+                     sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+from collections import OrderedDict
+from threading import Lock
+import json
+import logging
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-process LRU cache with a per-entry TTL.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """
+        Return the cached value or None, refreshing its LRU position
+        :param key:
+        :return: value or None
+        """
+        with self._lock:
+            item = self._data.get(key)
+
+            if item is None:
+                self.misses += 1
+                return None
+
+            value, expires = item
+            if expires < time.time():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            # mark as most recently used
+            del self._data[key]
+            self._data[key] = item
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (ttl or self.ttl)
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def add(self, key, value, ttl=None):
+        """
+        Set the key only if it is absent or expired
+        :return: True if the key was added
+        """
+        now = time.time()
+
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] >= now:
+                return False
+
+            self._data.pop(key, None)
+            self._data[key] = (value, now + (ttl or self.ttl))
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def delete_where(self, predicate):
+        """
+        Drop every entry whose value matches the predicate
+        :param predicate: callable(value) -> bool
+        :return: number of entries removed
+        """
+        with self._lock:
+            keys = [k for k, (v, _) in self._data.items() if predicate(v)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+
+class RedisCache(object):
+    """
+    Shared cache backend, JSON values stored under a key prefix with a TTL.
+    Redis errors are logged and treated as cache misses.
+    """
+
+    def __init__(self, client, prefix, ttl=300):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @classmethod
+    def from_url(cls, url, prefix, ttl=300):
+        import redis
+        return cls(redis.StrictRedis.from_url(url), prefix, ttl)
+
+    def _key(self, key):
+        return '{}:{}'.format(self.prefix, key)
+
+    def get(self, key):
+        try:
+            raw = self.client.get(self._key(key))
+        except Exception as err:
+            self.errors += 1
+            log.warning('redis cache get failed: %s', err)
+            return None
+
+        if raw is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return json.loads(raw.decode('utf-8') if isinstance(raw, bytes) else raw)
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.client.setex(self._key(key), int(ttl or self.ttl), json.dumps(value))
+        except Exception as err:
+            self.errors += 1
+            log.warning('redis cache set failed: %s', err)
+
+    def add(self, key, value, ttl=None):
+        """
+        SET NX, shared across workers
+        :return: True if the key was added, None if redis is unavailable
+        """
+        try:
+            return bool(self.client.set(self._key(key), json.dumps(value), nx=True, ex=int(ttl or self.ttl)))
+        except Exception as err:
+            self.errors += 1
+            log.warning('redis cache add failed: %s', err)
+            return None
+
+    def delete(self, *keys):
+        if not keys:
+            return
+        try:
+            self.client.delete(*[self._key(k) for k in keys])
+        except Exception as err:
+            self.errors += 1
+            log.warning('redis cache delete failed: %s', err)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors
+        }
+
+
+class RecipientCache(object):
+    """
+    Maps a recipient email address to (appended_visitor_id, lead_id).
+    Lookups check the local LRU first, then the optional shared backend.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300, shared=None):
+        self.local = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.shared = shared
+        self.invalidations = 0
+
+    @classmethod
+    def from_config(cls, config):
+        ttl = getattr(config, 'RECIPIENT_CACHE_TTL', 300)
+        shared = None
+        redis_url = getattr(config, 'RECIPIENT_CACHE_REDIS_URL', None)
+
+        if redis_url:
+            shared = RedisCache.from_url(redis_url, 'earl:recipient', ttl)
+
+        return cls(maxsize=getattr(config, 'RECIPIENT_CACHE_SIZE', 10000), ttl=ttl, shared=shared)
+
+    @staticmethod
+    def _key(email):
+        # MySQL compares the email column case-insensitively
+        return email.strip().lower()
+
+    def get(self, email):
+        """
+        :param email: recipient email address
+        :return: (appended_visitor_id, lead_id) or None
+        """
+        key = self._key(email)
+        value = self.local.get(key)
+
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                value = tuple(value)
+                self.local.set(key, value)
+
+        return value
+
+    def set(self, email, appended_visitor_id, lead_id):
+        key = self._key(email)
+        value = (appended_visitor_id, lead_id)
+        self.local.set(key, value)
+
+        if self.shared is not None:
+            self.shared.set(key, value)
+            self.shared.set('lead:{}'.format(lead_id), key)
+
+    def invalidate(self, email):
+        key = self._key(email)
+        self.local.delete(key)
+        self.invalidations += 1
+
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def invalidate_lead(self, lead_id):
+        """
+        Drop any cached recipient for a lead, e.g. after it is reassigned
+        :param lead_id:
+        :return: None
+        """
+        self.local.delete_where(lambda value: value[1] == lead_id)
+        self.invalidations += 1
+
+        if self.shared is not None:
+            email = self.shared.get('lead:{}'.format(lead_id))
+            keys = ['lead:{}'.format(lead_id)]
+            if email:
+                keys.append(email)
+            self.shared.delete(*keys)
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        stats = {"local": self.local.stats(), "invalidations": self.invalidations}
+        if self.shared is not None:
+            stats['shared'] = self.shared.stats()
+        return stats
+
+
+class Watermark(object):
+    """
+    A cheap value that changes whenever cached misses may have gone stale,
+    e.g. MAX(id) of an insert-mostly table, re-read at most every
+    `interval` seconds.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.value = None
+        self._read_at = 0.0
+        self.reads = 0
+
+    def stale(self):
+        return time.time() - self._read_at >= self.interval
+
+    def set(self, value):
+        self.value = value
+        self._read_at = time.time()
+        self.reads += 1
+
+    def get(self, read):
+        """
+        :param read: callable returning the current value
+        :return: the value, read again once it is `interval` seconds old
+        """
+        if self.stale():
+            self.set(read())
+        return self.value
+
+    def expire(self):
+        self._read_at = 0.0
+
+
+class NegativeCache(object):
+    """
+    Bounded set of keys known not to resolve, each kept with the generation
+    (a Watermark value) it was looked up at.  An entry only counts while the
+    generation is unchanged, so a new appended visitor brings every unknown
+    recipient back at once; the TTL is a backstop for emails changed in
+    place by the outside automation.
+    """
+
+    def __init__(self, maxsize=50000, ttl=600, shared=None):
+        self.local = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.shared = shared
+        self.stale = 0
+
+    @classmethod
+    def from_config(cls, config):
+        ttl = getattr(config, 'UNKNOWN_RECIPIENT_CACHE_TTL', 600)
+        shared = None
+        redis_url = getattr(config, 'RECIPIENT_CACHE_REDIS_URL', None)
+
+        if redis_url:
+            shared = RedisCache.from_url(redis_url, 'earl:unknown', ttl)
+
+        return cls(maxsize=getattr(config, 'UNKNOWN_RECIPIENT_CACHE_SIZE', 50000), ttl=ttl, shared=shared)
+
+    @staticmethod
+    def _key(email):
+        return email.strip().lower()
+
+    def contains(self, email, generation):
+        """
+        :param email:
+        :param generation: the current generation
+        :return: True if the email was unknown at this generation
+        """
+        key = self._key(email)
+        value = self.local.get(key)
+
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+
+        if value is None:
+            return False
+
+        if value != generation:
+            self.stale += 1
+            self.local.delete(key)
+            return False
+
+        return True
+
+    def add(self, email, generation):
+        key = self._key(email)
+        self.local.set(key, generation)
+
+        if self.shared is not None:
+            self.shared.set(key, generation)
+
+    def discard(self, email):
+        key = self._key(email)
+        self.local.delete(key)
+
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        stats = {"local": self.local.stats(), "stale": self.stale}
+        if self.shared is not None:
+            stats['shared'] = self.shared.stats()
+        return stats
@@ -0,0 +1,290 @@
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from threading import Condition, Thread
+from database import db_session
+from models import AppendedVisitor, Campaign, CampaignDashboard, GlobalDashboard, Lead, StoreDashboard, Visitor
+import atexit
+import config
+import logging
+import os
+
+
+log = logging.getLogger(__name__)
+
+# delta name -> (campaign_dashboard column, store_dashboard / dashboard column).
+# Appends and RTNs are written by the services that create appended visitors
+# and send leads to dealers, not by this API, so recompute.py keeps those
+DELTA_COLUMNS = {
+    'followup_emails': ('total_followup_emails', 'total_sent_followup_emails')
+}
+
+# a lead counts as a followup email once its email is delivered, later
+# engagement events overwrite the delivered status, see recompute.py
+DELIVERED_STATUSES = ('delivered', 'opened', 'clicked', 'unsubscribed', 'complained')
+
+
+def _merge_update(table, key, rows, column_index):
+    """
+    executemany UPDATE adding the deltas to the existing dashboard rows
+    :param table: dashboard table
+    :param key: the key column name
+    :param rows: list of (key value, deltas dict)
+    :param column_index: 0 for campaign columns, 1 for store/global columns
+    :return: (statement, params)
+    """
+    values = {"last_update": bindparam('b_last_update')}
+    for name, columns in DELTA_COLUMNS.items():
+        col = columns[column_index]
+        values[col] = func.coalesce(table.c[col], 0) + bindparam('b_' + name)
+
+    stmt = table.update().where(table.c[key] == bindparam('b_key')).values(**values)
+    now = datetime.now()
+    params = []
+
+    for value, deltas in rows:
+        param = dict(('b_' + name, deltas.get(name, 0)) for name in DELTA_COLUMNS)
+        param['b_key'] = value
+        param['b_last_update'] = now
+        params.append(param)
+
+    return stmt, params
+
+
+def upsert_deltas(session, table, key, rows, column_index, extra=None):
+    """
+    Add deltas to the dashboard rows with a unique key, creating the missing
+    ones.  MySQL gets one INSERT ... ON DUPLICATE KEY UPDATE col = col + n;
+    other databases (the sqlite dev setup) update and then insert the keys
+    the update missed, which is only safe with a single writer.
+    :param session: db session
+    :param table: campaign_dashboard or store_dashboard
+    :param key: the unique key column name
+    :param rows: list of (key value, deltas dict)
+    :param column_index: 0 for campaign columns, 1 for store columns
+    :param extra: optional dict of key value -> extra insert columns
+    :return: None
+    """
+    now = datetime.now()
+    columns = [columns[column_index] for columns in DELTA_COLUMNS.values()]
+    inserts = []
+
+    for value, deltas in rows:
+        row = dict((DELTA_COLUMNS[name][column_index], deltas.get(name, 0)) for name in DELTA_COLUMNS)
+        row.update((extra or {}).get(value, {}))
+        row[key] = value
+        row['last_update'] = now
+        inserts.append(row)
+
+    if session.get_bind().dialect.name == 'mysql':
+        stmt = mysql_insert(table)
+        updates = dict((col, func.coalesce(table.c[col], 0) + stmt.inserted[col]) for col in columns)
+        updates['last_update'] = stmt.inserted.last_update
+        session.execute(stmt.on_duplicate_key_update(**updates), inserts)
+        return
+
+    existing = set(row[0] for row in session.execute(
+        select([table.c[key]]).where(table.c[key].in_([value for value, _ in rows]))
+    ))
+    updates = [(value, deltas) for value, deltas in rows if value in existing]
+    if updates:
+        session.execute(*_merge_update(table, key, updates, column_index))
+    inserts = [row for row in inserts if row[key] not in existing]
+    if inserts:
+        session.execute(table.insert(), inserts)
+
+
+def lead_campaigns(session, lead_ids):
+    """
+    Map leads to their campaign and store with one join.  The store comes
+    from the campaign, visitors.store_id is nullable.
+    :param session: db session
+    :param lead_ids: iterable of lead ids
+    :return: list of (lead_id, campaign_id, store_id)
+    """
+    return session.query(
+        Lead.id, Campaign.id, Campaign.store_id
+    ).join(
+        AppendedVisitor, Lead.appended_visitor_id == AppendedVisitor.id
+    ).join(
+        Visitor, AppendedVisitor.visitor == Visitor.id
+    ).join(
+        Campaign, Visitor.campaign_id == Campaign.id
+    ).filter(
+        Lead.id.in_(list(lead_ids))
+    ).all()
+
+
+def merge_deltas(session, campaigns):
+    """
+    Merge per-campaign deltas into campaign_dashboard, store_dashboard and the
+    latest dashboard row in one transaction.  Missing campaign and store rows
+    are created by the upsert.
+    :param session: db session
+    :param campaigns: dict of (campaign_id, store_id) -> deltas dict
+    :return: None
+    """
+    if not campaigns:
+        return
+
+    stores = defaultdict(lambda: defaultdict(int))
+    totals = defaultdict(int)
+    for (campaign_id, store_id), deltas in campaigns.items():
+        for name, n in deltas.items():
+            stores[store_id][name] += n
+            totals[name] += n
+
+    # campaign_dashboard, a campaign belongs to one store
+    upsert_deltas(session, CampaignDashboard.__table__, 'campaign_id',
+                  [(k[0], d) for k, d in campaigns.items()], 0,
+                  dict((k[0], {"store_id": k[1]}) for k in campaigns))
+
+    # store_dashboard
+    upsert_deltas(session, StoreDashboard.__table__, 'store_id', list(stores.items()), 1)
+
+    # the latest global dashboard snapshot
+    table = GlobalDashboard.__table__
+    latest = session.execute(select([func.max(table.c.id)])).scalar()
+    if latest is not None:
+        stmt, params = _merge_update(table, 'id', [(latest, totals)], 1)
+        session.execute(stmt, params[0])
+
+    session.commit()
+
+
+class DashboardDeltas(object):
+    """
+    Accumulates dashboard deltas from the webhook pipeline and merges them
+    into the dashboard tables every flush_interval seconds.  A failed batch
+    is retried on its own for max_attempts flushes and then dropped, the
+    full refresh in recompute.py corrects the dashboards.
+    """
+
+    def __init__(self, session, flush_interval=5.0, max_attempts=5):
+        self.session = session
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._leads = defaultdict(lambda: defaultdict(int))
+        self._campaigns = defaultdict(lambda: defaultdict(int))
+        self._retries = []
+        self._cond = Condition()
+        self._pid = None
+        self.flushes = 0
+        self.errors = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self):
+        return bool(self.flush_interval)
+
+    def _ensure_thread(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            thread = Thread(target=self._run, name='dashboard-deltas')
+            thread.daemon = True
+            thread.start()
+
+    def add_lead(self, lead_id, **deltas):
+        """
+        Deltas for a lead, its campaign and store are resolved at flush time
+        :param lead_id:
+        :param deltas: DELTA_COLUMNS names
+        :return: None
+        """
+        if not self.enabled:
+            return
+        with self._cond:
+            self._ensure_thread()
+            for name, n in deltas.items():
+                self._leads[lead_id][name] += n
+
+    def add_campaign(self, campaign_id, store_id, **deltas):
+        if not self.enabled:
+            return
+        with self._cond:
+            self._ensure_thread()
+            for name, n in deltas.items():
+                self._campaigns[(campaign_id, store_id)][name] += n
+
+    def lead_event(self, lead_id, kind):
+        # Mailgun sends one delivered event per message, the dedupe window
+        # drops redeliveries
+        if kind == 'delivered':
+            self.add_lead(lead_id, followup_emails=1)
+
+    def _take(self):
+        with self._cond:
+            by_lead, self._leads = self._leads, defaultdict(lambda: defaultdict(int))
+            by_campaign, self._campaigns = self._campaigns, defaultdict(lambda: defaultdict(int))
+            retries, self._retries = self._retries, []
+            return by_lead, by_campaign, retries
+
+    def _resolve(self, by_lead, campaigns):
+        for lead_id, campaign_id, store_id in lead_campaigns(self.session, by_lead):
+            for name, n in by_lead[lead_id].items():
+                campaigns[(campaign_id, store_id)][name] += n
+
+    def _merge(self, by_lead, campaigns, attempts):
+        """
+        Merge one batch, a failed batch is kept apart from the new deltas
+        so it can't fail them too
+        :param by_lead: lead_id -> deltas dict
+        :param campaigns: (campaign_id, store_id) -> deltas dict
+        :param attempts: earlier failed attempts
+        :return: None
+        """
+        try:
+            if by_lead:
+                self._resolve(by_lead, campaigns)
+                by_lead = {}
+            merge_deltas(self.session, campaigns)
+            self.flushes += 1
+        except Exception as err:
+            self.session.rollback()
+            self.errors += 1
+            attempts += 1
+            if attempts >= self.max_attempts:
+                self.dropped += 1
+                log.error('dashboard delta merge failed %s times, dropped %s leads and %s campaigns: %s',
+                          attempts, len(by_lead), len(campaigns), err)
+                return
+            log.error('dashboard delta merge failed, requeued: %s', err)
+            with self._cond:
+                self._retries.append((by_lead, campaigns, attempts))
+        finally:
+            self.session.remove()
+
+    def flush(self):
+        by_lead, campaigns, retries = self._take()
+
+        for batch in retries:
+            self._merge(*batch)
+        if by_lead or campaigns:
+            self._merge(by_lead, campaigns, 0)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as err:
+                log.exception('dashboard deltas: %s', err)
+
+    def stats(self):
+        return {
+            "pending_leads": len(self._leads),
+            "pending_campaigns": len(self._campaigns),
+            "retries": len(self._retries),
+            "flushes": self.flushes,
+            "errors": self.errors,
+            "dropped": self.dropped
+        }
+
+
+# DASHBOARD_DELTA_INTERVAL of 0 leaves the dashboards to the full refresh
+deltas = DashboardDeltas(db_session, flush_interval=getattr(config, 'DASHBOARD_DELTA_INTERVAL', 0),
+                         max_attempts=getattr(config, 'DASHBOARD_DELTA_MAX_ATTEMPTS', 5))
+atexit.register(deltas.flush)
+
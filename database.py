@@ -0,0 +1,67 @@
+"""
+One engine and one scoped session per process, shared by the API, the
+celery tasks and the command line tools.  Read-only queries can use
+read_session, bound to SQLALCHEMY_REPLICA_URI when it is set and to the
+primary otherwise.
+"""
+from sqlalchemy import create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import scoped_session, sessionmaker
+import config
+
+
+def make_engine(url, **options):
+    """
+    Engine with the pool settings from config
+    :param url: database url
+    :param options: create_engine overrides
+    :return: engine
+    """
+    settings = {
+        # drop connections the server closed while they sat in the pool
+        "pool_pre_ping": getattr(config, 'SQLALCHEMY_POOL_PRE_PING', True),
+        # below MySQL's wait_timeout
+        "pool_recycle": getattr(config, 'SQLALCHEMY_POOL_RECYCLE', 280)
+    }
+
+    # sqlite uses a pool without size limits
+    if not url.startswith('sqlite'):
+        settings['pool_size'] = getattr(config, 'SQLALCHEMY_POOL_SIZE', 5)
+        settings['max_overflow'] = getattr(config, 'SQLALCHEMY_MAX_OVERFLOW', 10)
+        settings['pool_timeout'] = getattr(config, 'SQLALCHEMY_POOL_TIMEOUT', 10)
+
+    settings.update(options)
+    return create_engine(url, **settings)
+
+
+engine = make_engine(config.SQLALCHEMY_DATABASE_URI)
+
+# sessions only check out a connection on their first query
+db_session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+
+replica_uri = getattr(config, 'SQLALCHEMY_REPLICA_URI', None)
+if replica_uri:
+    replica_engine = make_engine(replica_uri)
+    read_session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=replica_engine))
+else:
+    replica_engine = engine
+    read_session = db_session
+
+Base = declarative_base()
+Base.query = db_session.query_property()
+
+
+def remove_sessions():
+    """
+    End the sessions this thread actually used, without creating new ones
+    :return: None
+    """
+    for session in set([db_session, read_session]):
+        if session.registry.has():
+            session.remove()
+
+
+def init_db():
+    # import the models so they are registered on the metadata
+    import models  # noqa: F401
+    Base.metadata.create_all(bind=engine)
@@ -0,0 +1,115 @@
+from cache import LRUCache, RedisCache
+
+
+# events Mailgun sends at most once per message; opens and clicks repeat, so
+# only these are also keyed on Message-Id
+ONE_SHOT_EVENTS = frozenset(('delivered', 'dropped', 'bounced', 'complained', 'unsubscribed'))
+
+
+class WebhookDeduplicator(object):
+    """
+    Idempotency guard for Mailgun webhooks, keyed on the webhook token and,
+    for one-shot events, on Message-Id + event.  Keys are remembered for
+    `window` seconds in a bounded local LRU and, optionally, in redis so every
+    worker sees them.
+    """
+
+    def __init__(self, window=3600, maxsize=100000, shared=None):
+        self.local = LRUCache(maxsize=maxsize, ttl=window)
+        self.shared = shared
+        self.window = window
+        self.claimed = 0
+        self.duplicates = 0
+        self.released = 0
+
+    @classmethod
+    def from_config(cls, config):
+        window = getattr(config, 'WEBHOOK_DEDUPE_WINDOW', 3600)
+        shared = None
+        redis_url = getattr(config, 'WEBHOOK_DEDUPE_REDIS_URL', None)
+
+        if redis_url:
+            shared = RedisCache.from_url(redis_url, 'earl:webhook', window)
+
+        return cls(window=window, maxsize=getattr(config, 'WEBHOOK_DEDUPE_SIZE', 100000), shared=shared)
+
+    @staticmethod
+    def keys(form_data):
+        """
+        :param form_data: the webhook form data
+        :return: list of idempotency keys
+        """
+        keys = []
+
+        if form_data.get('token'):
+            keys.append('t:{}'.format(form_data['token']))
+
+        if form_data.get('message_id') and form_data.get('event') in ONE_SHOT_EVENTS:
+            keys.append('m:{}:{}'.format(form_data['message_id'], form_data.get('event')))
+
+        return keys
+
+    def claim(self, form_data):
+        """
+        Mark a webhook as being processed
+        :param form_data: the webhook form data
+        :return: False if it was seen within the window
+        """
+        keys = self.keys(form_data)
+        added = []
+
+        for key in keys:
+            if not self.local.add(key, 1):
+                self._undo(added)
+                self.duplicates += 1
+                return False
+            added.append(key)
+
+        if self.shared is not None:
+            for idx, key in enumerate(keys):
+                # redis being unavailable is not treated as a duplicate
+                if self.shared.add(key, 1) is False:
+                    self.shared.delete(*keys[:idx])
+                    self._undo(keys)
+                    self.duplicates += 1
+                    return False
+
+        self.claimed += 1
+        return True
+
+    def _undo(self, keys):
+        for key in keys:
+            self.local.delete(key)
+
+    def release(self, form_data):
+        """
+        Forget a webhook that failed, so Mailgun's retry is processed
+        :param form_data: the webhook form data
+        :return: None
+        """
+        self.release_keys(self.keys(form_data))
+
+    def release_keys(self, keys):
+        """
+        release() for a worker that only has the keys, e.g. a celery task
+        :param keys: list from keys()
+        :return: None
+        """
+        self._undo(keys)
+
+        if self.shared is not None and keys:
+            self.shared.delete(*keys)
+
+        self.released += 1
+
+    def stats(self):
+        stats = {
+            "window": self.window,
+            "claimed": self.claimed,
+            "duplicates": self.duplicates,
+            "released": self.released,
+            "local": self.local.stats()
+        }
+        if self.shared is not None:
+            stats['shared'] = self.shared.stats()
+        return stats
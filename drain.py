@@ -0,0 +1,127 @@
+"""
+Apply the durable webhook event log to the leads table in large batches.
+
+    python drain.py [--dir WEBHOOK_LOG_DIR] [--batch 5000] [--follow]
+
+Each writer directory keeps its own checkpoint, saved after every committed
+batch.  A crash between a commit and its checkpoint re-applies that batch.
+Live writers are only read up to their last fsync, see eventlog.durable_limit.
+"""
+from collections import OrderedDict
+from batching import PendingLead, flush_pending
+from dashboards import deltas as dashboard_deltas
+from rollups import deltas as rollup_deltas
+from database import db_session
+from eventlog import Checkpoint, durable_limit, read_from, writer_directories
+from leads import lookup_recipient
+import argparse
+import config
+import logging
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+def drain_directory(directory, session, batch_size=5000):
+    """
+    Apply every durable record after the checkpoint of one writer directory
+    :param directory: the writer directory
+    :param session: db session
+    :param batch_size: records per transaction
+    :return: (records read, records applied)
+    """
+    checkpoint = Checkpoint(directory)
+    segment, offset = checkpoint.load()
+    pending = OrderedDict()
+    position = None
+    batch = 0
+    read = 0
+    applied = 0
+
+    for record, segment, offset in read_from(directory, segment, offset, durable_limit(directory)):
+        data = record['data']
+        row = lookup_recipient(session, data['recipient'])
+
+        if row and row.lead_id:
+            pending.setdefault(row.lead_id, PendingLead(row.lead_id)).apply(record['kind'], data)
+            applied += 1
+
+        position = (segment, offset)
+        batch += 1
+        read += 1
+
+        if batch >= batch_size:
+            if pending:
+                flush_pending(session, pending)
+            checkpoint.save(*position)
+            pending = OrderedDict()
+            batch = 0
+
+    if position is not None:
+        if pending:
+            flush_pending(session, pending)
+        checkpoint.save(*position)
+
+    return read, applied
+
+
+def drain(base_dir, batch_size=5000):
+    """
+    :param base_dir: the event log base directory
+    :param batch_size: records per transaction
+    :return: (records read, records applied)
+    """
+    read = applied = 0
+
+    for directory in writer_directories(base_dir):
+        try:
+            r, a = drain_directory(directory, db_session, batch_size)
+        finally:
+            db_session.remove()
+        read += r
+        applied += a
+
+    dashboard_deltas.flush()
+    rollup_deltas.flush()
+    return read, applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply the webhook event log to the leads table.')
+    parser.add_argument('--dir', default=getattr(config, 'WEBHOOK_LOG_DIR', 'var/webhook-log'))
+    parser.add_argument('--batch', type=int, default=5000)
+    parser.add_argument('--follow', action='store_true', help='keep draining new records')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between passes with --follow')
+    parser.add_argument('--max-backoff', type=float, default=60.0, help='longest wait after failed passes')
+    args = parser.parse_args()
+
+    if args.follow:
+        logging.basicConfig(level=logging.INFO)
+
+    backoff = args.interval
+    while True:
+        started = time.time()
+        try:
+            read, applied = drain(args.dir, args.batch)
+        except Exception as err:
+            if not args.follow:
+                raise
+            # the checkpoint still points at the failed batch, it is retried
+            log.exception('drain pass failed, retrying in %.1fs: %s', backoff, err)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, args.max_backoff)
+            continue
+
+        backoff = args.interval
+        if read:
+            elapsed = time.time() - started
+            print('{} records read, {} applied in {:.2f}s'.format(read, applied, elapsed))
+
+        if not args.follow:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
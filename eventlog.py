@@ -0,0 +1,358 @@
+from collections import deque
+from threading import Condition, Lock, Thread
+import errno
+import json
+import logging
+import os
+import socket
+import struct
+import time
+import zlib
+
+
+log = logging.getLogger(__name__)
+
+# record header: payload length and crc32 of the payload
+HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.log'
+# the writer's last fsynced position, drainers never read past it
+DURABLE_NAME = 'durable.json'
+
+
+def segment_name(seq):
+    return '{:020d}{}'.format(seq, SEGMENT_SUFFIX)
+
+
+def list_segments(directory):
+    """
+    :param directory: a writer directory
+    :return: sorted segment file names
+    """
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+
+
+def _fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class EventLog(object):
+    """
+    Segmented, length-prefixed append-only log.  append() returns once the
+    record is on disk; concurrent appends share a single fsync (group commit).
+    Each process writes to its own directory under the base path.
+    """
+
+    def __init__(self, base_dir, segment_bytes=64 * 1024 * 1024, group_commit_ms=2.0):
+        self.base_dir = base_dir
+        self.segment_bytes = segment_bytes
+        self.group_commit = group_commit_ms / 1000.0
+        self._lock = Lock()
+        self._synced = Condition(Lock())
+        self._pid = None
+        self._file = None
+        self.directory = None
+        self._error = None
+        # (after, upto] ticket ranges cut by failed fsyncs
+        self._failed = deque(maxlen=128)
+        self.appends = 0
+        self.discarded = 0
+        self.fsyncs = 0
+
+    def _open(self):
+        # one writer directory per process, segments are never shared
+        self._pid = os.getpid()
+        self.directory = os.path.join(self.base_dir, '{}-{}'.format(socket.gethostname(), self._pid))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+            _fsync_dir(self.base_dir)
+
+        segments = list_segments(self.directory)
+        seq = int(segments[-1][:-len(SEGMENT_SUFFIX)]) + 1 if segments else 0
+        self._roll(seq)
+
+        self._written = 0
+        self._durable = 0
+        thread = Thread(target=self._sync_loop, name='event-log-fsync')
+        thread.daemon = True
+        thread.start()
+
+    def _roll(self, seq):
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+            self._file.close()
+            # everything in the closed segment is durable
+            self._mark_durable(self._written)
+
+        self._seq = seq
+        # unbuffered, a record is either in the file or discarded, never left in a buffer
+        self._file = open(os.path.join(self.directory, segment_name(seq)), 'ab', buffering=0)
+        self._size = self._durable_size = self._file.tell()
+        _fsync_dir(self.directory)
+        self._publish()
+
+    def _publish(self):
+        # called under _lock after an fsync, a failed publish only delays the drainer
+        try:
+            DurableMark(self.directory).save(segment_name(self._seq), self._durable_size)
+        except (IOError, OSError) as err:
+            log.warning('unable to publish the durable position of %s: %s', self.directory, err)
+
+    def _write(self, frame):
+        view = memoryview(frame)
+        try:
+            while view:
+                view = view[self._file.write(view):]
+        except (IOError, OSError):
+            # a torn frame would hide every record after it from the reader
+            os.ftruncate(self._file.fileno(), self._size)
+            raise
+
+    def _discard_unsynced(self):
+        """
+        Cut the records written since the last good fsync.  Their appends
+        fail and the webhooks are applied synchronously, so they must never
+        reach the drainer as well.
+        """
+        self.discarded += self._written - self._durable
+        os.ftruncate(self._file.fileno(), self._durable_size)
+        self._size = self._durable_size
+
+    def _mark_durable(self, ticket):
+        with self._synced:
+            if ticket > self._durable:
+                self._durable = ticket
+            self._synced.notify_all()
+
+    def append(self, record):
+        """
+        Append a JSON-serialisable record and wait until it is durable
+        :param record: dict
+        :return: (segment name, offset) of the record
+        """
+        payload = json.dumps(record, separators=(',', ':')).encode('utf-8')
+        frame = HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._file = None
+                self._open()
+
+            if self._size and self._size + len(frame) > self.segment_bytes:
+                self._roll(self._seq + 1)
+
+            position = (segment_name(self._seq), self._size)
+            self._write(frame)
+            self._size += len(frame)
+            self._written += 1
+            ticket = self._written
+
+        with self._synced:
+            self._synced.notify_all()
+            while True:
+                # only records cut by a failed fsync fail, later ones wait for the next
+                for after, upto in self._failed:
+                    if after < ticket <= upto:
+                        raise self._error
+                if self._durable >= ticket:
+                    break
+                self._synced.wait()
+
+        self.appends += 1
+        return position
+
+    def _sync_loop(self):
+        while True:
+            with self._synced:
+                while self._durable >= self._written:
+                    self._synced.wait()
+
+            # let concurrent appends join this commit
+            if self.group_commit:
+                time.sleep(self.group_commit)
+
+            with self._lock:
+                target = self._written
+                try:
+                    os.fsync(self._file.fileno())
+                    self._durable_size = self._size
+                    self._publish()
+                    error = None
+                except (IOError, OSError) as err:
+                    error = err
+                    try:
+                        self._discard_unsynced()
+                    except (IOError, OSError) as truncate_err:
+                        log.error('unable to discard unsynced records from %s, they may be drained '
+                                  'after being applied: %s', self.directory, truncate_err)
+
+            if error is not None:
+                # waiting appends fail and the webhook falls back to sync
+                log.error('event log fsync failed in %s: %s', self.directory, error)
+                with self._synced:
+                    self._error = error
+                    self._failed.append((self._durable, target))
+                    self._durable = target
+                    self._synced.notify_all()
+                time.sleep(1.0)
+                continue
+
+            self.fsyncs += 1
+            self._mark_durable(target)
+
+    def stats(self):
+        return {
+            "directory": self.directory,
+            "appends": self.appends,
+            "fsyncs": self.fsyncs,
+            "discarded": self.discarded,
+            "records_per_fsync": round(float(self.appends) / self.fsyncs, 2) if self.fsyncs else 0.0
+        }
+
+
+def read_segment(path, offset=0, end=None):
+    """
+    Yield (record, next_offset) from a segment, stopping at a torn or
+    corrupt tail so a partially written record is never returned.
+    :param path: the segment file
+    :param offset: byte offset to start from
+    :param end: byte offset not to read past, None for the whole file
+    :return: generator
+    """
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        while True:
+            header = fp.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+
+            length, crc = HEADER.unpack(header)
+            if end is not None and offset + HEADER.size + length > end:
+                return
+
+            payload = fp.read(length)
+            if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                return
+
+            offset += HEADER.size + length
+            yield json.loads(payload.decode('utf-8')), offset
+
+
+class Checkpoint(object):
+    """
+    Drain position (segment, offset) for one writer directory, written with
+    an atomic rename.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, 'checkpoint.json')
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None, 0
+        with open(self.path) as fp:
+            data = json.load(fp)
+        return data['segment'], data['offset']
+
+    def save(self, segment, offset):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({"segment": segment, "offset": offset, "saved": time.time()}, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp, self.path)
+
+
+class DurableMark(object):
+    """
+    The (segment, offset) a writer has fsynced up to, replaced with a rename
+    after every group commit.  It is not fsynced itself: after a crash it
+    can only lag behind the data.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, DURABLE_NAME)
+
+    def load(self):
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+        return data['segment'], data['offset']
+
+    def save(self, segment, offset):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({"segment": segment, "offset": offset}, fp)
+        os.rename(tmp, self.path)
+
+
+def writer_alive(directory):
+    """
+    :param directory: a writer directory, named <hostname>-<pid>
+    :return: False only for a writer of this host whose process has exited
+    """
+    host, _, pid = os.path.basename(directory.rstrip(os.sep)).rpartition('-')
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+
+    try:
+        os.kill(int(pid), 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+def durable_limit(directory):
+    """
+    How far a drainer may read a writer directory.  Records past the last
+    fsync can still be cut by a failed fsync and retried by the client, so a
+    live writer is read up to its DurableMark; an exited local writer is
+    read to the end.
+    :param directory: a writer directory
+    :return: (segment, offset) or None for no limit
+    """
+    if not writer_alive(directory):
+        return None
+    return DurableMark(directory).load() or (segment_name(0), 0)
+
+
+def read_from(directory, segment=None, offset=0, limit=None):
+    """
+    Yield (record, segment, next_offset) for a writer directory, starting at
+    a checkpoint position
+    :param directory: a writer directory
+    :param segment: checkpoint segment name or None for the beginning
+    :param offset: checkpoint offset within the segment
+    :param limit: (segment, offset) not to read past, see durable_limit()
+    :return: generator
+    """
+    for name in list_segments(directory):
+        if segment is not None and name < segment:
+            continue
+        if limit is not None and name > limit[0]:
+            return
+
+        start = offset if name == segment else 0
+        end = limit[1] if limit is not None and name == limit[0] else None
+        for record, next_offset in read_segment(os.path.join(directory, name), start, end):
+            yield record, name, next_offset
+
+
+def writer_directories(base_dir):
+    """
+    :param base_dir: the event log base directory
+    :return: sorted writer directory paths
+    """
+    if not os.path.isdir(base_dir):
+        return []
+    return sorted(
+        os.path.join(base_dir, name) for name in os.listdir(base_dir)
+        if os.path.isdir(os.path.join(base_dir, name))
+    )
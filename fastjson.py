@@ -0,0 +1,90 @@
+"""
+JSON encoding for the API responses.  JSON_ENCODER in config picks orjson,
+ujson or the standard library; 'auto' uses the fastest one installed.
+Output is compact, never pretty printed.
+"""
+from flask import Response
+import json
+import logging
+
+import config
+
+
+log = logging.getLogger(__name__)
+
+MIMETYPE = 'application/json'
+
+
+def _stdlib():
+    encoder = json.JSONEncoder(separators=(',', ':'), default=str)
+    return lambda obj: encoder.encode(obj).encode('utf-8')
+
+
+def _orjson():
+    import orjson
+    return lambda obj: orjson.dumps(obj, default=str)
+
+
+def _ujson():
+    import ujson
+    # ujson releases without default= raise TypeError here
+    ujson.dumps({}, default=str)
+    return lambda obj: ujson.dumps(obj, ensure_ascii=False, default=str).encode('utf-8')
+
+
+ENCODERS = {
+    'orjson': _orjson,
+    'ujson': _ujson,
+    'json': _stdlib
+}
+
+
+def load_encoder(name='auto'):
+    """
+    :param name: 'auto' or a key of ENCODERS, an installed encoder falls
+        back to the standard library when it can't be imported
+    :return: (name, function of obj -> utf-8 bytes)
+    """
+    if name != 'auto' and name not in ENCODERS:
+        raise ValueError('Unknown JSON encoder {}, choose one of auto, {}'.format(
+            name, ', '.join(sorted(ENCODERS))))
+
+    names = ('orjson', 'ujson', 'json') if name == 'auto' else (name, 'json')
+
+    for candidate in names:
+        try:
+            return candidate, ENCODERS[candidate]()
+        except (ImportError, TypeError) as err:
+            log.info('%s JSON encoder unavailable: %s', candidate, err)
+
+    # the standard library encoder always loads
+    return 'json', _stdlib()
+
+
+backend, dumps = load_encoder(getattr(config, 'JSON_ENCODER', 'auto'))
+
+
+def json_response(obj, status=200):
+    """
+    :param obj: json serializable body
+    :param status: http status
+    :return: Response
+    """
+    return Response(dumps(obj), status=status, mimetype=MIMETYPE)
+
+
+def constant_response(obj, status):
+    """
+    A response whose body never changes, encoded once at import
+    :param obj: json serializable body
+    :param status: http status
+    :return: callable returning a new Response with the prebuilt body
+    """
+    body = dumps(obj)
+
+    def response():
+        return Response(body, status=status, mimetype=MIMETYPE)
+
+    response.body = body
+    response.status = status
+    return response
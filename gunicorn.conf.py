@@ -0,0 +1,40 @@
+import os
+
+
+bind = os.environ.get('EARL_BIND', '0.0.0.0:5880')
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+
+# build the app once in the master, the forked workers share it copy-on-write
+preload_app = True
+
+
+def on_starting(server):
+    # the metrics snapshots of the previous run's workers
+    import config
+    from metrics import Registry
+    Registry.from_config(config).clear()
+
+
+def when_ready(server):
+    # load the lazily imported mail and alert dependencies before forking
+    import api
+    api.preload()
+
+
+def post_fork(server, worker):
+    # pooled connections must not be shared with the master
+    from database import engine, replica_engine
+    engine.dispose()
+    if replica_engine is not engine:
+        replica_engine.dispose()
+
+    # run the first health check before the status route is polled
+    import api
+    api.health_monitor.ensure_running()
+
+
+def child_exit(server, worker):
+    # fold the exited worker's metrics into the exited totals
+    import config
+    from metrics import Registry
+    Registry.from_config(config).retire(worker.pid)
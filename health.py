@@ -0,0 +1,224 @@
+from datetime import datetime
+from threading import Event, Lock, Thread
+from cache import LRUCache, RedisCache
+from models import GlobalDashboard
+import fcntl
+import logging
+import os
+import time
+
+
+log = logging.getLogger(__name__)
+
+# alert kinds
+EMAIL = 'email'
+SMS = 'sms'
+
+
+def evaluate(session):
+    """
+    Compare the two latest dashboard snapshots, unchanged unique visitors
+    trip the email alert and unchanged appends as well trip the SMS alert.
+    :param session: db session
+    :return: dict
+    """
+    g1, g2, a1, a2 = range(4)
+    dashboards = session.query(GlobalDashboard.total_unique_visitors,
+                               GlobalDashboard.total_appends).order_by(GlobalDashboard.id.desc()).limit(2).all()
+
+    for idx, dashboard in enumerate(dashboards):
+        if idx == 0:
+            g1 = int(dashboard[0])
+            a1 = int(dashboard[1])
+        else:
+            g2 = int(dashboard[0])
+            a2 = int(dashboard[1])
+
+    alerts = []
+    if g1 and g2 > 4 and g1 == g2:
+        alerts.append(EMAIL)
+        if a1 and a2 > 4 and a1 == a2:
+            alerts.append(SMS)
+
+    return {
+        "EARL Health": "ALERT" if alerts else "OK!",
+        "alerts": alerts,
+        "checked_at": datetime.now().isoformat()
+    }
+
+
+class FileStore(object):
+    """
+    Cooldown keys shared by the worker processes of one host, the time an
+    alert last fired is kept in a file per key and read and written under
+    an exclusive flock.  add() has the RedisCache.add() contract.
+    """
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+
+    def add(self, key, value):
+        """
+        :param key: alert kind
+        :param value: unused
+        :return: True if the key was free, False if it is set, None on error
+        """
+        try:
+            if not os.path.isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError:
+                    if not os.path.isdir(self.directory):
+                        raise
+
+            with open(os.path.join(self.directory, '{}.cooldown'.format(key)), 'a+') as fp:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+                fp.seek(0)
+                try:
+                    last = float(fp.read() or 0)
+                except ValueError:
+                    last = 0.0
+
+                now = time.time()
+                if now - last < self.ttl:
+                    return False
+
+                fp.seek(0)
+                fp.truncate()
+                fp.write(repr(now))
+                fp.flush()
+                return True
+
+        except (IOError, OSError) as err:
+            log.warning('health cooldown file unavailable in %s: %s', self.directory, err)
+            return None
+
+
+class Cooldown(object):
+    """
+    Per-alert cooldown, shared through redis when HEALTH_REDIS_URL is set and
+    otherwise through lock files under HEALTH_COOLDOWN_DIR, so only one worker
+    fires an alert per window.  Without redis each host keeps its own window.
+    """
+
+    def __init__(self, seconds=3600, shared=None):
+        self.seconds = seconds
+        self.local = LRUCache(maxsize=100, ttl=seconds)
+        self.shared = shared
+
+    @classmethod
+    def from_config(cls, config):
+        seconds = getattr(config, 'HEALTH_ALERT_COOLDOWN', 3600)
+        shared = None
+        redis_url = getattr(config, 'HEALTH_REDIS_URL', None)
+
+        if redis_url:
+            shared = RedisCache.from_url(redis_url, 'earl:health', seconds)
+        else:
+            shared = FileStore(getattr(config, 'HEALTH_COOLDOWN_DIR', 'var/health-cooldown'), seconds)
+
+        return cls(seconds, shared)
+
+    def acquire(self, kind):
+        """
+        :param kind: alert kind
+        :return: True if the alert may fire now
+        """
+        if self.shared is not None:
+            added = self.shared.add(kind, 1)
+            if added is not None:
+                return added
+        return self.local.add(kind, 1)
+
+
+class HealthMonitor(object):
+    """
+    Evaluates the system health on a background schedule and keeps the last
+    result, so the status endpoint never touches the database.  Tripped alerts
+    are handed to `dispatch` subject to the cooldown.  When the session is a
+    read replica, `fallback` (the primary) is used if the replica fails.
+    Until the first check of a process finishes, result() waits up to
+    `first_wait` seconds for it.
+    """
+
+    def __init__(self, session, dispatch, interval=60.0, cooldown=None, fallback=None, first_wait=5.0):
+        self.session = session
+        self.fallback = fallback if fallback is not session else None
+        self.dispatch = dispatch
+        self.interval = interval
+        self.cooldown = cooldown or Cooldown()
+        self._result = {"EARL Health": "PENDING", "alerts": [], "checked_at": None}
+        self._lock = Lock()
+        self._checked = Event()
+        self._pid = None
+        self.first_wait = first_wait
+        self.runs = 0
+        self.errors = 0
+        self.last_ms = 0.0
+
+    def ensure_running(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._checked = Event()
+                    thread = Thread(target=self._run, name='health-monitor')
+                    thread.daemon = True
+                    thread.start()
+
+    def result(self):
+        self.ensure_running()
+        self._checked.wait(self.first_wait)
+        return self._result
+
+    def _evaluate(self, session):
+        try:
+            return evaluate(session)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.remove()
+
+    def check(self):
+        started = time.time()
+        try:
+            try:
+                result = self._evaluate(self.session)
+            except Exception as err:
+                if self.fallback is None:
+                    raise
+                log.warning('health check failed on the replica, using the primary: %s', err)
+                result = self._evaluate(self.fallback)
+        except Exception as err:
+            self.errors += 1
+            log.error('health check failed: %s', err)
+            return
+
+        self.runs += 1
+        self.last_ms = (time.time() - started) * 1000.0
+        self._result = result
+
+        for kind in result['alerts']:
+            if self.cooldown.acquire(kind):
+                try:
+                    self.dispatch(kind)
+                except Exception as err:
+                    log.error('unable to dispatch the %s health alert: %s', kind, err)
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            finally:
+                self._checked.set()
+            time.sleep(self.interval)
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "interval": self.interval,
+            "last_ms": round(self.last_ms, 3)
+        }
@@ -0,0 +1,219 @@
+from datetime import datetime
+from threading import Lock
+import io
+import json
+import logging
+import os
+import socket
+import time
+
+
+log = logging.getLogger(__name__)
+
+# webhook ingest modes, see WEBHOOK_INGEST_MODE in config
+SYNC = 'sync'
+ASYNC = 'async'
+BATCH = 'batch'
+LOG = 'log'
+
+# the webhook fields the workers need to apply an event
+EVENT_FIELDS = (
+    'event',
+    'recipient',
+    'timestamp',
+    'code',
+    'reason',
+    'description',
+    'error',
+    'ip',
+    'device_type',
+    'client_type'
+)
+
+
+def compact_event(form_data):
+    """
+    Strip a verified webhook down to the fields used to update the lead
+    :param form_data: the webhook form data
+    :return: dict
+    """
+    return dict((k, form_data[k]) for k in EVENT_FIELDS if form_data.get(k) is not None)
+
+
+def write_dead_letter(directory, kind, event, error):
+    """
+    Keep an event the workers gave up on, one JSONL file per process.
+    replay.py --no-verify re-applies the file.
+    :param directory: dead letter directory
+    :param kind: one of leads.LEAD_EVENTS
+    :param event: the compact event
+    :param error: the last error
+    :return: file path
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    path = os.path.join(directory, '{}-{}.jsonl'.format(socket.gethostname(), os.getpid()))
+    line = json.dumps({"kind": kind, "data": event, "error": str(error),
+                       "failed_at": datetime.now().isoformat()}, default=str)
+
+    with io.open(path, 'a', encoding='utf-8') as f:
+        f.write(u'{}\n'.format(line))
+        f.flush()
+        os.fsync(f.fileno())
+
+    return path
+
+
+class QueueDepthProbe(object):
+    """
+    Caches the broker queue depth so the webhooks don't ask the broker on
+    every request.  A failed probe reports the queue as full.
+    """
+
+    def __init__(self, celery, queue='celery', interval=1.0):
+        self.celery = celery
+        self.queue = queue
+        self.interval = interval
+        self._depth = None
+        self._checked = 0
+        self._lock = Lock()
+
+    def _probe(self):
+        with self.celery.connection_or_acquire() as conn:
+            return conn.default_channel.queue_declare(
+                queue=self.queue, passive=True
+            ).message_count
+
+    def depth(self):
+        now = time.time()
+
+        if now - self._checked < self.interval and self._depth is not None:
+            return self._depth
+
+        with self._lock:
+            if now - self._checked >= self.interval or self._depth is None:
+                try:
+                    self._depth = self._probe()
+                except Exception as err:
+                    log.warning('unable to read the %s queue depth: %s', self.queue, err)
+                    self._depth = float('inf')
+                self._checked = now
+
+        return self._depth
+
+    def has_room(self, max_depth):
+        return self.depth() < max_depth
+
+    def add(self, n=1):
+        # count our own enqueues until the next probe
+        if self._depth is not None:
+            self._depth += n
+
+
+# posted form fields read by each lead webhook route, as (form_data key, field)
+_COMMON_FIELDS = (
+    ('domain', 'domain'),
+    ('event', 'event'),
+    ('timestamp', 'timestamp'),
+    ('recipient', 'recipient'),
+    ('signature', 'signature'),
+    ('token', 'token')
+)
+_CLIENT_FIELDS = (('ip', 'ip'), ('device_type', 'device-type'), ('client_type', 'client-type'))
+
+LEAD_FORM_FIELDS = {
+    'delivered': (('message_id', 'Message-Id'),) + _COMMON_FIELDS,
+    'dropped': (('message_id', 'Message-Id'),) + _COMMON_FIELDS + (
+        ('reason', 'reason'), ('code', 'code'), ('description', 'description')),
+    'hard-bounce': (('message_id', 'Message-Id'), ('x_mail_gun_sid', 'X-Mailgun-Sid')) + _COMMON_FIELDS + (
+        ('code', 'code'), ('error', 'error')),
+    'spam-complaint': (('message_id', 'Message-Id'),) + _COMMON_FIELDS,
+    'unsubscribe': _COMMON_FIELDS,
+    'click': _COMMON_FIELDS + _CLIENT_FIELDS,
+    'open': _COMMON_FIELDS + _CLIENT_FIELDS
+}
+
+# every field a lead webhook route reads, the rest of the body is discarded
+WEBHOOK_FORM_FIELDS = frozenset(field for fields in LEAD_FORM_FIELDS.values() for _, field in fields)
+
+
+def lead_form_data(kind, form):
+    """
+    The form_data a lead webhook route builds from the posted form
+    :param kind: one of leads.LEAD_EVENTS
+    :param form: mapping of posted fields
+    :return: dict
+    """
+    return dict((key, form.get(field)) for key, field in LEAD_FORM_FIELDS[kind])
+
+
+# legacy form webhook event names mapped to the lead webhook kinds
+FORM_EVENTS = {
+    'delivered': 'delivered',
+    'dropped': 'dropped',
+    'bounced': 'hard-bounce',
+    'complained': 'spam-complaint',
+    'unsubscribed': 'unsubscribe',
+    'clicked': 'click',
+    'opened': 'open'
+}
+
+# Mailgun event-data names mapped to the lead webhook kinds
+JSON_EVENTS = {
+    'delivered': 'delivered',
+    'opened': 'open',
+    'clicked': 'click',
+    'unsubscribed': 'unsubscribe',
+    'complained': 'spam-complaint'
+}
+
+
+def _object(value):
+    # relayed payloads are not trusted to nest objects where Mailgun does
+    return value if isinstance(value, dict) else {}
+
+
+def event_from_json(item):
+    """
+    Convert a Mailgun {"signature": ..., "event-data": ...} payload to the
+    form fields the lead webhooks use.
+    :param item: dict
+    :return: (kind or None, form_data)
+    """
+    signature = _object(item.get('signature'))
+    event_data = _object(item.get('event-data'))
+    headers = _object(_object(event_data.get('message')).get('headers'))
+    client = _object(event_data.get('client-info'))
+    status = _object(event_data.get('delivery-status'))
+    event = event_data.get('event')
+
+    form_data = {
+        "message_id": headers.get('message-id'),
+        "event": event,
+        "timestamp": signature.get('timestamp'),
+        "token": signature.get('token'),
+        "signature": signature.get('signature'),
+        "recipient": event_data.get('recipient'),
+        "ip": event_data.get('ip'),
+        "device_type": client.get('device-type'),
+        "client_type": client.get('client-type'),
+        "code": status.get('code'),
+        "description": status.get('description'),
+        "reason": event_data.get('reason'),
+        "error": status.get('message')
+    }
+
+    kind = JSON_EVENTS.get(event)
+
+    # only permanent failures change the lead, temporary ones are retried by Mailgun
+    if event == 'failed' and event_data.get('severity') == 'permanent':
+        if event_data.get('reason') in ('bounce', 'suppress-bounce'):
+            kind, form_data['event'] = 'hard-bounce', 'bounced'
+        else:
+            kind, form_data['event'] = 'dropped', 'dropped'
+
+    if form_data['code'] is not None:
+        form_data['code'] = str(form_data['code'])
+
+    return kind, form_data
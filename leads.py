@@ -0,0 +1,358 @@
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import event, func, inspect, select
+from cache import RecipientCache, NegativeCache, Watermark
+from dashboards import deltas as dashboard_deltas
+from rollups import deltas as rollup_deltas
+from models import Lead, LeadEvent, AppendedVisitor
+import config
+
+
+# the Mailgun lead webhooks, keyed by the route suffix
+LEAD_EVENTS = (
+    'delivered',
+    'dropped',
+    'hard-bounce',
+    'spam-complaint',
+    'unsubscribe',
+    'click',
+    'open'
+)
+
+# event kinds that increment a counter column, and the column
+COUNTERS = {
+    'open': 'followup_email_opens',
+    'click': 'followup_email_clicks'
+}
+
+RecipientLead = namedtuple('RecipientLead', ['lead_id', 'appended_visitor_id', 'email'])
+
+# recipient email -> (appended_visitor_id, lead_id)
+recipient_cache = RecipientCache.from_config(config)
+
+# append each event to lead_events, Lead then keeps only flags and counters
+record_events = getattr(config, 'LEAD_EVENTS_ENABLED', False)
+
+# recipients known not to match any appended visitor
+unknown_recipients = NegativeCache.from_config(config)
+
+# MAX(appendedvisitors.id), the generation of unknown_recipients, so an
+# appended visitor makes every cached unknown recipient resolve again
+visitor_watermark = Watermark(getattr(config, 'UNKNOWN_RECIPIENT_WATERMARK_INTERVAL', 1.0))
+
+
+def recipient_select(recipient):
+    """
+    The projected join resolving a recipient to its newest lead
+    :param recipient: the recipient email address
+    :return: select of (lead_id, appended_visitor_id, email)
+    """
+    visitors = AppendedVisitor.__table__
+    leads = Lead.__table__
+
+    return select([
+        leads.c.id.label('lead_id'),
+        visitors.c.id.label('appended_visitor_id'),
+        visitors.c.email
+    ]).select_from(
+        visitors.outerjoin(leads, leads.c.appended_visitor_id == visitors.c.id)
+    ).where(
+        visitors.c.email == recipient
+    ).order_by(
+        leads.c.id.desc()
+    ).limit(1)
+
+
+def visitor_watermark_select():
+    return select([func.max(AppendedVisitor.__table__.c.id)])
+
+
+def visitor_generation(session):
+    """
+    The unknown recipient generation, read at most once a watermark interval
+    :param session: db session
+    :return: int
+    """
+    return visitor_watermark.get(lambda: session.execute(visitor_watermark_select()).scalar() or 0)
+
+
+def resolve_recipient(session, recipient):
+    """
+    Resolve a Mailgun recipient email to its lead with one projected join.
+    lead_id is None when the appended visitor exists without a lead.
+    :param session: db session
+    :param recipient: the recipient email address
+    :return: row (lead_id, appended_visitor_id, email) or None
+    """
+    return session.execute(recipient_select(recipient)).first()
+
+
+def lookup_recipient(session, recipient):
+    """
+    Resolve a recipient through the recipient cache, falling back to the database.
+    Only recipients that resolve to a lead are cached, unknown recipients
+    are remembered until the next appended visitor, so Mailgun retries skip
+    the recipient join.
+    :param session: db session
+    :param recipient: the recipient email address
+    :return: RecipientLead or None
+    """
+    if not recipient:
+        return None
+
+    cached = recipient_cache.get(recipient)
+
+    if cached is not None:
+        return RecipientLead(cached[1], cached[0], recipient)
+
+    generation = visitor_generation(session)
+
+    if unknown_recipients.contains(recipient, generation):
+        return None
+
+    row = resolve_recipient(session, recipient)
+
+    if row is None:
+        unknown_recipients.add(recipient, generation)
+
+    elif row.lead_id is not None:
+        recipient_cache.set(recipient, row.appended_visitor_id, row.lead_id)
+
+    return row
+
+
+def invalidate_recipient(email):
+    """
+    Drop a recipient from the lookup cache
+    :param email:
+    :return: None
+    """
+    recipient_cache.invalidate(email)
+
+
+def invalidate_lead(lead_id):
+    """
+    Drop the cached recipient of a lead, call this when a lead is reassigned
+    :param lead_id:
+    :return: None
+    """
+    recipient_cache.invalidate_lead(lead_id)
+
+
+def forget_unknown_recipient(email):
+    """
+    Allow a recipient cached as unknown to be looked up again.  Only this
+    process and the shared store are cleared, other workers drop their
+    local entry once their watermark moves past the new appended visitor.
+    :param email:
+    :return: None
+    """
+    unknown_recipients.discard(email)
+    visitor_watermark.expire()
+
+
+def lead_event_values(kind, data):
+    """
+    Build the Lead column values for a webhook event.
+    :param kind: one of LEAD_EVENTS
+    :param data: the webhook form data
+    :return: dict of column name to value
+    """
+    values = {
+        'followup_email_status': data['event'],
+        'webhook_last_update': datetime.now()
+    }
+
+    if kind == 'delivered':
+        values['followup_email_delivered'] = 1
+
+    elif kind == 'dropped':
+        values['followup_email_delivered'] = 0
+        values['followup_email_dropped'] = 1
+        values['dropped_code'] = data.get('code')
+        values['dropped_reason'] = data.get('reason')
+        values['dropped_description'] = data.get('description')
+
+    elif kind == 'hard-bounce':
+        values['followup_email_delivered'] = 0
+        values['followup_email_bounced'] = 1
+        values['dropped_code'] = data.get('code')
+        values['bounce_error'] = data.get('error')
+
+    elif kind == 'spam-complaint':
+        values['followup_email_delivered'] = 0
+        values['followup_email_spam'] = 1
+
+    elif kind == 'unsubscribe':
+        values['followup_email_delivered'] = 0
+        values['followup_email_unsub'] = 1
+
+    elif kind == 'click':
+        values['followup_email_delivered'] = 0
+        if not record_events:
+            values['followup_email_click_ip'] = data.get('ip')
+            values['followup_email_click_device'] = data.get('device_type')
+            values['followup_email_click_campaign'] = data.get('client_type')
+
+    elif kind == 'open':
+        values['followup_email_delivered'] = 0
+        if not record_events:
+            values['followup_email_open_ip'] = data.get('ip')
+            values['followup_email_open_campaign'] = data.get('client_type')
+            values['followup_email_open_device'] = data.get('device_type')
+
+    else:
+        raise ValueError('Unknown lead event: {}'.format(kind))
+
+    return values
+
+
+def event_time(data):
+    """
+    :param data: the webhook form data
+    :return: datetime of the Mailgun timestamp, now when it is missing
+    """
+    try:
+        return datetime.fromtimestamp(int(data.get('timestamp')))
+    except (TypeError, ValueError):
+        return datetime.now()
+
+
+def lead_event_row(lead_id, kind, data):
+    """
+    A lead_events row for a webhook event, stamped with the Mailgun timestamp
+    :param lead_id:
+    :param kind: one of LEAD_EVENTS
+    :param data: the webhook form data
+    :return: dict
+    """
+    return {
+        "lead_id": lead_id,
+        "event": kind,
+        "ts": event_time(data),
+        "ip": data.get('ip'),
+        "device": data.get('device_type'),
+        "client": data.get('client_type')
+    }
+
+
+def insert_lead_events(session, rows):
+    """
+    Bulk insert lead_events rows with a single multi-row INSERT
+    :param session: db session
+    :param rows: list of dicts from lead_event_row()
+    :return: None
+    """
+    if rows:
+        session.execute(LeadEvent.__table__.insert(), rows)
+
+
+def prune_lead_events(session, before, chunk=10000):
+    """
+    Delete lead_events older than a cutoff in primary key chunks, so each
+    delete is a short range scan on the ts index
+    :param session: db session
+    :param before: datetime cutoff
+    :param chunk: rows per delete
+    :return: number of rows deleted
+    """
+    table = LeadEvent.__table__
+    deleted = 0
+
+    while True:
+        ids = [row[0] for row in session.query(LeadEvent.id).filter(
+            LeadEvent.ts < before
+        ).order_by(LeadEvent.ts).limit(chunk)]
+
+        if not ids:
+            return deleted
+
+        session.execute(table.delete().where(table.c.id.in_(ids)))
+        session.commit()
+        deleted += len(ids)
+
+
+def increment(column, n=1):
+    """
+    Server-side counter increment, col = COALESCE(col, 0) + :n
+    :param column: the counter column
+    :param n: int or bind parameter
+    :return: sql expression
+    """
+    return func.coalesce(column, 0) + n
+
+
+def lead_update(lead_id, kind, data):
+    """
+    The single targeted UPDATE applying a webhook event to a lead
+    :param lead_id: the lead primary key
+    :param kind: one of LEAD_EVENTS
+    :param data: the webhook form data
+    :return: update statement
+    """
+    table = Lead.__table__
+    values = lead_event_values(kind, data)
+
+    # counters are incremented in the database, no read required
+    if kind in COUNTERS:
+        column = COUNTERS[kind]
+        values[column] = increment(table.c[column])
+
+    return table.update().where(table.c.id == lead_id).values(**values)
+
+
+def update_lead(session, lead_id, kind, data):
+    """
+    Apply a webhook event to a lead with a single targeted UPDATE, the
+    caller commits and then calls lead_event_committed().
+    :param session: db session
+    :param lead_id: the lead primary key
+    :param kind: one of LEAD_EVENTS
+    :param data: the webhook form data
+    :return: number of rows matched
+    """
+    if record_events:
+        insert_lead_events(session, [lead_event_row(lead_id, kind, data)])
+
+    return session.execute(lead_update(lead_id, kind, data)).rowcount
+
+
+def lead_event_committed(lead_id, kind, ts):
+    """
+    Count an applied webhook event in the dashboard and rollup deltas.  Call
+    it after the transaction commits, a rolled back event must not be counted.
+    :param lead_id:
+    :param kind: one of LEAD_EVENTS
+    :param ts: the event time, from event_time()
+    :return: None
+    """
+    dashboard_deltas.lead_event(lead_id, kind)
+    rollup_deltas.lead_event(lead_id, kind, ts)
+
+
+@event.listens_for(Lead, 'after_update')
+def _lead_reassigned(mapper, connection, target):
+    if inspect(target).attrs.appended_visitor_id.history.has_changes():
+        invalidate_lead(target.id)
+
+
+@event.listens_for(Lead, 'after_delete')
+def _lead_deleted(mapper, connection, target):
+    invalidate_lead(target.id)
+
+
+@event.listens_for(AppendedVisitor, 'after_insert')
+def _appended_visitor_inserted(mapper, connection, target):
+    if target.email:
+        forget_unknown_recipient(target.email)
+
+
+@event.listens_for(AppendedVisitor, 'after_update')
+def _appended_visitor_changed(mapper, connection, target):
+    history = inspect(target).attrs.email.history
+    for email in (history.deleted or ()):
+        if email:
+            invalidate_recipient(email)
+    for email in (history.added or ()):
+        if email:
+            forget_unknown_recipient(email)
@@ -0,0 +1,308 @@
+"""
+In-process counters and histograms, rendered in the Prometheus text format.
+
+Each worker process writes a snapshot of its metrics to METRICS_DIR every
+few seconds; the scrape endpoint sums the snapshots of every worker so the
+numbers are correct behind a multi-process server.  The gunicorn hooks in
+gunicorn.conf.py clear the directory when the master starts and fold the
+snapshot of each exited worker into metrics-exited.json.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock, Thread
+import glob
+import json
+import logging
+import os
+import time
+
+
+log = logging.getLogger(__name__)
+
+# seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+# relative to the deployment's working directory, like the other var/ paths
+DEFAULT_DIRECTORY = 'var/metrics'
+EXITED = 'exited'
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+def _sum(snapshots):
+    """
+    :param snapshots: snapshot dicts
+    :return: (counters, histograms) dicts keyed by (name, labels)
+    """
+    counters = defaultdict(float)
+    histograms = {}
+    for snap in snapshots:
+        for name, labels, value in snap['counters']:
+            counters[(name, tuple(tuple(pair) for pair in labels))] += value
+        for name, labels, counts, total in snap['histograms']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            hist = histograms.setdefault(key, [[0] * len(counts), 0.0])
+            if len(hist[0]) != len(counts):
+                continue
+            for idx, n in enumerate(counts):
+                hist[0][idx] += n
+            hist[1] += total
+    return counters, histograms
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Registry(object):
+    """
+    Counters and fixed-bucket histograms keyed by name and labels.  The lock
+    is only held for the dict updates.
+    """
+
+    def __init__(self, directory=None, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.descriptions = {}
+        self.buckets = {}
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._collectors = []
+        self._lock = Lock()
+        self._pid = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(getattr(config, 'METRICS_DIR', DEFAULT_DIRECTORY), getattr(config, 'METRICS_FLUSH_INTERVAL', 5.0))
+
+    def counter(self, name, text):
+        self.descriptions[name] = (COUNTER, text)
+
+    def histogram(self, name, text, buckets=DEFAULT_BUCKETS):
+        self.descriptions[name] = (HISTOGRAM, text)
+        self.buckets[name] = tuple(buckets)
+
+    def register_collector(self, collector):
+        """
+        A callable returning (name, labels dict, value) tuples of cumulative
+        counters read at snapshot time, e.g. cache hits
+        :param collector: callable
+        :return: None
+        """
+        self._collectors.append(collector)
+
+    def _ensure_process(self):
+        # a forked worker starts from zero instead of inheriting the parent's counts
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._counters = defaultdict(float)
+                    self._histograms = {}
+                    self._pid = os.getpid()
+                    if self.directory:
+                        thread = Thread(target=self._run, name='metrics-snapshot')
+                        thread.daemon = True
+                        thread.start()
+
+    def inc(self, name, n=1, **labels):
+        self._ensure_process()
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] += n
+
+    def observe(self, name, value, **labels):
+        self._ensure_process()
+        buckets = self.buckets.get(name, DEFAULT_BUCKETS)
+        idx = bisect_left(buckets, value)
+        key = (name, _labels(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+            hist[0][idx] += 1
+            hist[1] += value
+
+    def snapshot(self):
+        """
+        :return: json serializable dict of this process's metrics
+        """
+        with self._lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, list(labels), list(hist[0]), hist[1]]
+                          for (name, labels), hist in self._histograms.items()]
+
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    counters.append([name, list(_labels(labels)), value])
+            except Exception as err:
+                log.error('metrics collector failed: %s', err)
+
+        return {"pid": os.getpid(), "counters": counters, "histograms": histograms}
+
+    def _path(self, pid):
+        return os.path.join(self.directory, 'metrics-{}.json'.format(pid))
+
+    def _write(self, path, snapshot):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f)
+        os.rename(tmp, path)
+
+    def write_snapshot(self):
+        self._write(self._path(os.getpid()), self.snapshot())
+
+    def _load(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError) as err:
+            log.warning('skipping metrics snapshot %s: %s', path, err)
+            return None
+
+    def clear(self):
+        """
+        Remove every snapshot, called when the gunicorn master starts so a
+        restart doesn't count the previous run's workers
+        :return: number of files removed
+        """
+        if not self.directory:
+            return 0
+        removed = 0
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json*')):
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def retire(self, pid):
+        """
+        Fold the snapshot of an exited worker into the exited totals and
+        remove it, so the directory doesn't grow with every worker restart
+        and the summed counters never drop
+        :param pid: the exited worker's pid
+        :return: None
+        """
+        if not self.directory:
+            return
+        path = self._path(pid)
+        if not os.path.exists(path):
+            return
+
+        snapshots = [snap for snap in (self._load(self._path(EXITED)), self._load(path)) if snap]
+        counters, histograms = _sum(snapshots)
+        self._write(self._path(EXITED), {
+            "pid": EXITED,
+            "counters": [[name, list(labels), value] for (name, labels), value in counters.items()],
+            "histograms": [[name, list(labels), hist[0], hist[1]] for (name, labels), hist in histograms.items()]
+        })
+        os.remove(path)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.write_snapshot()
+            except (IOError, OSError) as err:
+                log.error('unable to write the metrics snapshot: %s', err)
+
+    def collect(self):
+        """
+        Sum this process's live metrics with the last snapshot of every other
+        worker and the exited workers' totals, see retire().
+        :return: (counters, histograms) dicts keyed by (name, labels)
+        """
+        self._ensure_process()
+        snapshots = [self.snapshot()]
+
+        if self.directory:
+            own = self._path(os.getpid())
+            for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+                if path == own:
+                    continue
+                snap = self._load(path)
+                if snap is not None:
+                    snapshots.append(snap)
+
+        return _sum(snapshots)
+
+    def render(self):
+        """
+        :return: the Prometheus text exposition of every worker's metrics
+        """
+        counters, histograms = self.collect()
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name in described:
+                return
+            described.add(name)
+            text = self.descriptions.get(name, (kind, name))[1]
+            lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels) in sorted(counters):
+            describe(name, COUNTER)
+            lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(counters[(name, labels)])))
+
+        for (name, labels) in sorted(histograms):
+            describe(name, HISTOGRAM)
+            counts, total = histograms[(name, labels)]
+            bounds = self.buckets.get(name, DEFAULT_BUCKETS) + (float('inf'),)
+            cumulative = 0
+            for bound, n in zip(bounds, counts):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, [('le', _format_value(bound))]),
+                                                     cumulative))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), repr(total)))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), cumulative))
+
+        return '\n'.join(lines) + '\n'
+
+
+def cache_collector(name, cache):
+    """
+    Hits and misses of an LRUCache or RedisCache as collector values
+    :param name: cache label
+    :param cache: object with hits and misses
+    :return: collector callable
+    """
+    def collect():
+        return [
+            ('earl_cache_hits_total', {"cache": name}, cache.hits),
+            ('earl_cache_misses_total', {"cache": name}, cache.misses)
+        ]
+    return collect
+
+
+def signature_collector(verifier):
+    """
+    Results and total time of a SignatureVerifier as collector values, the
+    average check time is the seconds total over the checks total
+    :param verifier: signatures.SignatureVerifier
+    :return: collector callable
+    """
+    def collect():
+        values = [('earl_signature_checks_total', {"result": result}, n) for result, n in verifier.counts.items()]
+        values.append(('earl_signature_check_seconds_total', {}, verifier.total_us / 1000000.0))
+        return values
+    return collect
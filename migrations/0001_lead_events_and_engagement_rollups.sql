@@ -0,0 +1,37 @@
+-- lead_events (models.LeadEvent) and engagement_rollups (models.EngagementRollup)
+--
+--     mysql earl < migrations/0001_lead_events_and_engagement_rollups.sql
+--
+-- lead_events is append-only and pruned by ts, see python rollups.py prune-events.
+
+CREATE TABLE IF NOT EXISTS lead_events (
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    lead_id INTEGER NOT NULL,
+    event VARCHAR(20) NOT NULL,
+    ts DATETIME NOT NULL,
+    ip VARCHAR(45),
+    device VARCHAR(50),
+    client VARCHAR(50),
+    PRIMARY KEY (id),
+    KEY ix_lead_events_lead_id_ts (lead_id, ts),
+    KEY ix_lead_events_ts (ts),
+    FOREIGN KEY (lead_id) REFERENCES leads (id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE IF NOT EXISTS engagement_rollups (
+    id INTEGER NOT NULL AUTO_INCREMENT,
+    campaign_id INTEGER NOT NULL,
+    granularity VARCHAR(5) NOT NULL DEFAULT 'hour',
+    bucket DATETIME NOT NULL,
+    visitors INTEGER NOT NULL DEFAULT 0,
+    appends INTEGER NOT NULL DEFAULT 0,
+    deliveries INTEGER NOT NULL DEFAULT 0,
+    opens INTEGER NOT NULL DEFAULT 0,
+    clicks INTEGER NOT NULL DEFAULT 0,
+    bounces INTEGER NOT NULL DEFAULT 0,
+    rvms INTEGER NOT NULL DEFAULT 0,
+    last_update DATETIME,
+    PRIMARY KEY (id),
+    UNIQUE KEY ix_engagement_rollups_bucket (campaign_id, granularity, bucket),
+    FOREIGN KEY (campaign_id) REFERENCES campaigns (id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
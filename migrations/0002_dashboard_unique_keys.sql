@@ -0,0 +1,8 @@
+-- one campaign_dashboard row per campaign and one store_dashboard row per
+-- store, the dashboard deltas upsert on these keys.  Rebuild the tables
+-- with python recompute.py first if the old merge left duplicates.
+--
+--     mysql earl < migrations/0002_dashboard_unique_keys.sql
+
+ALTER TABLE campaign_dashboard ADD UNIQUE KEY uq_campaign_dashboard_campaign_id (campaign_id);
+ALTER TABLE store_dashboard ADD UNIQUE KEY uq_store_dashboard_store_id (store_id);
@@ -1,6 +1,6 @@
 from database import Base
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, Text, Float
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, DateTime, Boolean, Text, Float, Index
 from sqlalchemy.orm import relationship
 from werkzeug.security import generate_password_hash, check_password_hash
 # Define application Bases
@@ -205,6 +205,53 @@ class Lead(Base):
         )
 
 
+class LeadEvent(Base):
+    __tablename__ = 'lead_events'
+    __table_args__ = (
+        Index('ix_lead_events_lead_id_ts', 'lead_id', 'ts'),
+    )
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    lead_id = Column(Integer, ForeignKey('leads.id'), nullable=False)
+    event = Column(String(20), nullable=False)
+    ts = Column(DateTime, nullable=False, index=True)
+    ip = Column(String(45))
+    device = Column(String(50))
+    client = Column(String(50))
+
+    def __repr__(self):
+        return '{} {} {}'.format(
+            self.lead_id,
+            self.event,
+            str(self.ts)
+        )
+
+
+class EngagementRollup(Base):
+    __tablename__ = 'engagement_rollups'
+    __table_args__ = (
+        Index('ix_engagement_rollups_bucket', 'campaign_id', 'granularity', 'bucket', unique=True),
+    )
+    id = Column(Integer, primary_key=True)
+    campaign_id = Column(Integer, ForeignKey('campaigns.id'), nullable=False)
+    granularity = Column(String(5), nullable=False, default='hour')
+    bucket = Column(DateTime, nullable=False)
+    visitors = Column(Integer, default=0, nullable=False)
+    appends = Column(Integer, default=0, nullable=False)
+    deliveries = Column(Integer, default=0, nullable=False)
+    opens = Column(Integer, default=0, nullable=False)
+    clicks = Column(Integer, default=0, nullable=False)
+    bounces = Column(Integer, default=0, nullable=False)
+    rvms = Column(Integer, default=0, nullable=False)
+    last_update = Column(DateTime, onupdate=datetime.now, nullable=True)
+
+    def __repr__(self):
+        return '{} {} {}'.format(
+            self.campaign_id,
+            self.granularity,
+            str(self.bucket)
+        )
+
+
 class Store(Base):
     __tablename__ = 'stores'
     id = Column(Integer, primary_key=True)
@@ -338,7 +385,7 @@ class GlobalDashboard(Base):
 class StoreDashboard(Base):
     __tablename__ = 'store_dashboard'
     id = Column(Integer, primary_key=True)
-    store_id = Column(Integer, ForeignKey('stores.id'))
+    store_id = Column(Integer, ForeignKey('stores.id'), unique=True)
     store_name = relationship("Store")
     total_campaigns = Column(Integer, default=0, nullable=False)
     active_campaigns = Column(Integer, default=0, nullable=False)
@@ -363,7 +410,7 @@ class CampaignDashboard(Base):
     id = Column(Integer, primary_key=True)
     store_id = Column(Integer, ForeignKey('stores.id'), nullable=False)
     store_name = relationship("Store")
-    campaign_id = Column(Integer, ForeignKey('campaigns.id'), nullable=False)
+    campaign_id = Column(Integer, ForeignKey('campaigns.id'), nullable=False, unique=True)
     campaign_name = relationship("Campaign")
     total_visitors = Column(Integer, default=0, nullable=True)
     total_appends = Column(Integer, default=0, nullable=True)
@@ -0,0 +1,116 @@
+"""
+SQLAlchemy engine listeners timing every statement.  While a request is
+being profiled the statement count, commits, total database time and the
+slowest statement are collected for it; statements over the slow threshold
+are logged with their parameters redacted, in or out of a request.
+"""
+from sqlalchemy import event
+from threading import local
+import json
+import logging
+import time
+
+
+log = logging.getLogger(__name__)
+slow_log = logging.getLogger(__name__ + '.slow')
+
+# characters of SQL kept in log lines
+MAX_SQL = 500
+
+
+def redact(parameters):
+    """
+    Keep the shape of the bound parameters, never their values
+    :param parameters: dict, sequence, or list of them for executemany
+    :return: json serializable description
+    """
+    if isinstance(parameters, dict):
+        return dict((key, type(value).__name__) for key, value in parameters.items())
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return {"rows": len(parameters), "first": redact(parameters[0])}
+        return [type(value).__name__ for value in parameters]
+    return None
+
+
+def _sql(statement):
+    return ' '.join(statement.split())[:MAX_SQL]
+
+
+class QueryProfiler(object):
+    """
+    Per-thread statement statistics for the current request.
+    """
+
+    def __init__(self, slow_ms=100.0):
+        self.slow_ms = slow_ms
+        self._local = local()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(slow_ms=getattr(config, 'SLOW_QUERY_MS', 100.0))
+
+    def start(self):
+        self._local.stats = {
+            "db_statements": 0,
+            "db_commits": 0,
+            "db_ms": 0.0,
+            "slowest_ms": 0.0,
+            "slowest_sql": None
+        }
+
+    def stop(self):
+        """
+        :return: the statistics since start(), or None
+        """
+        stats = getattr(self._local, 'stats', None)
+        self._local.stats = None
+        if stats is not None:
+            stats['db_ms'] = round(stats['db_ms'], 3)
+            stats['slowest_ms'] = round(stats['slowest_ms'], 3)
+        return stats
+
+    def install(self, target):
+        """
+        :param target: the engine behind db_session, or the Engine class
+        :return: self
+        """
+        event.listen(target, 'before_cursor_execute', self._before)
+        event.listen(target, 'after_cursor_execute', self._after)
+        event.listen(target, 'handle_error', self._error)
+        event.listen(target, 'commit', self._commit)
+        return self
+
+    @staticmethod
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.time())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = (time.time() - conn.info['query_started'].pop()) * 1000.0
+        stats = getattr(self._local, 'stats', None)
+
+        if stats is not None:
+            stats['db_statements'] += 1
+            stats['db_ms'] += elapsed
+            if elapsed > stats['slowest_ms']:
+                stats['slowest_ms'] = elapsed
+                stats['slowest_sql'] = _sql(statement)
+
+        if elapsed >= self.slow_ms:
+            slow_log.warning(json.dumps({
+                "ms": round(elapsed, 3),
+                "sql": _sql(statement),
+                "params": redact(parameters),
+                "executemany": executemany
+            }))
+
+    @staticmethod
+    def _error(context):
+        started = context.connection.info.get('query_started') if context.connection is not None else None
+        if started:
+            started.pop()
+
+    def _commit(self, conn):
+        stats = getattr(self._local, 'stats', None)
+        if stats is not None:
+            stats['db_commits'] += 1
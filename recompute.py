@@ -0,0 +1,187 @@
+"""
+Rebuild the global, store and campaign dashboards from one grouped pass over
+visitors, appended visitors and leads.
+
+    python recompute.py
+"""
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import and_, case, distinct, func
+from database import db_session
+from dashboards import DELIVERED_STATUSES
+from models import (AppendedVisitor, Campaign, CampaignDashboard, GlobalDashboard, Lead, Store,
+                    StoreDashboard, Visitor)
+import json
+import time
+
+
+# per campaign counters read by the grouped pass
+FIELDS = (
+    'total_visitors',
+    'unique_visitors',
+    'us_visitors',
+    'appends',
+    'unique_appends',
+    'us_appends',
+    'sent_to_dealer',
+    'followup_emails',
+    'rvms'
+)
+
+
+def rate(part, whole):
+    # append rates are stored as percentages
+    return round(part * 100.0 / whole, 2) if whole else 0.0
+
+
+def campaign_totals(session, chunk=1000):
+    """
+    Stream one row of counters per campaign, with the store that owns the
+    campaign; visitors.store_id is nullable, campaign_dashboard.store_id isn't
+    :param session: db session
+    :param chunk: rows fetched per round trip
+    :return: generator of (store_id, campaign_id, dict)
+    """
+    is_us = Visitor.country_code == 'US'
+    query = session.query(
+        Campaign.store_id,
+        Visitor.campaign_id,
+        func.count(distinct(Visitor.id)),
+        func.count(distinct(Visitor.ip)),
+        func.count(distinct(case([(is_us, Visitor.id)]))),
+        func.count(distinct(AppendedVisitor.id)),
+        func.count(distinct(case([(AppendedVisitor.id.isnot(None), Visitor.ip)]))),
+        func.count(distinct(case([(and_(is_us, AppendedVisitor.id.isnot(None)), AppendedVisitor.id)]))),
+        func.sum(case([(Lead.sent_to_dealer == True, 1)], else_=0)),  # noqa: E712
+        func.sum(case([(Lead.followup_email_status.in_(DELIVERED_STATUSES), 1)], else_=0)),
+        func.sum(case([(Lead.rvm_sent == True, 1)], else_=0))  # noqa: E712
+    ).join(
+        Campaign, Campaign.id == Visitor.campaign_id
+    ).outerjoin(
+        AppendedVisitor, AppendedVisitor.visitor == Visitor.id
+    ).outerjoin(
+        Lead, Lead.appended_visitor_id == AppendedVisitor.id
+    ).group_by(
+        Campaign.store_id, Visitor.campaign_id
+    ).execution_options(stream_results=True).yield_per(chunk)
+
+    for row in query:
+        yield row[0], row[1], dict(zip(FIELDS, [int(v or 0) for v in row[2:]]))
+
+
+def campaign_counts(session):
+    """
+    :param session: db session
+    :return: dict of store_id -> (total campaigns, active campaigns)
+    """
+    rows = session.query(
+        Campaign.store_id,
+        func.count(Campaign.id),
+        func.sum(case([(func.lower(Campaign.status) == 'active', 1)], else_=0))
+    ).group_by(Campaign.store_id)
+    return dict((row[0], (int(row[1] or 0), int(row[2] or 0))) for row in rows)
+
+
+def recompute(session):
+    """
+    Rebuild campaign_dashboard and store_dashboard and add a new dashboard
+    snapshot, in one transaction.  Store and global unique visitors are the
+    sum of the per-campaign unique visitors.
+    :param session: db session
+    :return: dict timing report
+    """
+    started = time.time()
+    now = datetime.now()
+    campaigns = []
+    stores = defaultdict(lambda: defaultdict(int))
+    totals = defaultdict(int)
+    rows = 0
+
+    for store_id, campaign_id, counts in campaign_totals(session):
+        rows += 1
+        campaigns.append({
+            "store_id": store_id,
+            "campaign_id": campaign_id,
+            "total_visitors": counts['total_visitors'],
+            "total_appends": counts['appends'],
+            "total_rtns": counts['sent_to_dealer'],
+            "total_followup_emails": counts['followup_emails'],
+            "total_rvms": counts['rvms'],
+            "append_rate": rate(counts['appends'], counts['total_visitors']),
+            "last_update": now
+        })
+        for name, n in counts.items():
+            stores[store_id][name] += n
+            totals[name] += n
+
+    per_store = campaign_counts(session)
+    stores_total = session.query(func.count(Store.id)).scalar() or 0
+    stores_active = session.query(func.count(Store.id)).filter(Store.status == 'Active').scalar() or 0
+    read_ms = (time.time() - started) * 1000.0
+
+    store_rows = []
+    for store_id, counts in stores.items():
+        total_campaigns, active_campaigns = per_store.get(store_id, (0, 0))
+        store_rows.append(dashboard_row(counts, now, store_id=store_id, total_campaigns=total_campaigns,
+                                        active_campaigns=active_campaigns))
+
+    global_row = dashboard_row(
+        totals, now,
+        total_stores=stores_total,
+        active_stores=stores_active,
+        total_campaigns=sum(c[0] for c in per_store.values()),
+        active_campaigns=sum(c[1] for c in per_store.values())
+    )
+
+    write_started = time.time()
+    session.execute(CampaignDashboard.__table__.delete())
+    session.execute(StoreDashboard.__table__.delete())
+    if campaigns:
+        session.execute(CampaignDashboard.__table__.insert(), campaigns)
+    if store_rows:
+        session.execute(StoreDashboard.__table__.insert(), store_rows)
+    session.execute(GlobalDashboard.__table__.insert(), [global_row])
+    session.commit()
+    write_ms = (time.time() - write_started) * 1000.0
+
+    return {
+        "groups": rows,
+        "campaigns": len(campaigns),
+        "stores": len(store_rows),
+        "visitors": totals['total_visitors'],
+        "appends": totals['appends'],
+        "read_ms": round(read_ms, 2),
+        "write_ms": round(write_ms, 2),
+        "total_ms": round((time.time() - started) * 1000.0, 2)
+    }
+
+
+def dashboard_row(counts, now, **extra):
+    """
+    Store and global dashboard columns from summed campaign counters
+    :param counts: dict of FIELDS
+    :param now: last_update
+    :return: dict
+    """
+    row = {
+        "total_global_visitors": counts['total_visitors'],
+        "total_unique_visitors": counts['unique_visitors'],
+        "total_us_visitors": counts['us_visitors'],
+        "total_appends": counts['appends'],
+        "total_sent_to_dealer": counts['sent_to_dealer'],
+        "total_sent_followup_emails": counts['followup_emails'],
+        "total_rvms_sent": counts['rvms'],
+        "global_append_rate": rate(counts['appends'], counts['total_visitors']),
+        "unique_append_rate": rate(counts['unique_appends'], counts['unique_visitors']),
+        "us_append_rate": rate(counts['us_appends'], counts['us_visitors']),
+        "last_update": now
+    }
+    row.update(extra)
+    return row
+
+
+if __name__ == '__main__':
+    try:
+        print(json.dumps(recompute(db_session)))
+    finally:
+        db_session.remove()
@@ -0,0 +1,282 @@
+"""
+Re-apply recorded Mailgun webhook events to the leads table.
+
+    python replay.py events.jsonl [more.jsonl ...] [--workers 8] [--batch 2000]
+    python replay.py --log var/webhook-log
+    python replay.py --no-verify var/webhook-dead-letter/*.jsonl
+
+JSONL lines are either webhook form fields (with an optional "kind"), read
+through ingest.lead_form_data like the lead routes, or Mailgun
+{"signature", "event-data"} payloads; --log reads the durable event log
+written by the 'log' ingest mode.  Dead letters from the async mode carry
+no signature, so they need --no-verify.  Events are verified, deduplicated
+and sharded by recipient, so every event for a lead is applied by the same
+worker, in order.
+
+Replayed events are not counted in the dashboard and rollup deltas unless
+--deltas is given; rebuild them with recompute.py and rollups.py hourly.
+"""
+from collections import OrderedDict
+from multiprocessing import Process, Queue
+from batching import PendingLead, flush_pending
+from database import db_session
+from dashboards import deltas as dashboard_deltas
+from rollups import deltas as rollup_deltas
+from dedupe import WebhookDeduplicator
+from eventlog import durable_limit, read_from, writer_directories
+from ingest import FORM_EVENTS, LEAD_FORM_FIELDS, event_from_json, lead_form_data
+from leads import lookup_recipient
+from signatures import SignatureVerifier
+import argparse
+import config
+import io
+import json
+import signatures
+import sys
+import time
+import zlib
+
+try:
+    from queue import Empty, Full
+except ImportError:
+    from Queue import Empty, Full
+
+
+class ReplayFailed(Exception):
+    """
+    A worker process exited before finishing its shard
+    """
+
+    def __init__(self, shard, exitcode):
+        super(ReplayFailed, self).__init__('replay worker for shard {} exited with code {}'.format(shard, exitcode))
+        self.shard = shard
+        self.exitcode = exitcode
+
+
+def read_jsonl(paths):
+    """
+    Yield (kind, form_data) from JSONL files, '-' reads stdin
+    :param paths: list of file paths
+    :return: generator
+    """
+    for path in paths:
+        fp = sys.stdin if path == '-' else io.open(path, encoding='utf-8')
+        try:
+            for line in fp:
+                line = line.strip()
+                if not line:
+                    continue
+
+                item = json.loads(line)
+                if 'event-data' in item:
+                    yield event_from_json(item)
+                elif 'data' in item and 'kind' in item:
+                    # event log records and dead letters are already form_data
+                    yield item['kind'], item['data']
+                else:
+                    # posted form fields, mapped like the lead webhook routes map them
+                    kind = item.get('kind') or FORM_EVENTS.get(item.get('event'))
+                    yield kind, lead_form_data(kind, item) if kind in LEAD_FORM_FIELDS else item
+        finally:
+            if fp is not sys.stdin:
+                fp.close()
+
+
+def read_log(base_dir):
+    """
+    Yield (kind, form_data) from every writer directory of the event log
+    :param base_dir: the event log base directory
+    :return: generator
+    """
+    for directory in writer_directories(base_dir):
+        for record, _, _ in read_from(directory, limit=durable_limit(directory)):
+            yield record['kind'], record['data']
+
+
+def shard_of(recipient, shards):
+    return zlib.crc32(recipient.strip().lower().encode('utf-8')) % shards
+
+
+def apply_chunk(session, chunk):
+    """
+    Resolve and apply a chunk of events in one transaction
+    :param session: db session
+    :param chunk: list of (kind, form_data)
+    :return: (events applied, events unresolved)
+    """
+    pending = OrderedDict()
+    unresolved = 0
+
+    for kind, data in chunk:
+        row = lookup_recipient(session, data['recipient'])
+
+        if row and row.lead_id:
+            pending.setdefault(row.lead_id, PendingLead(row.lead_id)).apply(kind, data)
+        else:
+            unresolved += 1
+
+    if pending:
+        flush_pending(session, pending)
+
+    return len(chunk) - unresolved, unresolved
+
+
+def worker(chunks, results, deltas=False):
+    # connections must not be shared with the parent process
+    db_session.remove()
+    db_session.get_bind().dispose()
+
+    if not deltas:
+        dashboard_deltas.flush_interval = 0
+        rollup_deltas.flush_interval = 0
+
+    applied = unresolved = 0
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            a, u = apply_chunk(db_session, chunk)
+            applied += a
+            unresolved += u
+            db_session.remove()
+
+        # worker processes exit without running atexit hooks
+        dashboard_deltas.flush()
+        rollup_deltas.flush()
+    finally:
+        results.put((applied, unresolved))
+
+
+def _failed(procs):
+    for shard, proc in enumerate(procs):
+        if not proc.is_alive() and proc.exitcode:
+            return ReplayFailed(shard, proc.exitcode)
+    return None
+
+
+def _abort(procs, chunks, error):
+    for proc in procs:
+        if proc.is_alive():
+            proc.terminate()
+    # chunks buffered for a dead worker would block the interpreter exit
+    for queue in chunks:
+        queue.cancel_join_thread()
+    raise error
+
+
+def _put(chunks, procs, shard, item, timeout=1.0):
+    # a dead worker never drains its queue, check on it instead of blocking forever
+    while True:
+        try:
+            chunks[shard].put(item, timeout=timeout)
+            return
+        except Full:
+            if not procs[shard].is_alive():
+                _abort(procs, chunks, ReplayFailed(shard, procs[shard].exitcode))
+
+
+def replay(events, workers=4, batch=2000, verify=True, deltas=False):
+    """
+    :param events: iterable of (kind, form_data)
+    :param workers: number of worker processes
+    :param batch: events per transaction
+    :param verify: check the Mailgun signatures
+    :param deltas: count the events in the dashboard and rollup deltas
+    :return: dict of counts
+    :raises ReplayFailed: when a worker process dies
+    """
+    verifier = SignatureVerifier(config.MAILGUN_API_KEY, max_age=0)
+    deduplicator = WebhookDeduplicator(window=7 * 86400, maxsize=10000000)
+    counts = {"read": 0, "invalid": 0, "ignored": 0, "duplicate": 0, "applied": 0, "unresolved": 0}
+
+    chunks = [Queue(maxsize=8) for _ in range(workers)]
+    results = Queue()
+    procs = [Process(target=worker, args=(chunks[i], results, deltas)) for i in range(workers)]
+    for proc in procs:
+        proc.daemon = True
+        proc.start()
+
+    buffers = [[] for _ in range(workers)]
+
+    for kind, data in events:
+        counts['read'] += 1
+
+        if kind is None or not data.get('recipient'):
+            counts['ignored'] += 1
+            continue
+
+        if verify and verifier.verify(data.get('token'), data.get('timestamp'),
+                                      data.get('signature')) != signatures.VALID:
+            counts['invalid'] += 1
+            continue
+
+        if not deduplicator.claim(data):
+            counts['duplicate'] += 1
+            continue
+
+        shard = shard_of(data['recipient'], workers)
+        buffers[shard].append((kind, data))
+        if len(buffers[shard]) >= batch:
+            _put(chunks, procs, shard, buffers[shard])
+            buffers[shard] = []
+
+    for shard in range(workers):
+        if buffers[shard]:
+            _put(chunks, procs, shard, buffers[shard])
+        _put(chunks, procs, shard, None)
+
+    received = 0
+    while received < len(procs):
+        try:
+            applied, unresolved = results.get(timeout=1.0)
+        except Empty:
+            error = _failed(procs)
+            if error is not None:
+                _abort(procs, chunks, error)
+            continue
+        received += 1
+        counts['applied'] += applied
+        counts['unresolved'] += unresolved
+
+    for proc in procs:
+        proc.join()
+
+    error = _failed(procs)
+    if error is not None:
+        raise error
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-apply recorded Mailgun webhook events.')
+    parser.add_argument('files', nargs='*', help='JSONL files, - for stdin')
+    parser.add_argument('--log', help='replay the durable event log under this directory')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch', type=int, default=2000, help='events per transaction')
+    parser.add_argument('--no-verify', action='store_true', help='skip the signature check')
+    parser.add_argument('--deltas', action='store_true',
+                        help='count the events in the dashboard and rollup deltas')
+    args = parser.parse_args()
+
+    if not args.files and not args.log:
+        parser.error('give JSONL files or --log')
+
+    events = read_log(args.log) if args.log else read_jsonl(args.files)
+
+    started = time.time()
+    try:
+        counts = replay(events, workers=args.workers, batch=args.batch, verify=not args.no_verify,
+                        deltas=args.deltas)
+    except ReplayFailed as err:
+        sys.exit('replay aborted: {}'.format(err))
+    elapsed = time.time() - started
+
+    print(json.dumps(counts))
+    print('{} events in {:.2f}s, {:.0f} events/sec'.format(
+        counts['read'], elapsed, counts['read'] / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+"""
+Hourly engagement rollups per campaign, compacted into daily buckets after
+the retention window.
+
+    python rollups.py hourly [--hours 2]
+    python rollups.py compact [--retention-days 30]
+    python rollups.py prune-events [--retention-days 90]
+
+Run from cron, e.g. hourly at :05, compact and prune-events daily.  The
+tables are created by migrations/0001_lead_events_and_engagement_rollups.sql.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import and_, bindparam, func, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from threading import Condition, Thread
+from database import db_session
+from dashboards import lead_campaigns
+from models import AppendedVisitor, EngagementRollup, Lead, Visitor
+import argparse
+import atexit
+import config
+import json
+import logging
+import os
+
+
+log = logging.getLogger(__name__)
+
+HOUR = 'hour'
+DAY = 'day'
+
+METRICS = ('visitors', 'appends', 'deliveries', 'opens', 'clicks', 'bounces', 'rvms')
+
+# webhook event kinds counted in the rollups
+EVENT_METRICS = {
+    'delivered': 'deliveries',
+    'open': 'opens',
+    'click': 'clicks',
+    'hard-bounce': 'bounces'
+}
+
+rollups_table = EngagementRollup.__table__
+
+
+def hour_of(ts):
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def day_of(ts):
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def merge_buckets(session, granularity, buckets, replace=False):
+    """
+    Add (or with replace, set) metric values on rollup rows, inserting the
+    rows that don't exist yet.  MySQL gets one INSERT ... ON DUPLICATE KEY
+    UPDATE per set of metrics; other databases update and then insert, like
+    dashboards.upsert_deltas, which is only safe with a single writer.
+    :param session: db session
+    :param granularity: HOUR or DAY
+    :param buckets: dict of (campaign_id, bucket) -> {metric: n}
+    :param replace: overwrite the metrics instead of adding to them
+    :return: None
+    """
+    if not buckets:
+        return
+
+    t = rollups_table
+    now = datetime.now()
+
+    if session.get_bind().dialect.name == 'mysql':
+        groups = defaultdict(list)
+        for (campaign_id, bucket), metrics in buckets.items():
+            row = dict((m, 0) for m in METRICS)
+            row.update(metrics)
+            row.update(campaign_id=campaign_id, granularity=granularity, bucket=bucket, last_update=now)
+            groups[tuple(sorted(metrics))].append(row)
+
+        for names, rows in groups.items():
+            stmt = mysql_insert(t)
+            updates = dict((m, stmt.inserted[m] if replace else t.c[m] + stmt.inserted[m]) for m in names)
+            updates['last_update'] = stmt.inserted.last_update
+            session.execute(stmt.on_duplicate_key_update(**updates), rows)
+        return
+
+    existing = set(tuple(row) for row in session.execute(
+        select([t.c.campaign_id, t.c.bucket]).where(and_(
+            t.c.granularity == granularity,
+            t.c.campaign_id.in_(set(k[0] for k in buckets)),
+            t.c.bucket.in_(set(k[1] for k in buckets))
+        ))
+    ))
+
+    inserts = []
+    updates = defaultdict(list)
+
+    for (campaign_id, bucket), metrics in buckets.items():
+        if (campaign_id, bucket) in existing:
+            params = dict(('b_' + m, n) for m, n in metrics.items())
+            params.update(b_campaign_id=campaign_id, b_bucket=bucket, b_last_update=now)
+            updates[tuple(sorted(metrics))].append(params)
+        else:
+            row = dict((m, 0) for m in METRICS)
+            row.update(metrics)
+            row.update(campaign_id=campaign_id, granularity=granularity, bucket=bucket, last_update=now)
+            inserts.append(row)
+
+    for names, params in updates.items():
+        values = {"last_update": bindparam('b_last_update')}
+        for m in names:
+            values[m] = bindparam('b_' + m) if replace else t.c[m] + bindparam('b_' + m)
+        stmt = t.update().where(and_(
+            t.c.campaign_id == bindparam('b_campaign_id'),
+            t.c.granularity == granularity,
+            t.c.bucket == bindparam('b_bucket')
+        )).values(**values)
+        session.execute(stmt, params)
+
+    if inserts:
+        session.execute(t.insert(), inserts)
+
+
+class RollupDeltas(object):
+    """
+    Counts webhook events per lead and hour, merged into the hourly rollups
+    every flush_interval seconds.  A failed batch is retried on its own for
+    max_attempts flushes and then dropped.
+    """
+
+    def __init__(self, session, flush_interval=10.0, max_attempts=5):
+        self.session = session
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._pending = defaultdict(lambda: defaultdict(int))
+        self._retries = []
+        self._cond = Condition()
+        self._pid = None
+        self.flushes = 0
+        self.errors = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self):
+        return bool(self.flush_interval)
+
+    def _ensure_thread(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            thread = Thread(target=self._run, name='rollup-deltas')
+            thread.daemon = True
+            thread.start()
+
+    def lead_event(self, lead_id, kind, ts):
+        """
+        Count an event in the hour it happened, Mailgun retries and the log
+        and async ingest modes apply events late
+        :param lead_id:
+        :param kind: one of leads.LEAD_EVENTS
+        :param ts: the event time
+        :return: None
+        """
+        metric = EVENT_METRICS.get(kind)
+        if metric is None or not self.enabled:
+            return
+        with self._cond:
+            self._ensure_thread()
+            self._pending[(lead_id, hour_of(ts))][metric] += 1
+
+    def _merge(self, pending, attempts):
+        try:
+            campaigns = dict((row[0], row[1]) for row in lead_campaigns(self.session, set(k[0] for k in pending)))
+            buckets = defaultdict(lambda: defaultdict(int))
+            for (lead_id, bucket), metrics in pending.items():
+                if lead_id in campaigns:
+                    for m, n in metrics.items():
+                        buckets[(campaigns[lead_id], bucket)][m] += n
+
+            merge_buckets(self.session, HOUR, buckets)
+            self.session.commit()
+            self.flushes += 1
+        except Exception as err:
+            self.session.rollback()
+            self.errors += 1
+            attempts += 1
+            if attempts >= self.max_attempts:
+                self.dropped += 1
+                log.error('rollup merge failed %s times, dropped %s buckets: %s', attempts, len(pending), err)
+                return
+            log.error('rollup merge failed, requeued: %s', err)
+            with self._cond:
+                self._retries.append((pending, attempts))
+        finally:
+            self.session.remove()
+
+    def flush(self):
+        with self._cond:
+            pending, self._pending = self._pending, defaultdict(lambda: defaultdict(int))
+            retries, self._retries = self._retries, []
+
+        for batch in retries:
+            self._merge(*batch)
+        if pending:
+            self._merge(pending, 0)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as err:
+                log.exception('rollup deltas: %s', err)
+
+
+# ROLLUP_DELTA_INTERVAL of 0 turns off the webhook driven rollup counts
+deltas = RollupDeltas(db_session, flush_interval=getattr(config, 'ROLLUP_DELTA_INTERVAL', 0),
+                      max_attempts=getattr(config, 'ROLLUP_DELTA_MAX_ATTEMPTS', 5))
+atexit.register(deltas.flush)
+
+
+def rollup_hour(session, start):
+    """
+    Recount visitors, appends and RVMs for one hour, per campaign, and set
+    them on the hourly rollups.  Webhook metrics are left alone.
+    :param session: db session
+    :param start: the hour
+    :return: number of campaigns updated
+    """
+    start = hour_of(start)
+    end = start + timedelta(hours=1)
+    buckets = defaultdict(dict)
+
+    visitors = session.query(Visitor.campaign_id, func.count(Visitor.id)).filter(
+        Visitor.created_date >= start, Visitor.created_date < end
+    ).group_by(Visitor.campaign_id)
+
+    appends = session.query(Visitor.campaign_id, func.count(AppendedVisitor.id)).join(
+        AppendedVisitor, AppendedVisitor.visitor == Visitor.id
+    ).filter(
+        AppendedVisitor.created_date >= start, AppendedVisitor.created_date < end
+    ).group_by(Visitor.campaign_id)
+
+    rvms = session.query(Visitor.campaign_id, func.count(Lead.id)).join(
+        AppendedVisitor, AppendedVisitor.visitor == Visitor.id
+    ).join(
+        Lead, Lead.appended_visitor_id == AppendedVisitor.id
+    ).filter(
+        Lead.rvm_sent == True,  # noqa: E712
+        Lead.rvm_date >= start, Lead.rvm_date < end
+    ).group_by(Visitor.campaign_id)
+
+    for metric, query in (('visitors', visitors), ('appends', appends), ('rvms', rvms)):
+        for campaign_id, n in query:
+            buckets[(campaign_id, start)][metric] = int(n)
+
+    for metrics in buckets.values():
+        for metric in ('visitors', 'appends', 'rvms'):
+            metrics.setdefault(metric, 0)
+
+    merge_buckets(session, HOUR, buckets, replace=True)
+    session.commit()
+    return len(buckets)
+
+
+def compact(session, retention_days=30, chunk=5000):
+    """
+    Fold hourly rollups older than the retention window into daily buckets
+    :param session: db session
+    :param retention_days: days of hourly rollups to keep
+    :param chunk: hourly rows per transaction
+    :return: number of hourly rows compacted
+    """
+    cutoff = day_of(datetime.now() - timedelta(days=retention_days))
+    t = rollups_table
+    compacted = 0
+
+    while True:
+        rows = session.execute(
+            select([t.c.id, t.c.campaign_id, t.c.bucket] + [t.c[m] for m in METRICS]).where(and_(
+                t.c.granularity == HOUR, t.c.bucket < cutoff
+            )).order_by(t.c.bucket).limit(chunk)
+        ).fetchall()
+
+        if not rows:
+            return compacted
+
+        days = defaultdict(lambda: defaultdict(int))
+        for row in rows:
+            for idx, m in enumerate(METRICS):
+                days[(row[1], day_of(row[2]))][m] += row[3 + idx] or 0
+
+        merge_buckets(session, DAY, days)
+        session.execute(t.delete().where(t.c.id.in_([row[0] for row in rows])))
+        session.commit()
+        compacted += len(rows)
+
+
+def timeseries(session, campaign_id, start, end, granularity=HOUR, metrics=METRICS):
+    """
+    Read a campaign time series from the rollups, hourly rows are folded
+    into days when a daily series is asked for
+    :param session: db session
+    :param campaign_id:
+    :param start: datetime
+    :param end: datetime
+    :param granularity: HOUR or DAY
+    :param metrics: metric names
+    :return: list of dicts ordered by bucket
+    """
+    t = rollups_table
+    rows = session.execute(
+        select([t.c.granularity, t.c.bucket] + [t.c[m] for m in metrics]).where(and_(
+            t.c.campaign_id == campaign_id, t.c.bucket >= start, t.c.bucket < end
+        )).order_by(t.c.bucket)
+    ).fetchall()
+
+    series = defaultdict(lambda: defaultdict(int))
+    for row in rows:
+        bucket = day_of(row[1]) if granularity == DAY else row[1]
+        for idx, m in enumerate(metrics):
+            series[bucket][m] += row[2 + idx] or 0
+
+    points = []
+    for bucket in sorted(series):
+        point = dict(series[bucket])
+        point['bucket'] = bucket.isoformat()
+        points.append(point)
+    return points
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain the engagement rollups.')
+    sub = parser.add_subparsers(dest='command')
+    hourly = sub.add_parser('hourly', help='recount visitors, appends and RVMs for recent hours')
+    hourly.add_argument('--hours', type=int, default=2)
+    comp = sub.add_parser('compact', help='fold old hourly rollups into days')
+    comp.add_argument('--retention-days', type=int, default=getattr(config, 'ROLLUP_RETENTION_DAYS', 30))
+    prune = sub.add_parser('prune-events', help='delete lead_events older than the retention window')
+    prune.add_argument('--retention-days', type=int, default=getattr(config, 'LEAD_EVENTS_RETENTION_DAYS', 90))
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'hourly':
+            now = datetime.now()
+            result = dict(
+                (hour_of(now - timedelta(hours=h)).isoformat(), rollup_hour(db_session, now - timedelta(hours=h)))
+                for h in range(args.hours)
+            )
+        elif args.command == 'compact':
+            result = {"compacted": compact(db_session, args.retention_days)}
+        elif args.command == 'prune-events':
+            # leads imports this module for its deltas
+            from leads import prune_lead_events
+            cutoff = day_of(datetime.now() - timedelta(days=args.retention_days))
+            result = {"pruned": prune_lead_events(db_session, cutoff), "before": cutoff.isoformat()}
+        else:
+            parser.error('choose hourly, compact or prune-events')
+        print(json.dumps(result))
+    finally:
+        db_session.remove()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+from six import text_type
+import hashlib
+import hmac
+import time
+
+
+# verification results
+VALID = 'valid'
+INVALID = 'invalid'
+STALE = 'stale'
+MALFORMED = 'malformed'
+
+
+def _bytes(value):
+    # JSON payloads can carry the timestamp or token as a number
+    if isinstance(value, bytes):
+        return value
+    return text_type(value).encode('utf-8')
+
+
+class SignatureVerifier(object):
+    """
+    Mailgun webhook signature check.  The keyed HMAC is built once and
+    copied per request, and timestamps outside max_age seconds are rejected
+    before the HMAC is computed.
+    """
+
+    def __init__(self, api_key, max_age=900, clock=time.time):
+        self._prototype = hmac.new(_bytes(api_key), digestmod=hashlib.sha256)
+        self.max_age = max_age
+        self.clock = clock
+        self.counts = {VALID: 0, INVALID: 0, STALE: 0, MALFORMED: 0}
+        self.total_us = 0.0
+        self.max_us = 0.0
+
+    def check(self, token, timestamp, signature):
+        """
+        :param token: the webhook token
+        :param timestamp: the webhook timestamp, unix seconds
+        :param signature: the hex HMAC-SHA256 of timestamp + token
+        :return: VALID, INVALID, STALE or MALFORMED
+        """
+        if not token or not timestamp or not signature:
+            return MALFORMED
+
+        try:
+            sent = int(timestamp)
+        except (TypeError, ValueError):
+            return MALFORMED
+
+        if self.max_age and abs(self.clock() - sent) > self.max_age:
+            return STALE
+
+        digest = self._prototype.copy()
+        digest.update(_bytes(timestamp))
+        digest.update(_bytes(token))
+
+        if hmac.compare_digest(_bytes(signature), _bytes(digest.hexdigest())):
+            return VALID
+
+        return INVALID
+
+    def verify(self, token, timestamp, signature):
+        """
+        check() with timing and result counters
+        :return: VALID, INVALID, STALE or MALFORMED
+        """
+        started = time.time()
+        result = self.check(token, timestamp, signature)
+        elapsed = (time.time() - started) * 1000000.0
+
+        self.counts[result] += 1
+        self.total_us += elapsed
+        if elapsed > self.max_us:
+            self.max_us = elapsed
+
+        return result
+
+    def stats(self):
+        total = sum(self.counts.values())
+        return {
+            "results": dict(self.counts),
+            "max_age": self.max_age,
+            "avg_us": round(self.total_us / total, 3) if total else 0.0,
+            "max_us": round(self.max_us, 3)
+        }
@@ -0,0 +1,235 @@
+"""
+AlertDispatcher against the in-memory outbox transports, and SmtpPool and
+TwilioSms against local SMTP and HTTP stand-ins.
+
+    python -m pytest tests
+"""
+from threading import Thread
+from alerts import AlertDispatcher, OutboxSms, OutboxSmtp, SmtpPool, TwilioSms
+import json
+import smtplib
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import StreamRequestHandler, ThreadingTCPServer
+    from urllib.parse import parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import StreamRequestHandler, ThreadingTCPServer
+    from urlparse import parse_qs
+
+
+class SmtpStandIn(StreamRequestHandler):
+    """
+    Just enough SMTP for smtplib: EHLO, MAIL, RCPT, DATA, NOOP and QUIT.
+    Recipients at reject.example.com are refused.
+    """
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 stand-in')
+        recipients = []
+
+        while True:
+            line = self.rfile.readline().decode('ascii').rstrip('\r\n')
+            verb = line[:4].upper()
+
+            if not line or verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            elif verb in ('EHLO', 'HELO'):
+                self.reply('250 stand-in')
+            elif verb == 'RCPT':
+                recipient = line.split(':', 1)[1].strip('<> ')
+                if recipient.endswith('@reject.example.com'):
+                    self.reply('550 no such user')
+                    continue
+                recipients.append(recipient)
+                self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                body = []
+                for data in iter(self.rfile.readline, b''):
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                    body.append(data.decode('utf-8'))
+                self.server.messages.append((recipients, ''.join(body)))
+                recipients = []
+                self.reply('250 queued')
+            else:
+                # MAIL, RSET and NOOP
+                self.reply('250 ok')
+
+
+class TwilioStandIn(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        self.server.requests.append((self.path, form))
+
+        body = json.dumps({"sid": 'SM{}'.format(len(self.server.requests))}).encode('utf-8')
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(server):
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class Failing(object):
+
+    def __init__(self, bad):
+        self.bad = bad
+
+    def send(self, to, body):
+        if to in self.bad:
+            raise IOError('unreachable')
+        return 'SM-' + to
+
+
+class AlertDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.smtp = OutboxSmtp()
+        self.sms = OutboxSms()
+        self.dispatcher = AlertDispatcher(self.smtp, self.sms, sender='earl@example.com', pool_size=2)
+
+    def test_email_one_message_per_recipient(self):
+        to = ['a@example.com', 'b@example.com', 'c@example.com']
+        sent = self.dispatcher.send_email(to, 'EARL alert', '<p>down</p>')
+
+        self.assertEqual(sent, to)
+        self.assertEqual(sorted(m[1][0] for m in self.smtp.messages), to)
+        for sender, recipients, message in self.smtp.messages:
+            self.assertEqual(sender, 'earl@example.com')
+            self.assertIn('To: {}'.format(recipients[0]), message)
+            self.assertIn('Subject: EARL alert', message)
+        self.assertEqual(self.dispatcher.stats()['email']['sent'], 3)
+
+    def test_sms_returns_the_sids(self):
+        sids = self.dispatcher.send_sms(['+15550001', '+15550002'], 'down')
+
+        self.assertEqual(len(sids), 2)
+        self.assertEqual(sorted(m[0] for m in self.sms.messages), ['+15550001', '+15550002'])
+
+    def test_failed_recipient_is_counted_and_skipped(self):
+        dispatcher = AlertDispatcher(sms=Failing(['+15550002']), pool_size=2)
+        sids = dispatcher.send_sms(['+15550001', '+15550002', '+15550003'], 'down')
+
+        self.assertEqual(sids, ['SM-+15550001', 'SM-+15550003'])
+        stats = dispatcher.stats()['sms']
+        self.assertEqual((stats['sent'], stats['errors']), (2, 1))
+
+    def test_factory_builds_the_transports_once(self):
+        built = []
+
+        def factory():
+            built.append(1)
+            return self.smtp, self.sms
+
+        dispatcher = AlertDispatcher(sender='earl@example.com', factory=factory)
+        dispatcher.send_sms(['+15550001'], 'down')
+        dispatcher.send_email(['a@example.com'], 'EARL alert', 'down')
+
+        self.assertEqual(len(built), 1)
+
+    def test_outbox_from_config(self):
+        class config(object):
+            ALERT_TRANSPORT = 'outbox'
+            MAIL_DEFAULT_SENDER = 'earl@example.com'
+
+        dispatcher = AlertDispatcher.from_config(config)
+
+        self.assertIsInstance(dispatcher.smtp, OutboxSmtp)
+        self.assertIsInstance(dispatcher.sms, OutboxSms)
+
+
+class SmtpPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = serve(ThreadingTCPServer(('127.0.0.1', 0), SmtpStandIn))
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.messages = []
+        self.pool = SmtpPool('127.0.0.1', self.server.server_address[1], use_tls=False, size=1)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_is_reused(self):
+        self.pool.send('earl@example.com', ['a@example.com'], 'Subject: one\r\n\r\nfirst')
+        self.pool.send('earl@example.com', ['b@example.com'], 'Subject: two\r\n\r\nsecond')
+
+        self.assertEqual(self.pool.opened, 1)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual([m[0] for m in self.server.messages], [['a@example.com'], ['b@example.com']])
+
+    def test_refused_recipient_keeps_the_connection(self):
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self.pool.send,
+                          'earl@example.com', ['a@reject.example.com'], 'Subject: one\r\n\r\nfirst')
+        self.pool.send('earl@example.com', ['b@example.com'], 'Subject: two\r\n\r\nsecond')
+
+        self.assertEqual(self.pool.opened, 1)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual([m[0] for m in self.server.messages], [['b@example.com']])
+
+    def test_failed_send_closes_the_connection(self):
+        conn = self.pool._checkout()
+
+        def broken(*args):
+            raise smtplib.SMTPException('broken')
+
+        conn.sendmail = broken
+        self.pool._checkin(conn)
+
+        self.assertRaises(smtplib.SMTPException, self.pool.send,
+                          'earl@example.com', ['a@example.com'], 'Subject: one\r\n\r\nfirst')
+        self.assertTrue(self.pool._idle.empty())
+        self.assertIsNone(conn.sock)
+
+    def test_dispatcher_over_smtp(self):
+        dispatcher = AlertDispatcher(smtp=self.pool, sender='earl@example.com', pool_size=2)
+        sent = dispatcher.send_email(['a@example.com', 'b@example.com'], 'EARL alert', '<p>down</p>')
+
+        self.assertEqual(sorted(sent), ['a@example.com', 'b@example.com'])
+        self.assertEqual(len(self.server.messages), 2)
+
+
+class TwilioSmsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = serve(HTTPServer(('127.0.0.1', 0), TwilioStandIn))
+        self.server.requests = []
+        base_url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.sms = TwilioSms('AC123', 'token', '+15559999', base_url=base_url)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_send_posts_the_message(self):
+        sid = self.sms.send('+15550001', 'down')
+
+        self.assertEqual(sid, 'SM1')
+        path, form = self.server.requests[0]
+        self.assertEqual(path, '/2010-04-01/Accounts/AC123/Messages.json')
+        self.assertEqual(form, {"To": ['+15550001'], "From": ['+15559999'], "Body": ['down']})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+"""
+NegativeCache entries are only trusted while the Watermark generation holds.
+
+    python -m pytest tests
+"""
+from cache import NegativeCache, Watermark
+import unittest
+
+
+class NegativeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.unknown = NegativeCache(maxsize=10, ttl=600)
+
+    def test_hit_at_the_same_generation(self):
+        self.unknown.add('Nobody@Example.com', 41)
+
+        self.assertTrue(self.unknown.contains('nobody@example.com ', 41))
+
+    def test_new_generation_invalidates(self):
+        self.unknown.add('nobody@example.com', 41)
+
+        self.assertFalse(self.unknown.contains('nobody@example.com', 42))
+        # the stale entry is gone, even at the old generation
+        self.assertFalse(self.unknown.contains('nobody@example.com', 41))
+        self.assertEqual(self.unknown.stats()['stale'], 1)
+
+    def test_discard(self):
+        self.unknown.add('nobody@example.com', 1)
+        self.unknown.discard('nobody@example.com')
+
+        self.assertFalse(self.unknown.contains('nobody@example.com', 1))
+
+
+class WatermarkTest(unittest.TestCase):
+
+    def test_read_once_per_interval(self):
+        reads = []
+        watermark = Watermark(interval=60)
+
+        def read():
+            reads.append(1)
+            return len(reads)
+
+        self.assertEqual([watermark.get(read) for _ in range(3)], [1, 1, 1])
+        watermark.expire()
+        self.assertEqual(watermark.get(read), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
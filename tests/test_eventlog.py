@@ -0,0 +1,131 @@
+"""
+EventLog framing, the torn and corrupt tail checks, the truncate after a
+failed fsync and the durable limit drainers read up to.
+
+    python -m pytest tests
+"""
+from eventlog import (HEADER, DurableMark, EventLog, durable_limit, list_segments, read_from, read_segment,
+                      writer_directories)
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+import zlib
+
+
+def frame(record):
+    payload = record.encode('utf-8')
+    return HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+class ReadSegmentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'segment.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, data):
+        with open(self.path, 'wb') as fp:
+            fp.write(data)
+
+    def records(self, **kwargs):
+        return [record for record, _ in read_segment(self.path, **kwargs)]
+
+    def test_torn_frame_is_not_returned(self):
+        second = frame('{"n":2}')
+        self.write(frame('{"n":1}') + second[:len(second) - 3])
+
+        self.assertEqual(self.records(), [{"n": 1}])
+
+    def test_torn_header_is_not_returned(self):
+        self.write(frame('{"n":1}') + struct.pack('>I', 7))
+
+        self.assertEqual(self.records(), [{"n": 1}])
+
+    def test_crc_mismatch_stops_the_read(self):
+        corrupt = bytearray(frame('{"n":2}'))
+        corrupt[-2] ^= 0xff
+        self.write(frame('{"n":1}') + bytes(corrupt) + frame('{"n":3}'))
+
+        self.assertEqual(self.records(), [{"n": 1}])
+
+    def test_end_offset(self):
+        first = frame('{"n":1}')
+        self.write(first + frame('{"n":2}'))
+
+        self.assertEqual(self.records(end=len(first)), [{"n": 1}])
+        self.assertEqual(self.records(end=len(first) + 3), [{"n": 1}])
+
+
+class EventLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.log = EventLog(self.base, group_commit_ms=0)
+        self.fsync = os.fsync
+
+    def tearDown(self):
+        os.fsync = self.fsync
+        shutil.rmtree(self.base)
+
+    def directory(self):
+        return writer_directories(self.base)[0]
+
+    def read(self, limit=None):
+        return [record['n'] for record, _, _ in read_from(self.directory(), limit=limit)]
+
+    def test_append_publishes_the_durable_position(self):
+        self.log.append({"n": 1})
+        self.log.append({"n": 2})
+
+        segment, offset = DurableMark(self.directory()).load()
+        self.assertEqual(segment, list_segments(self.directory())[-1])
+        self.assertEqual(offset, os.path.getsize(os.path.join(self.directory(), segment)))
+        self.assertEqual(self.read(durable_limit(self.directory())), [1, 2])
+
+    def test_unsynced_bytes_are_not_drained(self):
+        self.log.append({"n": 1})
+        limit = durable_limit(self.directory())
+        # a record written but not yet fsynced
+        with open(os.path.join(self.directory(), limit[0]), 'ab') as fp:
+            fp.write(frame('{"n":2}'))
+
+        self.assertEqual(self.read(limit), [1])
+        self.assertEqual(self.read(), [1, 2])
+
+    def test_failed_fsync_truncates_and_fails_the_append(self):
+        self.log.append({"n": 1})
+        before = DurableMark(self.directory()).load()
+
+        def failing(fd):
+            os.fsync = self.fsync
+            raise OSError(5, 'Input/output error')
+
+        os.fsync = failing
+        self.assertRaises(OSError, self.log.append, {"n": 2})
+
+        segment = os.path.join(self.directory(), before[0])
+        self.assertEqual(os.path.getsize(segment), before[1])
+        self.assertEqual(DurableMark(self.directory()).load(), before)
+        self.assertEqual(self.log.stats()['discarded'], 1)
+
+        # the next append lands where the discarded record was
+        self.log.append({"n": 3})
+        self.assertEqual(self.read(durable_limit(self.directory())), [1, 3])
+
+    def test_live_writer_without_a_mark_is_not_read(self):
+        directory = os.path.join(self.base, '{}-{}'.format(socket.gethostname(), os.getpid()))
+        os.makedirs(directory)
+        with open(os.path.join(directory, '{:020d}.log'.format(0)), 'wb') as fp:
+            fp.write(frame('{"n":1}'))
+
+        self.assertEqual(list(read_from(directory, limit=durable_limit(directory))), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
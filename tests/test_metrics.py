@@ -0,0 +1,74 @@
+"""
+Registry snapshots summed across workers, cleared when the master starts
+and folded into the exited totals when a worker exits.
+
+    python -m pytest tests
+"""
+from metrics import Registry
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+def snapshot(pid, requests, latency):
+    return {
+        "pid": pid,
+        "counters": [['earl_http_requests_total', [['route', 'status']], requests]],
+        "histograms": [['earl_http_request_duration_seconds', [], [1, 0], latency]]
+    }
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.registry = Registry(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, pid, requests, latency=0.5):
+        with open(os.path.join(self.dir, 'metrics-{}.json'.format(pid)), 'w') as f:
+            json.dump(snapshot(pid, requests, latency), f)
+
+    def totals(self):
+        counters, histograms = self.registry.collect()
+        return (counters[('earl_http_requests_total', (('route', 'status'),))],
+                histograms[('earl_http_request_duration_seconds', ())])
+
+    def test_default_directory(self):
+        class config(object):
+            pass
+
+        self.assertEqual(Registry.from_config(config).directory, 'var/metrics')
+
+    def test_workers_are_summed(self):
+        self.write(101, 3)
+        self.write(102, 4)
+
+        self.assertEqual(self.totals(), (7, [[2, 0], 1.0]))
+
+    def test_retire_keeps_the_exited_counts(self):
+        self.write(101, 3)
+        self.write(102, 4)
+        self.registry.retire(101)
+        self.write(103, 5)
+        self.registry.retire(103)
+        self.registry.retire(104)
+
+        self.assertEqual(sorted(os.listdir(self.dir)), ['metrics-102.json', 'metrics-exited.json'])
+        self.assertEqual(self.totals(), (12, [[3, 0], 1.5]))
+
+    def test_clear(self):
+        self.write(101, 3)
+        self.registry.retire(101)
+        self.write(102, 4)
+
+        self.assertEqual(self.registry.clear(), 2)
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
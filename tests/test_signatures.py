@@ -0,0 +1,54 @@
+"""
+SignatureVerifier results for form and JSON payloads.
+
+    python -m pytest tests
+"""
+from signatures import INVALID, MALFORMED, STALE, VALID, SignatureVerifier
+import hashlib
+import hmac
+import unittest
+
+KEY = 'key-test'
+NOW = 1700000000
+
+
+def sign(timestamp, token):
+    return hmac.new(KEY.encode('utf-8'), '{}{}'.format(timestamp, token).encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+
+class SignatureVerifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.verifier = SignatureVerifier(KEY, max_age=900, clock=lambda: NOW)
+
+    def test_valid(self):
+        self.assertEqual(self.verifier.check('abc', str(NOW), sign(NOW, 'abc')), VALID)
+
+    def test_int_timestamp(self):
+        self.assertEqual(self.verifier.check('abc', NOW, sign(NOW, 'abc')), VALID)
+
+    def test_int_token(self):
+        self.assertEqual(self.verifier.check(12345, NOW, sign(NOW, 12345)), VALID)
+
+    def test_wrong_signature(self):
+        self.assertEqual(self.verifier.check('abc', NOW, sign(NOW, 'abd')), INVALID)
+        self.assertEqual(self.verifier.check('abc', NOW, ['not', 'hex']), INVALID)
+
+    def test_stale(self):
+        self.assertEqual(self.verifier.check('abc', NOW - 901, sign(NOW - 901, 'abc')), STALE)
+
+    def test_malformed(self):
+        self.assertEqual(self.verifier.check('abc', 'yesterday', 'f00'), MALFORMED)
+        self.assertEqual(self.verifier.check(None, NOW, 'f00'), MALFORMED)
+
+    def test_verify_counts(self):
+        self.verifier.verify('abc', NOW, sign(NOW, 'abc'))
+        self.verifier.verify('abc', {'a': 1}, 'f00')
+
+        self.assertEqual(self.verifier.stats()['results'][VALID], 1)
+        self.assertEqual(self.verifier.stats()['results'][MALFORMED], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
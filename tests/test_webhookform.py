@@ -0,0 +1,107 @@
+"""
+WebhookFormParser on urlencoded and multipart bodies, fed in every chunk
+size so boundaries and pairs split across chunk edges, plus the truncated
+bodies and the size limits the routes answer with a 413.
+
+    python -m pytest tests
+"""
+from webhookform import FormTooLarge, WebhookFormParser
+import io
+import unittest
+
+
+FIELDS = ('recipient', 'event', 'timestamp', 'token', 'signature')
+
+BOUNDARY = 'b0undary'
+MULTIPART = 'multipart/form-data; boundary={}'.format(BOUNDARY)
+URLENCODED = 'application/x-www-form-urlencoded'
+
+
+def multipart(*parts):
+    """
+    :param parts: (name, value) or (name, filename, value)
+    :return: body bytes
+    """
+    body = b''
+    for part in parts:
+        if len(part) == 3:
+            disposition = 'form-data; name="{}"; filename="{}"'.format(part[0], part[1])
+            headers = 'Content-Disposition: {}\r\nContent-Type: application/octet-stream'.format(disposition)
+        else:
+            headers = 'Content-Disposition: form-data; name="{}"'.format(part[0])
+        value = part[-1] if isinstance(part[-1], bytes) else part[-1].encode('utf-8')
+        body += '--{}\r\n{}\r\n\r\n'.format(BOUNDARY, headers).encode('latin-1') + value + b'\r\n'
+    return body + '--{}--\r\n'.format(BOUNDARY).encode('latin-1')
+
+
+class WebhookFormParserTest(unittest.TestCase):
+
+    def parser(self, **kwargs):
+        return WebhookFormParser(FIELDS, **kwargs)
+
+    def chunked(self, body, content_type, chunk_size):
+        form = self.parser().start(content_type)
+        for at in range(0, len(body), chunk_size):
+            form.feed(body[at:at + chunk_size])
+        return form.close()
+
+    def test_urlencoded(self):
+        body = b'recipient=x%40y.com&event=opened&junk=1&token=ab+cd&timestamp=1500000000'
+
+        for size in range(1, len(body) + 1):
+            fields = self.chunked(body, URLENCODED, size)
+            self.assertEqual(fields, {"recipient": u'x@y.com', "event": u'opened', "token": u'ab cd',
+                                      "timestamp": u'1500000000'}, size)
+
+    def test_urlencoded_first_value_wins(self):
+        fields = self.parser().parse(io.BytesIO(b'event=opened&event=clicked'), URLENCODED)
+
+        self.assertEqual(fields, {"event": u'opened'})
+
+    def test_multipart_drops_attachments(self):
+        body = multipart(('recipient', 'x@y.com'), ('attachment-1', 'report.pdf', b'%PDF' + b'\x00' * 4096),
+                         ('body-plain', 'hello'), ('event', u'opened \u2713'))
+
+        fields = self.parser(chunk_size=1000).parse(io.BytesIO(body), MULTIPART, len(body))
+        self.assertEqual(fields, {"recipient": u'x@y.com', "event": u'opened \u2713'})
+
+    def test_multipart_boundary_split_across_chunks(self):
+        body = multipart(('recipient', 'x@y.com'), ('attachment-1', 'a.txt', b'--b0undar not yet'),
+                         ('token', 'abc'), ('signature', 'f00'))
+
+        for size in range(1, len(body) + 1):
+            fields = self.chunked(body, MULTIPART, size)
+            self.assertEqual(fields, {"recipient": u'x@y.com', "token": u'abc', "signature": u'f00'}, size)
+
+    def test_truncated_multipart_keeps_the_complete_parts(self):
+        body = multipart(('recipient', 'x@y.com'), ('token', 'abcdefgh'))
+        cut = body[:body.index(b'abcdefgh') + 4]
+
+        for size in (1, 7, len(cut)):
+            self.assertEqual(self.chunked(cut, MULTIPART, size), {"recipient": u'x@y.com'}, size)
+
+    def test_unknown_content_type_is_ignored(self):
+        fields = self.parser().parse(io.BytesIO(b'{"recipient": "x@y.com"}'), 'application/json')
+
+        self.assertEqual(fields, {})
+
+    def test_declared_length_over_the_limit(self):
+        self.assertRaises(FormTooLarge, self.parser(max_content_length=100).start, URLENCODED, 101)
+
+    def test_streamed_body_over_the_limit(self):
+        body = multipart(('recipient', 'x@y.com'), ('attachment-1', 'a.bin', b'\x00' * 500))
+        parser = self.parser(max_content_length=400, chunk_size=64)
+
+        self.assertRaises(FormTooLarge, parser.parse, io.BytesIO(body), MULTIPART)
+
+    def test_field_over_the_limit(self):
+        parser = self.parser(max_field_size=16, chunk_size=8)
+
+        self.assertRaises(FormTooLarge, parser.parse, io.BytesIO(multipart(('token', 'a' * 17))), MULTIPART)
+        self.assertRaises(FormTooLarge, parser.parse, io.BytesIO(b'token=' + b'a' * 17), URLENCODED)
+        # unwanted fields are dropped whatever their size
+        self.assertEqual(parser.parse(io.BytesIO(b'body-plain=' + b'a' * 100), URLENCODED), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
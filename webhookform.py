@@ -0,0 +1,265 @@
+"""
+Streaming parser for the Mailgun webhook form bodies.  Keeps only the
+whitelisted fields the lead routes read and discards everything else as it
+streams past, stored-message attachments included, so memory per request
+stays flat whatever the payload size.  Handles multipart/form-data and
+application/x-www-form-urlencoded bodies.
+"""
+from werkzeug.http import parse_options_header
+
+try:
+    from urllib.parse import unquote_to_bytes
+except ImportError:
+    from urllib import unquote as unquote_to_bytes
+
+
+class FormTooLarge(Exception):
+    """
+    The body passed the max content length, or a kept field passed the max
+    field size
+    """
+    pass
+
+
+def _unquote(value):
+    return unquote_to_bytes(value.replace(b'+', b' ')).decode('utf-8', 'replace')
+
+
+class UrlencodedForm(object):
+    """
+    Splits the body on '&' as it arrives.  A pair carried over into the next
+    chunk is dropped as soon as its name shows it isn't wanted.
+    """
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.fields = {}
+        self._pending = b''
+        self._skipping = False
+
+    def feed(self, chunk):
+        pieces = chunk.split(b'&')
+        last = len(pieces) - 1
+
+        for n, piece in enumerate(pieces):
+            if self._skipping:
+                # the next '&' ends the pair being skipped
+                self._skipping = n == last
+                continue
+
+            self._pending += piece
+            if n < last:
+                self._add(self._pending)
+                self._pending = b''
+            else:
+                self._check_pending()
+
+    def _check_pending(self):
+        name, eq, value = self._pending.partition(b'=')
+        if not eq:
+            if len(name) > self.parser.max_name_size:
+                self._pending, self._skipping = b'', True
+        elif not self.parser.wanted(_unquote(name), self.fields):
+            self._pending, self._skipping = b'', True
+        elif len(value) > self.parser.max_field_size * 3:
+            # percent encoding takes at most three bytes a byte
+            raise FormTooLarge('field {} is too large'.format(_unquote(name)))
+
+    def _add(self, pair):
+        name, _, value = pair.partition(b'=')
+        name = _unquote(name)
+        if self.parser.wanted(name, self.fields):
+            value = _unquote(value)
+            if len(value) > self.parser.max_field_size:
+                raise FormTooLarge('field {} is too large'.format(name))
+            self.fields[name] = value
+
+    def close(self):
+        if self._pending and not self._skipping:
+            self._add(self._pending)
+        self._pending = b''
+        return self.fields
+
+
+class MultipartForm(object):
+    """
+    Scans for the boundary as the body arrives.  Wanted text parts are kept,
+    file parts and unwanted fields are dropped chunk by chunk.
+    """
+
+    PREAMBLE, HEADERS, BODY, DONE = range(4)
+
+    def __init__(self, parser, boundary):
+        self.parser = parser
+        self.fields = {}
+        self._delimiter = b'\r\n--' + boundary
+        # the first boundary has no leading line break
+        self._buffer = b'\r\n'
+        self._state = self.PREAMBLE
+        self._name = None
+        self._value = None
+
+    def feed(self, chunk):
+        if self._state == self.DONE:
+            return
+        self._buffer += chunk
+
+        while self._state != self.DONE:
+            if self._state == self.HEADERS:
+                if not self._read_headers():
+                    return
+                continue
+
+            at = self._buffer.find(self._delimiter)
+            if at < 0:
+                # keep enough of the tail to match a boundary split across chunks
+                keep = len(self._delimiter) + 1
+                if len(self._buffer) > keep:
+                    self._take(len(self._buffer) - keep)
+                    self._buffer = self._buffer[-keep:]
+                return
+
+            self._take(at)
+            self._end_part()
+            rest = self._buffer[at + len(self._delimiter):]
+            if len(rest) < 2:
+                self._buffer = self._buffer[at:]
+                return
+            if rest.startswith(b'--'):
+                self._state = self.DONE
+                self._buffer = b''
+                return
+            self._buffer = rest
+            self._state = self.HEADERS
+
+    def _read_headers(self):
+        end = self._buffer.find(b'\r\n\r\n')
+        if end < 0:
+            if len(self._buffer) > self.parser.max_header_size:
+                raise FormTooLarge('part headers are too large')
+            return False
+
+        disposition = {}
+        for line in self._buffer[:end].split(b'\r\n'):
+            key, _, value = line.decode('latin-1').partition(':')
+            if key.strip().lower() == 'content-disposition':
+                disposition = parse_options_header(value.strip())[1]
+
+        self._buffer = self._buffer[end + 4:]
+        self._name = disposition.get('name')
+        wanted = 'filename' not in disposition and self.parser.wanted(self._name, self.fields)
+        self._value = bytearray() if wanted else None
+        self._state = self.BODY
+        return True
+
+    def _take(self, end):
+        # discarded parts are never copied out of the buffer
+        if self._value is None or not end:
+            return
+        self._value += self._buffer[:end]
+        if len(self._value) > self.parser.max_field_size:
+            raise FormTooLarge('field {} is too large'.format(self._name))
+
+    def _end_part(self):
+        if self._state == self.BODY and self._value is not None:
+            self.fields[self._name] = bytes(self._value).decode('utf-8', 'replace')
+        self._name = self._value = None
+
+    def close(self):
+        return self.fields
+
+
+class IgnoredForm(object):
+    """
+    Any other content type, the body is read and dropped
+    """
+
+    def __init__(self):
+        self.fields = {}
+
+    def feed(self, chunk):
+        pass
+
+    def close(self):
+        return self.fields
+
+
+class WebhookFormParser(object):
+    """
+    Reads at most max_content_length bytes of a webhook body and returns the
+    whitelisted fields, first value wins, like request.form.get
+    """
+
+    def __init__(self, fields, max_content_length=25 * 1024 * 1024, max_field_size=64 * 1024,
+                 max_name_size=256, max_header_size=8192, chunk_size=65536):
+        self.fields = frozenset(fields)
+        self.max_content_length = max_content_length
+        self.max_field_size = max_field_size
+        self.max_name_size = max_name_size
+        self.max_header_size = max_header_size
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_config(cls, config, fields):
+        return cls(
+            fields,
+            max_content_length=getattr(config, 'WEBHOOK_MAX_CONTENT_LENGTH', 25 * 1024 * 1024),
+            max_field_size=getattr(config, 'WEBHOOK_MAX_FIELD_SIZE', 64 * 1024)
+        )
+
+    def wanted(self, name, seen):
+        return name in self.fields and name not in seen
+
+    def start(self, content_type, content_length=None):
+        """
+        Begin a body, for callers that push the chunks themselves
+        :param content_type: the Content-Type header
+        :param content_length: the declared length, if any
+        :return: form with feed(chunk) and close() -> dict
+        """
+        if content_length is not None and content_length > self.max_content_length:
+            raise FormTooLarge('{} bytes is over the {} byte limit'.format(content_length, self.max_content_length))
+
+        mimetype, options = parse_options_header(content_type or '')
+        if mimetype == 'multipart/form-data' and options.get('boundary'):
+            form = MultipartForm(self, options['boundary'].encode('latin-1'))
+        elif mimetype == 'application/x-www-form-urlencoded':
+            form = UrlencodedForm(self)
+        else:
+            form = IgnoredForm()
+        return LimitedForm(form, self.max_content_length)
+
+    def parse(self, stream, content_type, content_length=None):
+        """
+        :param stream: file-like body, e.g. request.stream
+        :param content_type: the Content-Type header
+        :param content_length: the declared length, if any
+        :return: dict of the whitelisted fields
+        """
+        form = self.start(content_type, content_length)
+        while True:
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                break
+            form.feed(chunk)
+        return form.close()
+
+
+class LimitedForm(object):
+    """
+    Counts the bytes fed to a form, for bodies without a content length
+    """
+
+    def __init__(self, form, limit):
+        self.form = form
+        self.limit = limit
+        self.received = 0
+
+    def feed(self, chunk):
+        self.received += len(chunk)
+        if self.received > self.limit:
+            raise FormTooLarge('body is over the {} byte limit'.format(self.limit))
+        self.form.feed(chunk)
+
+    def close(self):
+        return self.form.close()
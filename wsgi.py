@@ -0,0 +1,9 @@
+"""
+WSGI entry point
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from api import create_app
+
+
+app = create_app()